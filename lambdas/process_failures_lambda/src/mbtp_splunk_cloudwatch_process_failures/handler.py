@@ -3,8 +3,6 @@
 import logging
 from os import environ
 
-import boto3
-
 logger = logging.getLogger()
 
 
@@ -32,8 +30,52 @@ REGION = environ["AWS_REGION"]
 RETRIES_PREFIX = environ["RETRIES_PREFIX"]
 FAILED_PREFIX = environ["FAILED_PREFIX"]
 
-s3_client = boto3.client("s3", region_name=REGION)
-sqs_client = boto3.client("sqs", region_name=REGION)
+# Clients are created the first time they're needed, so importing the handler
+# doesn't pay for importing boto3. Tests replace them by patching these.
+# pylint: disable=invalid-name
+_session = None
+s3_client = None
+sqs_client = None
+# pylint: enable=invalid-name
+
+
+def get_session():
+    """Gets the boto3 session every client is created from, importing boto3 the
+    first time so its setup is shared between them.
+
+    Returns:
+        boto3.session.Session: boto3 session
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        _session = boto3.session.Session(region_name=REGION)
+    return _session
+
+
+def get_s3_client():
+    """Gets the S3 client, creating it the first time it's needed.
+
+    Returns:
+        botocore.client.BaseClient: S3 client
+    """
+    global s3_client  # pylint: disable=global-statement
+    if s3_client is None:
+        s3_client = get_session().client("s3")
+    return s3_client
+
+
+def get_sqs_client():
+    """Gets the SQS client, creating it the first time it's needed.
+
+    Returns:
+        botocore.client.BaseClient: SQS client
+    """
+    global sqs_client  # pylint: disable=global-statement
+    if sqs_client is None:
+        sqs_client = get_session().client("sqs")
+    return sqs_client
 
 
 def redrive_dlq_sqs(source_arn: str, dest_arn: str):
@@ -44,7 +86,9 @@ def redrive_dlq_sqs(source_arn: str, dest_arn: str):
         dest_arn (str): ARN of the destination queue.
     """
     logger.info(f"Initiating DQL redrive from {source_arn} to {dest_arn}")
-    sqs_client.start_message_move_task(SourceArn=source_arn, DestinationArn=dest_arn)
+    get_sqs_client().start_message_move_task(
+        SourceArn=source_arn, DestinationArn=dest_arn
+    )
 
 
 def reprocess_failed_files(
@@ -59,7 +103,7 @@ def reprocess_failed_files(
         failed_prefix (str, optional): Prefix of the failed folder. Defaults to "failed/".
         retry_prefix (str, optional): Prefix of the retries folder. Defaults to "retries/".
     """
-    paginator = s3_client.get_paginator("list_objects_v2")
+    paginator = get_s3_client().get_paginator("list_objects_v2")
     pages = paginator.paginate(Bucket=bucket_name, Prefix=failed_prefix)
 
     for page in pages:
@@ -67,12 +111,12 @@ def reprocess_failed_files(
             key: str = file["Key"]
             new_key = f"{retry_prefix}{key.removeprefix(failed_prefix)}"
             logger.info(f"Moving {key} to {new_key}")
-            s3_client.copy_object(
+            get_s3_client().copy_object(
                 Bucket=bucket_name,
                 CopySource={"Bucket": bucket_name, "Key": key},
                 Key=new_key,
             )
-            s3_client.delete_object(Bucket=bucket_name, Key=key)
+            get_s3_client().delete_object(Bucket=bucket_name, Key=key)
 
 
 def lambda_handler(_event, _context):
@@ -4,10 +4,11 @@ import base64
 import gzip
 import json
 import logging
+import random
+import time
+import zlib
 from os import environ
-
-import boto3
-import botocore
+from typing import NamedTuple
 
 logger = logging.getLogger()
 
@@ -34,25 +35,147 @@ MAX_RETRIES = int(environ["MAX_RETRIES"])
 STREAM_NAME = environ["STREAM_NAME"]
 RETRIES_PREFIX = environ["RETRIES_PREFIX"]
 FAILED_PREFIX = environ["FAILED_PREFIX"]
+# Most bytes a record's data is allowed to decompress to
+MAX_DECOMPRESSED_RECORD_BYTES = int(
+    environ.get("MAX_DECOMPRESSED_RECORD_BYTES", 64 * 1024 * 1024)
+)
+
+# Clients are created the first time they're needed, so importing the handler
+# doesn't pay for importing boto3. Tests replace them by patching these.
+# pylint: disable=invalid-name
+_session = None
+s3_client = None
+firehose_client = None
+# pylint: enable=invalid-name
+
+
+def get_session():
+    """Gets the boto3 session every client is created from, importing boto3 the
+    first time so its setup is shared between them.
+
+    Returns:
+        boto3.session.Session: boto3 session
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        _session = boto3.session.Session(region_name=REGION)
+    return _session
+
+
+def get_s3_client():
+    """Gets the S3 client, creating it the first time it's needed.
+
+    Returns:
+        botocore.client.BaseClient: S3 client
+    """
+    global s3_client  # pylint: disable=global-statement
+    if s3_client is None:
+        s3_client = get_session().client("s3")
+    return s3_client
+
+
+def get_firehose_client():
+    """Gets the Firehose client, creating it the first time it's needed.
+
+    Returns:
+        botocore.client.BaseClient: Firehose client
+    """
+    global firehose_client  # pylint: disable=global-statement
+    if firehose_client is None:
+        firehose_client = get_session().client("firehose")
+    return firehose_client
+
+
+class RecordDataTooLargeException(Exception):
+    """Raised when a record's data decompresses to more than MAX_DECOMPRESSED_RECORD_BYTES"""
 
-s3_client = boto3.client("s3", region_name=REGION)
-firehose_client = boto3.client("firehose", region_name=REGION)
 
+GZIP_MAGIC = b"\x1f\x8b"
+# wbits for zlib to expect a gzip or zlib header and trailer
+GZIP_WBITS = 31
+ZLIB_WBITS = 15
 
-def get_records_from_s3(bucket: str, key: str, version_id: str) -> list[str]:
+
+def get_compression_wbits(data: bytes) -> int | None:
+    """Works out from its first bytes whether data is gzip or zlib compressed.
+
+    Args:
+        data (bytes): Data that may be compressed
+
+    Returns:
+        int | None: wbits to decompress it with, or None if it isn't compressed
+    """
+    if data[:2] == GZIP_MAGIC:
+        return GZIP_WBITS
+    # A zlib header has the deflate method, a window of at most 32KiB and a check
+    # making the first two bytes a multiple of 31. JSON can't start like this.
+    if len(data) >= 2 and data[0] & 0x0F == 8 and data[0] >> 4 <= 7:
+        if (data[0] << 8 | data[1]) % 31 == 0:
+            return ZLIB_WBITS
+    return None
+
+
+def decompress_record_data(
+    data: bytes, max_size: int = MAX_DECOMPRESSED_RECORD_BYTES
+) -> bytes:
+    """Decompresses gzip or zlib compressed data, a chunk at a time, stopping if it
+    gets bigger than max_size. Uncompressed data is returned as it is.
+
+    Args:
+        data (bytes): Data that may be compressed
+        max_size (int, optional): Most bytes it can decompress to. Defaults to
+            MAX_DECOMPRESSED_RECORD_BYTES.
+
+    Raises:
+        RecordDataTooLargeException: If it decompresses to more than max_size
+        EOFError: If the compressed data is truncated
+
+    Returns:
+        bytes: Decompressed data
+    """
+    if (wbits := get_compression_wbits(data)) is None:
+        return data
+
+    chunks = []
+    size = 0
+    while data:
+        decompressor = zlib.decompressobj(wbits)
+        # Never decompresses more than one byte past the limit
+        chunk = decompressor.decompress(data, max_size - size + 1)
+        size += len(chunk)
+        if size > max_size:
+            raise RecordDataTooLargeException(
+                f"Decompresses to more than {max_size} bytes"
+            )
+        if not decompressor.eof:
+            raise EOFError("Compressed data ended before the end-of-stream marker")
+        chunks.append(chunk)
+        # Gzip data can have several members one after another
+        data = decompressor.unused_data if wbits == GZIP_WBITS else b""
+    return b"".join(chunks)
+
+
+def get_records_from_s3(
+    bucket: str, key: str, version_id: str, unreadable_lines: list[str] | None = None
+) -> list[str]:
     """Gets a file from S3 and extracts all the firehose records within it.
 
     Args:
         bucket (str): S3 Bucket to download from.
         key (str): Key within the bucket to download.
         version_id (str): Version ID to download.
+        unreadable_lines (list[str] | None, optional): If given, the lines of records
+            that decompress to more than MAX_DECOMPRESSED_RECORD_BYTES, or that are
+            truncated or corrupt, are appended to it as they are. Defaults to None.
 
     Returns:
         list[str]: A list of the records/lines from the S3 file.
                     The contents of the rawData key has been extracted and base64 decoded.
     """
     # Grab the file from S3 and loop through the lines in it
-    s3_file = s3_client.get_object(Bucket=bucket, Key=key, VersionId=version_id)
+    s3_file = get_s3_client().get_object(Bucket=bucket, Key=key, VersionId=version_id)
     records = []
     s3_file_data = s3_file["Body"].read().decode()
     logger.debug("S3 file data", extra={"data": s3_file_data})
@@ -62,9 +185,14 @@ def get_records_from_s3(bucket: str, key: str, version_id: str) -> list[str]:
             # Parse the line as JSON, extract the rawData and b64 decode it
             batch = json.loads(line)
             try:
-                record = gzip.decompress(base64.b64decode(batch["rawData"])).decode()
-            except gzip.BadGzipFile:
-                record = base64.b64decode(batch["rawData"]).decode()
+                record = decompress_record_data(
+                    base64.b64decode(batch["rawData"]), MAX_DECOMPRESSED_RECORD_BYTES
+                ).decode()
+            except (RecordDataTooLargeException, EOFError, zlib.error, ValueError) as e:
+                logger.error(f"Not reingesting a record from {key}: {e}")
+                if unreadable_lines is not None:
+                    unreadable_lines.append(line)
+                continue
 
             records.append(record)
     logger.debug(f"Downloaded {key} and extracted {records}")
@@ -133,22 +261,210 @@ def get_s3_lines(data_to_s3: list[dict]) -> list:
     return s3_lines
 
 
-def send_to_s3(data_to_s3: list[dict], bucket: str, key: str):
+def send_to_s3(
+    data_to_s3: list[dict], bucket: str, key: str, raw_lines: list[str] | None = None
+):
     """Takes a list of log messages and puts them in S3
 
     Args:
         data_to_s3 (list[dict]): List of the json logs to put in S3
         bucket (str): S3 bucket to put them in
         key (str): Key to save them to.
+        raw_lines (list[str] | None, optional): Lines to put in S3 as they are,
+            after the logs. Defaults to None.
     """
-    if data_to_s3:
+    if data_to_s3 or raw_lines:
         logger.debug(f"Sending data to S3", extra={"data": data_to_s3})
-        s3_lines = "\n".join(get_s3_lines(data_to_s3))
+        s3_lines = "\n".join(get_s3_lines(data_to_s3) + (raw_lines or []))
         logger.debug(f"Sending lines to S3", extra={"data": s3_lines})
-        s3_client.put_object(Bucket=bucket, Key=key, Body=s3_lines.encode())
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=s3_lines.encode())
         logger.debug(f"Written file to {bucket}/{key}")
 
 
+# Base delay, in seconds, before retrying records Firehose failed to put
+RETRY_BASE_DELAY = 0.1
+# Base delay, in seconds, before retrying records Firehose throttled
+THROTTLED_RETRY_BASE_DELAY = 1.0
+# Longest delay, in seconds, between attempts to put records
+RETRY_MAX_DELAY = 5.0
+# Error codes that retrying won't fix
+NON_RETRYABLE_ERROR_CODES = frozenset(
+    [
+        "AccessDeniedException",
+        "InvalidArgumentException",
+        "InvalidKMSResourceException",
+        "ResourceNotFoundException",
+    ]
+)
+
+
+class RetrySettings(NamedTuple):
+    """How many attempts FirehoseRetrier makes and how it backs off between them"""
+
+    max_attempts: int = 20
+    base_delay: float = RETRY_BASE_DELAY
+    throttled_base_delay: float = THROTTLED_RETRY_BASE_DELAY
+    max_delay: float = RETRY_MAX_DELAY
+
+
+class FirehoseRetrier:
+    """Puts records into a Firehose stream, retrying any that fail.
+
+    Attempts are made in a loop, backing off exponentially (with full jitter)
+    between them. Throttling, i.e. ServiceUnavailableException for either the
+    whole call or individual records, backs off from a longer base delay than
+    other failures. Errors retrying can't fix aren't retried, and no retry is
+    made that would start after the deadline.
+    """
+
+    def __init__(
+        self,
+        client,
+        deadline: float | None = None,
+        settings: RetrySettings = RetrySettings(),
+        sleep=None,
+        clock=None,
+    ):
+        """
+        Args:
+            client (botocore.client.BaseClient): Firehose client
+            deadline (float | None, optional): time.monotonic() value to stop
+                retrying by. Defaults to None.
+            settings (RetrySettings, optional): Attempts and delays. Defaults to
+                RetrySettings().
+            sleep (Callable[[float], None] | None, optional): Used to wait between
+                attempts. Defaults to time.sleep.
+            clock (Callable[[], float] | None, optional): Used to check the
+                deadline. Defaults to time.monotonic.
+        """
+        self.client = client
+        self.deadline = deadline
+        self.settings = settings
+        self.sleep = sleep or time.sleep
+        self.clock = clock or time.monotonic
+
+    def get_delay(self, attempt: int, throttled: bool) -> float:
+        """Works out how long to wait before the next attempt
+
+        Args:
+            attempt (int): Number of attempts made so far
+            throttled (bool): Whether the last attempt was throttled
+
+        Returns:
+            float: Seconds to wait
+        """
+        settings = self.settings
+        base_delay = settings.throttled_base_delay if throttled else settings.base_delay
+        return random.uniform(
+            0, min(settings.max_delay, base_delay * 2 ** (attempt - 1))
+        )
+
+    def attempt(
+        self, stream_name: str, records: list[dict]
+    ) -> tuple[list[dict], str, bool, bool]:
+        """Makes a single attempt to put records into the stream.
+
+        Args:
+            stream_name (str): Stream to send the records to.
+            records (list[dict]): Records to send.
+
+        Returns:
+            tuple[list[dict], str, bool, bool]: Records that failed, why, whether
+                they were throttled and whether retrying them could help.
+        """
+        try:
+            response = self.client.put_record_batch(
+                DeliveryStreamName=stream_name, Records=records
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # botocore is always imported by the time a client raises
+            from botocore.exceptions import (  # pylint: disable=import-outside-toplevel
+                ClientError,
+            )
+
+            code = None
+            if isinstance(e, ClientError):
+                code = e.response.get("Error", {}).get("Code")
+            return (
+                records,
+                str(e),
+                code == "ServiceUnavailableException",
+                code not in NON_RETRYABLE_ERROR_CODES,
+            )
+
+        if response["FailedPutCount"] == 0:
+            return [], "", False, True
+        failed_records = []
+        codes = []
+        for idx, res in enumerate(response["RequestResponses"]):
+            if res.get("ErrorCode"):
+                codes.append(res["ErrorCode"])
+                failed_records.append(records[idx])
+        return (
+            failed_records,
+            "Individual error codes: " + ",".join(codes),
+            "ServiceUnavailableException" in codes,
+            True,
+        )
+
+    def put_record_batch(
+        self, stream_name: str, records: list[dict]
+    ) -> tuple[list[dict], str]:
+        """Puts records into the stream, retrying any that fail.
+
+        Args:
+            stream_name (str): Stream to send the records to.
+            records (list[dict]): Records to send.
+
+        Returns:
+            tuple[list[dict], str]: Records that still couldn't be put, and why.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            records, err_msg, throttled, retryable = self.attempt(stream_name, records)
+            if not records:
+                return [], ""
+            if not retryable:
+                return records, f"Not retrying after attempt {attempt}. {err_msg}"
+            if attempt >= self.settings.max_attempts:
+                return records, f"Gave up after {attempt} attempts. {err_msg}"
+            delay = self.get_delay(attempt, throttled)
+            if self.deadline is not None and self.clock() + delay > self.deadline:
+                return (
+                    records,
+                    f"Out of time to retry after {attempt} attempts. {err_msg}",
+                )
+
+            logger.info(
+                f"{len(records)} records failed while calling PutRecordBatch "
+                f"to Firehose stream, retrying in {delay:.2f}s. {err_msg}"
+            )
+            self.sleep(delay)
+
+
+# Seconds to leave spare before the lambda times out
+DEADLINE_MARGIN = 2.0
+
+
+def get_deadline(context) -> float | None:
+    """Works out the time.monotonic() value the invocation should finish by.
+
+    Args:
+        context (LambdaContext): Lambda context
+
+    Returns:
+        float | None: Deadline, or None if the context doesn't say
+    """
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return (
+        time.monotonic()
+        + context.get_remaining_time_in_millis() / 1000
+        - DEADLINE_MARGIN
+    )
+
+
 # https://docs.aws.amazon.com/firehose/latest/APIReference/API_PutRecordBatch.html
 def send_to_firehose(
     data_to_firehose: list[dict],
@@ -156,6 +472,7 @@ def send_to_firehose(
     max_records: int = 500,
     max_record_size: int = 1_000_000,
     max_request_size: int = 4_000_000,
+    deadline: float | None = None,
 ):
     """Sends logs back into firehose for reingestion
 
@@ -169,6 +486,8 @@ def send_to_firehose(
             Defaults to 1_000_000.
         max_request_size (int, optional): Maximum size per request to Firehose.
             Defaults to 4_000_000.
+        deadline (float | None, optional): time.monotonic() value to stop retrying by.
+            Defaults to None.
     """
     if data_to_firehose:
         records = []
@@ -194,7 +513,7 @@ def send_to_firehose(
                     or predicted_size + record_size >= max_request_size
                 ):
                     # If it is, flush the current list to Firehose
-                    push_to_firehose(data_to_s3, records)
+                    push_to_firehose(data_to_s3, records, deadline=deadline)
                     records = []
                     predicted_size = 0
                 predicted_size += record_size
@@ -204,76 +523,37 @@ def send_to_firehose(
                 data_to_s3.append(log)
         if records:
             # Catch any leftover records at the end
-            push_to_firehose(data_to_s3, records)
+            push_to_firehose(data_to_s3, records, deadline=deadline)
 
 
 def push_to_firehose(
     data_to_s3: list[dict],
     records: list[dict],
-    attempts_made: int = 0,
     max_attempts: int = 20,
+    deadline: float | None = None,
 ):
-    """Calls the Firehose put_record_batch API and checks for errors.
+    """Calls the Firehose put_record_batch API, retrying any records that fail.
 
     Args:
         data_to_s3 (list[dict]): Data to send to S3
             (in case we can't send to firehose, we add them to this as a fallback)
         records (list[dict]): Records to send to Firehose.
-        attempts_made (int, optional): Number of attempts we've made sending already.
-            Defaults to 0.
         max_attempts (int, optional): Maximum number of attempts before we give up and put it in S3.
             Defaults to 20.
+        deadline (float | None, optional): time.monotonic() value to stop retrying by.
+            Defaults to None.
     """
     logger.debug(f"Sending {len(records)} to Firehose")
 
-    failed_records = []
-    codes = []
-    err_msg = ""
-    response = None
-
-    # Try to send the logs to firehose, catch any errors doing it.
-    try:
-        response = firehose_client.put_record_batch(
-            DeliveryStreamName=STREAM_NAME, Records=records
-        )
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        failed_records = records
-        err_msg = str(e)
-        logger.warning(
-            (
-                "Some records failed while calling ",
-                f"PutRecordBatch to Firehose stream, retrying. {err_msg}",
-            )
-        )
+    failed_records, err_msg = FirehoseRetrier(
+        get_firehose_client(), deadline, RetrySettings(max_attempts)
+    ).put_record_batch(STREAM_NAME, records)
 
-    # If it was accepted by firehose, check if any of the logs failed to process
-    if not failed_records and response and response["FailedPutCount"] > 0:
-        for idx, res in enumerate(response["RequestResponses"]):
-            if not res.get("ErrorCode"):
-                continue
-
-            codes.append(res["ErrorCode"])
-            failed_records.append(records[idx])
-
-        err_msg = "Individual error codes: " + ",".join(codes)
-
-    # If any logs failed to process, increase the counter and try sending them again
+    # If we failed to send them to firehose, fallback to the S3 bucket for a manual fix
     if failed_records:
-        if attempts_made + 1 < max_attempts:
-            logger.warning(
-                (
-                    "Some records failed while calling ",
-                    f"PutRecordBatch to Firehose stream, retrying. {err_msg}",
-                )
-            )
-            push_to_firehose(
-                data_to_s3, failed_records, attempts_made + 1, max_attempts
-            )
-        else:
-            # If we failed to send them to firehose after max_attempts,
-            # fallback to the S3 bucket for a manual fix
-            for failed_record in failed_records:
-                data_to_s3.append(json.loads(gzip.decompress(failed_record["Data"])))
+        logger.warning(f"Sending {len(failed_records)} records to S3. {err_msg}")
+        for failed_record in failed_records:
+            data_to_s3.append(json.loads(gzip.decompress(failed_record["Data"])))
 
 
 def does_file_exist(bucket: str, key: str, version_id: str) -> bool:
@@ -287,24 +567,29 @@ def does_file_exist(bucket: str, key: str, version_id: str) -> bool:
     Returns:
         bool: True if exists
     """
+    from botocore.exceptions import (  # pylint: disable=import-outside-toplevel
+        ClientError,
+    )
+
     try:
-        s3_client.head_object(Bucket=bucket, Key=key, VersionId=version_id)
+        get_s3_client().head_object(Bucket=bucket, Key=key, VersionId=version_id)
         return True
-    except botocore.exceptions.ClientError as e:
+    except ClientError as e:
         if str(e.response["Error"]["Code"]) in ["403", "404"]:
             return False
         else:
             raise
 
 
-def lambda_handler(event: dict, _context: dict):
+def lambda_handler(event: dict, context: dict):
     """Lambda Handler to download logs from S3 and retry sending them to Firehose.
 
     Args:
         event (dict): SQS Event from AWS
-        _context (dict): Lambda execution context - not used.
+        context (dict): Lambda execution context, used to stop retrying before timing out.
     """
     logger.debug("Incoming event", extra={"data": event})
+    deadline = get_deadline(context)
 
     # https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html#example-standard-queue-message-event
     for sqs_record in event.get("Records", []):
@@ -323,19 +608,23 @@ def lambda_handler(event: dict, _context: dict):
 
             # Get the logs from the file and assign them to firehose or S3
             logger.info(f"Processing {key}")
-            records = get_records_from_s3(bucket, key, version_id)
+            unreadable_lines: list[str] = []
+            records = get_records_from_s3(bucket, key, version_id, unreadable_lines)
             for record in records:
                 for log in get_logs_from_record(record):
                     add_log_to_output_list(log, data_to_firehose, data_to_s3)
 
             logger.info(f"Processed {bucket}/{key}")
             logger.info(f"Sending {len(data_to_firehose)} to Firehose")
-            send_to_firehose(data_to_firehose, data_to_s3)
+            send_to_firehose(data_to_firehose, data_to_s3, deadline=deadline)
 
-            logger.info(f"Sending {len(data_to_s3)} to S3")
+            logger.info(f"Sending {len(data_to_s3) + len(unreadable_lines)} to S3")
             send_to_s3(
-                data_to_s3, bucket, f"{FAILED_PREFIX}{key.removeprefix(RETRIES_PREFIX)}"
+                data_to_s3,
+                bucket,
+                f"{FAILED_PREFIX}{key.removeprefix(RETRIES_PREFIX)}",
+                unreadable_lines,
             )
 
             logger.info(f"Deleting {bucket}/{key}")
-            s3_client.delete_object(Bucket=bucket, Key=key, VersionId=version_id)
+            get_s3_client().delete_object(Bucket=bucket, Key=key, VersionId=version_id)
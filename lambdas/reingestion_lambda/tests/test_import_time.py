@@ -0,0 +1,31 @@
+"""Tracks what importing the handler costs, as it's paid on every cold start"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+HANDLER = "src.mbtp_splunk_cloudwatch_reingestion.handler"
+# Only imported once they're needed
+LAZY_MODULES = {"boto3", "botocore"}
+
+
+def get_import_times(module: str) -> dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).parent.parent,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, name = line.removeprefix("import time:").split("|")
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_time():
+    times = get_import_times(HANDLER)
+    print(f"Importing {HANDLER} took {times[HANDLER]}us")
+    assert not LAZY_MODULES & {name.split(".")[0] for name in times}
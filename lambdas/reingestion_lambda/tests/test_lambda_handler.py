@@ -4,6 +4,7 @@ import base64
 import gzip
 import io
 import json
+import zlib
 from os import environ
 from unittest import mock
 
@@ -14,6 +15,7 @@ from botocore.response import StreamingBody
 from botocore.stub import Stubber
 from src.mbtp_splunk_cloudwatch_reingestion.handler import (
     add_log_to_output_list,
+    decompress_record_data,
     check_required_env_vars,
     get_logs_from_record,
     get_s3_lines,
@@ -22,6 +24,8 @@ from src.mbtp_splunk_cloudwatch_reingestion.handler import (
     send_to_firehose,
     send_to_s3,
     does_file_exist,
+    get_deadline,
+    push_to_firehose,
 )
 
 REGION = environ["AWS_REGION"]
@@ -97,6 +101,62 @@ def test_get_records_from_s3_processing_failed(mocker):
     assert results == test_json_events
 
 
+def test_get_records_from_s3_unreadable(mocker):
+    lines = [
+        json.dumps({"rawData": base64.b64encode(zlib.compress(x.encode())).decode()})
+        for x in [test_json_events[0], "x" * 1_000, test_json_events[1]]
+    ] + [
+        # Truncated, corrupt and not UTF-8
+        json.dumps({"rawData": base64.b64encode(x).decode()})
+        for x in [
+            gzip.compress(b"foo")[:-10],
+            zlib.compress(b"foo")[:2] + b"garbage",
+            zlib.compress(b"\xff"),
+        ]
+    ]
+    encoded_message = "\n".join(lines).encode()
+
+    mocked_s3_client = boto3.client("s3", region_name=environ["AWS_REGION"])
+    s3_stubber = Stubber(mocked_s3_client)
+    s3_stubber.add_response(
+        "get_object",
+        {"Body": StreamingBody(io.BytesIO(encoded_message), len(encoded_message))},
+        {
+            "Bucket": "TEST_BUCKET",
+            "Key": "retries/processing-failed/TEST_KEY",
+            "VersionId": "TEST_VERSION_ID",
+        },
+    )
+    s3_stubber.activate()
+
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_reingestion.handler.s3_client",
+        new=mocked_s3_client,
+    )
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_reingestion.handler.MAX_DECOMPRESSED_RECORD_BYTES",
+        new=999,
+    )
+    unreadable_lines = []
+    results = get_records_from_s3(
+        "TEST_BUCKET",
+        "retries/processing-failed/TEST_KEY",
+        "TEST_VERSION_ID",
+        unreadable_lines,
+    )
+
+    assert results == test_json_events[:2]
+    assert unreadable_lines == lines[1:2] + lines[3:]
+
+
+def test_decompress_record_data():
+    assert decompress_record_data(gzip.compress(b"foo")) == b"foo"
+    assert decompress_record_data(zlib.compress(b"foo")) == b"foo"
+    assert decompress_record_data(b'{"foo": "bar"}') == b'{"foo": "bar"}'
+    with pytest.raises(EOFError):
+        decompress_record_data(gzip.compress(b"foo")[:-10])
+
+
 def test_get_logs_from_record():
     assert get_logs_from_record(test_json_events[0]) == [
         {"foo1": "bar1"},
@@ -243,10 +303,13 @@ def test_send_to_firehose_split_max_request_size(mocker):
 
     data_to_firehose = [{"foo": "bar"}, {"foo2": "bar2"}, {"foo3": "bar3"}]
     data_to_s3 = []
-    send_to_firehose(data_to_firehose, data_to_s3, max_request_size=185 * 2)
+    # Each record comes to 60 bytes
+    send_to_firehose(data_to_firehose, data_to_s3, max_request_size=60 * 3)
+    firehose_stubber.assert_no_pending_responses()
 
 
 def test_push_to_firehose_failures(mocker):
+    mocker.patch("src.mbtp_splunk_cloudwatch_reingestion.handler.time.sleep")
     mocked_firehose_client = boto3.client("firehose", region_name=environ["AWS_REGION"])
     firehose_stubber = Stubber(mocked_firehose_client)
     firehose_stubber.add_response(
@@ -285,6 +348,7 @@ def test_push_to_firehose_failures(mocker):
 
 
 def test_push_to_firehose_errored(mocker):
+    mocker.patch("src.mbtp_splunk_cloudwatch_reingestion.handler.time.sleep")
     mocked_firehose_client = boto3.client("firehose", region_name=environ["AWS_REGION"])
     firehose_stubber = Stubber(mocked_firehose_client)
     for _ in range(0, 20):
@@ -302,6 +366,46 @@ def test_push_to_firehose_errored(mocker):
     assert data_to_s3 == data_to_firehose
 
 
+def test_push_to_firehose_throttled(mocker):
+    mocked_firehose_client = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_reingestion.handler.firehose_client"
+    )
+    mocked_firehose_client.put_record_batch.side_effect = [
+        botocore.exceptions.ClientError(
+            {"Error": {"Code": "ServiceUnavailableException"}}, "PutRecordBatch"
+        ),
+        {"FailedPutCount": 0, "RequestResponses": [{}]},
+    ]
+    sleep = mocker.patch("src.mbtp_splunk_cloudwatch_reingestion.handler.time.sleep")
+    data_to_s3 = []
+    push_to_firehose(data_to_s3, [{"Data": gzip.compress(b'{"foo": "bar"}')}])
+    assert data_to_s3 == []
+    assert mocked_firehose_client.put_record_batch.call_count == 2
+    sleep.assert_called_once()
+
+
+def test_push_to_firehose_out_of_time(mocker):
+    mocked_firehose_client = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_reingestion.handler.firehose_client"
+    )
+    mocked_firehose_client.put_record_batch.return_value = {
+        "FailedPutCount": 1,
+        "RequestResponses": [{"ErrorCode": "InternalFailure"}],
+    }
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.return_value = 1_000
+    data_to_s3 = []
+    # The deadline leaves a margin before the lambda times out, so it's already passed
+    push_to_firehose(
+        data_to_s3,
+        [{"Data": gzip.compress(b'{"foo": "bar"}')}],
+        deadline=get_deadline(context),
+    )
+    assert data_to_s3 == [{"foo": "bar"}]
+    assert mocked_firehose_client.put_record_batch.call_count == 1
+    assert get_deadline({}) is None
+
+
 def test_does_file_exist_exists(mocker):
     mocked_s3_client = boto3.client("s3", region_name=environ["AWS_REGION"])
     s3_stubber = Stubber(mocked_s3_client)
@@ -0,0 +1,90 @@
+"""
+Compares how long the transformation lambda takes to load its config on a cold
+start from YAML and from the output of compile_config.
+
+Run from the lambda's directory:
+
+    pdm run python -m benchmarks.config_load --log-groups 1000
+"""
+
+import argparse
+import time
+from os import environ
+
+environ.setdefault("AWS_REGION", "eu-west-1")
+environ.setdefault("CONFIG_S3_BUCKET", "CONFIG_S3_BUCKET")
+environ.setdefault("CONFIG_S3_KEY", "CONFIG_S3_KEY")
+# Stops the handler loading its config from S3 on import
+environ.setdefault("SKIP_CONFIG_LOAD", "true")
+
+# pylint: disable=wrong-import-position
+import yaml
+from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    CompiledConfig,
+    compile_config,
+    parse_config,
+)
+
+
+def make_config(log_groups: int) -> str:
+    """Builds a YAML config.
+
+    Args:
+        log_groups (int): Number of log groups (and sourcetypes) in it
+
+    Returns:
+        str: YAML config
+    """
+    return yaml.safe_dump(
+        {
+            "log_groups": {
+                f"group_{i}": {
+                    "log_group": f"/aws/lambda/group-{i}",
+                    "accounts": ["123456789012", "210987654321"],
+                    "index": f"index_{i % 10}",
+                    "log_streams": [
+                        {"regex": r"^\d{4}/\d{2}/\d{2}/.*", "sourcetype": f"st_{i}"},
+                        {"regex": ".*", "sourcetype": "default"},
+                    ],
+                }
+                for i in range(log_groups)
+            },
+            "sourcetypes": {
+                f"st_{i}": {
+                    "denylist_regexes": [r"healthcheck", r"^DEBUG"],
+                    "redact_regexes": [r"password=(\S+)"],
+                }
+                for i in range(log_groups)
+            },
+        }
+    )
+
+
+def main():
+    """Times loading the same config from each format"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--log-groups", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    config_yaml = make_config(args.log_groups)
+    formats = {"yaml": config_yaml, "compiled": compile_config(config_yaml)}
+    print(f"{args.log_groups} log groups")
+    for name, config_text in formats.items():
+        parse_timings = []
+        compile_timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            config = parse_config(config_text)
+            parse_timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            CompiledConfig(config)
+            compile_timings.append(time.perf_counter() - start)
+        print(
+            f"{name:>9}: {len(config_text):>9} bytes, parse {min(parse_timings):.3f}s, "
+            f"build routes and regexes {min(compile_timings):.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Compares the peak memory allocated while the transformation lambda assembles
+the data of a large transformed Cloudwatch record, joining a list of the
+transformed events as it used to and building it up as the events are
+transformed as it does now.
+
+Run from the lambda's directory:
+
+    pdm run python -m benchmarks.output_memory --events 20000 --message-size 250
+"""
+
+import argparse
+import base64
+import tracemalloc
+from os import environ
+
+environ.setdefault("AWS_REGION", "eu-west-1")
+environ.setdefault("CONFIG_S3_BUCKET", "CONFIG_S3_BUCKET")
+environ.setdefault("CONFIG_S3_KEY", "CONFIG_S3_KEY")
+# Stops the handler loading its config from S3 on import
+environ.setdefault("SKIP_CONFIG_LOAD", "true")
+environ.setdefault("STAGE_METRICS", "false")
+
+# pylint: disable=wrong-import-position
+from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    get_compiled_config,
+    get_envelope_template,
+    process_cloudwatch_log_record,
+    transform_event,
+)
+
+CONFIG = {
+    "log_groups": {
+        "benchmark": {
+            "log_group": "BENCHMARK_LOG_GROUP",
+            "accounts": ["123456789012"],
+            "index": "BENCHMARK_INDEX",
+            "log_streams": [{"regex": ".*", "sourcetype": "BENCHMARK_SOURCETYPE"}],
+        }
+    },
+    "sourcetypes": {"BENCHMARK_SOURCETYPE": {}},
+}
+
+
+def make_data(events: int, message_size: int) -> dict:
+    """Builds the data of a Cloudwatch record.
+
+    Args:
+        events (int): Number of log events
+        message_size (int): Length of each message
+
+    Returns:
+        dict: Cloudwatch record data
+    """
+    return {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "BENCHMARK_LOG_GROUP",
+        "logStream": "BENCHMARK_LOG_STREAM",
+        "subscriptionFilters": [],
+        "logEvents": [
+            {
+                "id": str(i),
+                "timestamp": 1510109208016 + i,
+                "message": f"{i} ".ljust(message_size, "x"),
+            }
+            for i in range(events)
+        ],
+    }
+
+
+def join_transformed_events(data: dict) -> dict:
+    """Assembles a record's data the way process_cloudwatch_log_record used to.
+
+    Args:
+        data (dict): Cloudwatch record data
+
+    Returns:
+        dict: Processed record
+    """
+    sourcetype = get_compiled_config(CONFIG).get_sourcetype("BENCHMARK_SOURCETYPE")
+    envelope = get_envelope_template(
+        "BENCHMARK_INDEX",
+        "BENCHMARK_SOURCETYPE",
+        data["logGroup"],
+        data["owner"],
+        data["logStream"],
+        "ARN",
+    )
+    transformed = [
+        transform_event(
+            str(log_event["timestamp"]),
+            log_event["message"],
+            sourcetype,
+            "BENCHMARK_SOURCETYPE",
+            envelope,
+        )
+        for log_event in data["logEvents"]
+    ]
+    log_events = [event for event in transformed if event]
+    return {
+        "data": base64.b64encode(b"\n".join(log_events)).decode(),
+        "result": "Ok",
+        "recordId": "1",
+    }
+
+
+def main():
+    """Measures the peak memory allocated by each way of assembling the record"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--message-size", type=int, default=250)
+    args = parser.parse_args()
+
+    data = make_data(args.events, args.message_size)
+    assemblers = {
+        "join": join_transformed_events,
+        "incremental": lambda data: process_cloudwatch_log_record(
+            data, "1", "ARN", CONFIG
+        ),
+    }
+    # Warm up the compiled config and envelope caches
+    for assemble in assemblers.values():
+        assemble(data)
+
+    for name, assemble in assemblers.items():
+        tracemalloc.start()
+        record = assemble(data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{name:>11}: {len(record['data']):>10} bytes returned, "
+            f"peak allocated {peak / 1024 / 1024:.1f}MiB "
+            f"({peak / len(record['data']):.2f}x the returned data)"
+        )
+        del record
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Compares transforming a Firehose buffer serially against the thread and process
+worker pools used by process_records_parallel.
+
+Run from the lambda's directory, on a machine (or Lambda size) with the number
+of vCPUs being considered:
+
+    pdm run python -m benchmarks.parallel_transform --records 500 --events 100
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import time
+from os import environ
+
+environ.setdefault("AWS_REGION", "eu-west-1")
+environ.setdefault("CONFIG_S3_BUCKET", "CONFIG_S3_BUCKET")
+environ.setdefault("CONFIG_S3_KEY", "CONFIG_S3_KEY")
+# Stops the handler loading its config from S3 on import
+environ.setdefault("SKIP_CONFIG_LOAD", "true")
+
+# pylint: disable=wrong-import-position
+from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    ProcessingOptions,
+    process_records,
+    process_records_parallel,
+)
+
+CONFIG = {
+    "log_groups": {
+        "benchmark": {
+            "log_group": "BENCHMARK_LOG_GROUP",
+            "accounts": ["123456789012"],
+            "index": "BENCHMARK_INDEX",
+            "log_streams": [{"regex": ".*", "sourcetype": "BENCHMARK_SOURCETYPE"}],
+        }
+    },
+    "sourcetypes": {
+        "BENCHMARK_SOURCETYPE": {
+            "denylist_regexes": [r"healthcheck", r"^DEBUG"],
+            "redact_regexes": [r"password=\S+", r"\b\d{16}\b"],
+        }
+    },
+}
+
+
+def make_records(records: int, events: int) -> list[dict]:
+    """Builds Firehose records, each holding one Cloudwatch record.
+
+    Args:
+        records (int): Number of records
+        events (int): Number of log events in each record
+
+    Returns:
+        list[dict]: Firehose records
+    """
+    firehose_records = []
+    for i in range(records):
+        data = {
+            "messageType": "DATA_MESSAGE",
+            "owner": "123456789012",
+            "logGroup": "BENCHMARK_LOG_GROUP",
+            "logStream": f"stream-{i}",
+            "subscriptionFilters": ["benchmark"],
+            "logEvents": [
+                {
+                    "id": f"{i}-{j}",
+                    "timestamp": 1510109208016 + j,
+                    "message": json.dumps(
+                        {
+                            "level": "INFO",
+                            "message": f"request {j} password=hunter{j} served",
+                            "card": "1234567812345678",
+                            "path": "/api/v1/items",
+                            "duration_ms": j % 250,
+                        }
+                    ),
+                }
+                for j in range(events)
+            ],
+        }
+        firehose_records.append(
+            {
+                "recordId": str(i),
+                "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            }
+        )
+    return firehose_records
+
+
+def main():
+    """Times each way of processing the same records"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=500)
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    records = make_records(args.records, args.events)
+    runs = {
+        "serial": lambda: process_records(records, "ARN", CONFIG, []),
+        "thread": lambda: process_records_parallel(
+            records,
+            "ARN",
+            CONFIG,
+            [],
+            options=ProcessingOptions(workers=args.workers, worker_type="thread"),
+        ),
+        "process": lambda: process_records_parallel(
+            records,
+            "ARN",
+            CONFIG,
+            [],
+            options=ProcessingOptions(workers=args.workers, worker_type="process"),
+        ),
+    }
+    print(
+        f"{args.records} records of {args.events} events, {args.workers} workers, "
+        f"{os.cpu_count()} CPUs"
+    )
+    for name, run in runs.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        print(f"{name:>8}: {min(timings):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
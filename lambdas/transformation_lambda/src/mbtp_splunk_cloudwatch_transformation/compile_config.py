@@ -0,0 +1,74 @@
+"""
+MBTP Splunk Cloudwatch Ingestion - Config Compiler
+
+Validates a transformation lambda config file and compiles it into JSON the
+lambda can load without parsing YAML or running the schema validator. Upload the
+output to the config S3 key in place of the YAML file.
+
+    pdm run compile-config config.yaml config.json
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from os import environ
+
+# The handler checks these when it's imported, but they aren't needed offline
+environ.setdefault("AWS_REGION", "eu-west-2")
+environ.setdefault("CONFIG_S3_BUCKET", "")
+environ.setdefault("CONFIG_S3_KEY", "")
+environ["SKIP_CONFIG_LOAD"] = "true"
+
+# pylint: disable=wrong-import-position
+from .handler import (
+    InvalidConfigException,
+    compile_config,
+)
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Compiles a config file.
+
+    Args:
+        argv (list[str] | None, optional): Command line arguments. Defaults to sys.argv.
+
+    Returns:
+        int: Exit code
+    """
+    parser = argparse.ArgumentParser(description="Compile a transformation config")
+    parser.add_argument("config", type=argparse.FileType("r"), help="YAML config")
+    # Only opened once the config has compiled, so an invalid config doesn't
+    # empty an existing output file
+    parser.add_argument("output", help="Compiled config")
+    args = parser.parse_args(argv)
+
+    try:
+        compiled = compile_config(args.config.read())
+    except InvalidConfigException as e:
+        print(e, file=sys.stderr)
+        return 1
+    write_file(args.output, compiled)
+    return 0
+
+
+def write_file(path: str, text: str):
+    """Writes a file via a temporary file alongside it, so it's either replaced
+    completely or left as it was.
+
+    Args:
+        path (str): File to write
+        text (str): Contents to write to it
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -57,14 +57,21 @@ The code below will:
 5) Concatenate the result from (4) together and set the result as the data of the record returned to Firehose. Note that
    this step will not add any delimiters. Delimiters should be appended by the logic within the transform_log_event
    method.
-6) Any individual record exceeding 6,000,000 bytes in size after decompression, processing and base64-encoding is marked
-   as Dropped, and the original record is split into two and re-ingested back into Firehose or Kinesis. The re-ingested
-   records should be about half the size compared to the original, and should fit within the size limit the second time
-   round.
-7) When the total data size (i.e. the sum over multiple records) after decompression, processing and base64-encoding
-   exceeds 6,000,000 bytes, any additional records are re-ingested back into Firehose or Kinesis.
-8) The retry count for intermittent failures during re-ingestion is set 20 attempts. If you wish to retry fewer number
-   of times for intermittent failures you can lower this value.
+6) Any individual record exceeding the 6MB response limit after decompression, processing and
+   base64-encoding is marked as Dropped, and the original record is split up and re-ingested back
+   into Firehose or Kinesis. The log events are grouped, in order, using their transformed sizes so
+   that each re-ingested record should take up no more than half the size limit the second time
+   round, leaving room to return it alongside other records.
+7) When the total response size (i.e. the sum over multiple records) after decompression, processing
+   and base64-encoding exceeds the 6MB response limit, any additional records are re-ingested back
+   into Firehose or Kinesis. With STREAMING_BUDGET enabled, records after the response fills up are
+   re-ingested without being processed at all. Records still to be processed when the lambda is
+   about to time out are re-ingested the same way. With REINGEST_TRANSFORMED enabled, the
+   transformed Splunk events are re-ingested instead of the original records, so they are forwarded
+   on without being processed again.
+8) The retry count for intermittent failures during re-ingestion is set 20 attempts, backing off
+   exponentially (with jitter) between them, and stopping early if the lambda is about to time out.
+   If you wish to retry fewer number of times for intermittent failures you can lower this value.
 
                                               ***IMPORTANT NOTE***
 When using this blueprint, it is highly recommended to change the Amazon Data Firehose Lambda setting for buffer size to
@@ -72,15 +79,24 @@ When using this blueprint, it is highly recommended to change the Amazon Data Fi
 """
 
 import base64
+import binascii
+import codecs
+import functools
 import gzip
 import json
 import logging
+import multiprocessing
+import os
+import random
 import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from datetime import datetime
-import boto3
-import yaml
-from cerberus import Validator
+from typing import NamedTuple
 
 logger = logging.getLogger()
 
@@ -98,15 +114,124 @@ def check_required_env_vars():
 check_required_env_vars()
 
 REGION = environ["AWS_REGION"]
+# Splice JSON messages into the HEC event as they are, rather than re-serialising them
+RAW_JSON_SPLICE = environ.get("RAW_JSON_SPLICE", "false").lower() == "true"
+# Maximum decompressed bytes of oversized records to keep for splitting
+DECODED_RECORD_CACHE_BYTES = int(
+    environ.get("DECODED_RECORD_CACHE_BYTES", 64 * 1024 * 1024)
+)
+STREAMING_BUDGET = environ.get("STREAMING_BUDGET", "false").lower() == "true"
+# Most bytes a record's data is allowed to decompress to
+MAX_DECOMPRESSED_RECORD_BYTES = int(
+    environ.get("MAX_DECOMPRESSED_RECORD_BYTES", 64 * 1024 * 1024)
+)
+# Route Cloudwatch records on their header before decompressing their log events
+STREAMING_PARSE = environ.get("STREAMING_PARSE", "false").lower() == "true"
+REINGEST_TRANSFORMED = environ.get("REINGEST_TRANSFORMED", "false").lower() == "true"
+# How to choose which records to return when they don't all fit in the response
+PACKING_STRATEGY = environ.get("PACKING_STRATEGY", "in_order")
+# Number of workers to transform records with, 0 meaning one per CPU
+TRANSFORM_WORKERS = int(environ.get("TRANSFORM_WORKERS", 1)) or os.cpu_count() or 1
+TRANSFORM_WORKER_TYPE = environ.get("TRANSFORM_WORKER_TYPE", "process")
+# Number of log stream/detail type routing results kept for each config
+ROUTE_CACHE_SIZE = int(environ.get("ROUTE_CACHE_SIZE", 4096))
+# Seconds between checks for changes to the config in S3, 0 to never check
+CONFIG_RELOAD_SECONDS = int(environ.get("CONFIG_RELOAD_SECONDS", 300))
+# Number of dropped events logged in full per sourcetype and regex each invocation
+DROP_LOG_SAMPLES = int(environ.get("DROP_LOG_SAMPLES", 3))
+# Number of put_record_batch calls to make at once when reingesting
+REINGEST_CONCURRENCY = max(1, int(environ.get("REINGEST_CONCURRENCY", 4)))
+# Seconds before the lambda's deadline to stop transforming records, leaving time
+# to reingest the rest
+PROCESSING_DEADLINE_MARGIN = float(environ.get("PROCESSING_DEADLINE_MARGIN", 10))
+# Emit the time spent in each stage as CloudWatch Embedded Metric Format metrics
+STAGE_METRICS = environ.get("STAGE_METRICS", "false").lower() == "true"
+
+# Clients are created the first time they're needed, so importing the handler
+# doesn't pay for importing boto3. Tests replace them by patching these.
+# pylint: disable=invalid-name
+_session = None
+firehose_client = None
+s3_client = None
+# pylint: enable=invalid-name
+
+
+def get_session():
+    """Gets the boto3 session every client is created from, importing boto3 the
+    first time so its setup is shared between them.
 
-firehose_client = boto3.client("firehose", region_name=REGION)
-s3_client = boto3.client("s3", region_name=REGION)
+    Returns:
+        boto3.session.Session: boto3 session
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        import boto3  # pylint: disable=import-outside-toplevel
+
+        _session = boto3.session.Session(region_name=REGION)
+    return _session
+
+
+def get_firehose_client():
+    """Gets the Firehose client, creating it the first time it's needed.
+
+    Returns:
+        botocore.client.BaseClient: Firehose client
+    """
+    global firehose_client  # pylint: disable=global-statement
+    if firehose_client is None:
+        from botocore.config import (  # pylint: disable=import-outside-toplevel
+            Config,
+        )
+
+        # Allow a connection per concurrent put_record_batch call
+        config = Config(max_pool_connections=max(10, REINGEST_CONCURRENCY))
+        firehose_client = get_session().client("firehose", config=config)
+    return firehose_client
+
+
+def get_s3_client():
+    """Gets the S3 client, creating it the first time it's needed.
+
+    Returns:
+        botocore.client.BaseClient: S3 client
+    """
+    global s3_client  # pylint: disable=global-statement
+    if s3_client is None:
+        s3_client = get_session().client("s3")
+    return s3_client
 
 
 class InvalidConfigException(Exception):
     """Invalid Config Exception"""
 
 
+def download_config(etag: str | None = None) -> tuple[str | None, str | None]:
+    """Downloads the configuration file from S3.
+
+    Args:
+        etag (str | None, optional): ETag of the config already loaded, so it's only
+            downloaded if it has changed. Defaults to None.
+
+    Returns:
+        tuple[str | None, str | None]: The config file's contents (None if it hasn't
+            changed) and its ETag.
+    """
+    params = {"Bucket": environ["CONFIG_S3_BUCKET"], "Key": environ["CONFIG_S3_KEY"]}
+    if etag:
+        params["IfNoneMatch"] = etag
+    from botocore.exceptions import (  # pylint: disable=import-outside-toplevel
+        ClientError,
+    )
+
+    try:
+        s3_config_file: dict = get_s3_client().get_object(**params)
+    except ClientError as e:
+        if etag and e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            return None, etag
+        raise
+    return s3_config_file["Body"].read().decode(), s3_config_file.get("ETag")
+
+
 def get_validated_config() -> dict:
     """Downloads a configuration file from S3 and checks it matches the required schema.
 
@@ -116,10 +241,87 @@ def get_validated_config() -> dict:
     Returns:
         dict: Processed configuration.
     """
-    s3_config_file: dict = s3_client.get_object(
-        Bucket=environ["CONFIG_S3_BUCKET"], Key=environ["CONFIG_S3_KEY"]
+    config_text, _ = download_config()
+    return parse_config(config_text)
+
+
+# Key identifying a config compiled by compile_config, and the format version it holds
+COMPILED_CONFIG_KEY = "mbtp_splunk_compiled_config"
+COMPILED_CONFIG_VERSION = 1
+
+
+def load_compiled_config(config_text: str) -> dict | None:
+    """Loads a config compiled by compile_config.
+
+    Args:
+        config_text (str): Contents of the configuration file
+
+    Raises:
+        InvalidConfigException: Raised if it was compiled into an unsupported format.
+
+    Returns:
+        dict | None: Validated configuration, or None if it isn't a compiled config.
+    """
+    if not config_text.lstrip().startswith("{"):
+        return None
+    try:
+        artifact = json.loads(config_text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(artifact, dict) or COMPILED_CONFIG_KEY not in artifact:
+        return None
+    if artifact[COMPILED_CONFIG_KEY] != COMPILED_CONFIG_VERSION:
+        raise InvalidConfigException(
+            f"Compiled config version {artifact[COMPILED_CONFIG_KEY]} isn't supported, recompile it"
+        )
+    return artifact["config"]
+
+
+def compile_config(config_text: str) -> str:
+    """Validates a YAML config, including its regexes, and compiles it into JSON
+    that parse_config can load without parsing YAML or running the validator.
+
+    Args:
+        config_text (str): Contents of the YAML configuration file
+
+    Raises:
+        InvalidConfigException: Raised if the config does not match what's required.
+
+    Returns:
+        str: Compiled config
+    """
+    config = parse_config(config_text)
+    CompiledConfig(config)
+    return json.dumps(
+        {COMPILED_CONFIG_KEY: COMPILED_CONFIG_VERSION, "config": config},
+        separators=(",", ":"),
     )
-    config_yaml: dict = yaml.safe_load(s3_config_file["Body"].read().decode())
+
+
+def parse_config(config_text: str) -> dict:
+    """Parses a configuration file and checks it matches the required schema.
+    Configs compiled by compile_config have already been checked, so are just loaded.
+
+    Args:
+        config_text (str): Contents of the configuration file
+
+    Raises:
+        InvalidConfigException: Raised if the config does not match what's required.
+
+    Returns:
+        dict: Processed configuration.
+    """
+    if (compiled := load_compiled_config(config_text)) is not None:
+        return compiled
+
+    # Only imported when needed, as compiled configs don't use them
+    import yaml  # pylint: disable=import-outside-toplevel
+    from cerberus import Validator  # pylint: disable=import-outside-toplevel
+
+    try:
+        config_yaml: dict = yaml.safe_load(config_text)
+    except yaml.YAMLError as e:
+        raise InvalidConfigException(f"Config failed to parse - {e}") from e
 
     if not config_yaml:
         raise InvalidConfigException("The supplied config file is empty")
@@ -202,434 +404,2285 @@ def get_validated_config() -> dict:
     return v.document
 
 
-CONFIG = {}
-if not environ.get("PYTEST_VERSION"):  # pragma: no cover
-    CONFIG = get_validated_config()
-
-DEFAULT_ALLOW_REGEX = ".*"
+# Patterns using numbered backreferences/conditionals or global inline flags change
+# meaning (or fail to compile) once wrapped in a larger alternation.
+UNCOMBINABLE_REGEX = re.compile(r"\\[1-9]|\(\?\(\d|\(\?[aiLmsux]+\)")
 
 
-def is_json(j: str) -> bool:
-    """Checks if a string is json parsable
+class RegexSet:
+    """A list of regexes combined into a single alternation, so a string only has
+    to be scanned once to find out whether any of them match.
 
-    Args:
-        j (str): JSON to test
+    Each pattern is wrapped in its own group so the pattern that matched can be
+    worked out from the match. Patterns that can't safely be combined are kept
+    separately and checked afterwards.
 
-    Returns:
-        bool: True if string is json parsable
+    A match is attributed to the first pattern in the list that matches, as it
+    would be checking them one at a time, not to the one matching earliest in the
+    string.
     """
-    try:
-        json.loads(j)
-    except ValueError:
-        return False
-    return True
 
+    def __init__(self, patterns: list[str], capturing_only: bool = False):
+        self.patterns = list(patterns)
+        self._combined = None
+        # Maps the group wrapping each combined pattern to its index and group count
+        self._group_to_pattern: dict[int, tuple[int, int]] = {}
+        self._separate: list[tuple[int, re.Pattern]] = []
+        self._combinable: list[tuple[int, re.Pattern]] = []
+
+        combinable = []
+        for pattern_index, pattern in enumerate(self.patterns):
+            compiled = re.compile(pattern)
+            if capturing_only and not compiled.groups:
+                continue
+            if UNCOMBINABLE_REGEX.search(pattern):
+                self._separate.append((pattern_index, compiled))
+            else:
+                combinable.append((pattern_index, compiled))
+
+        if len(combinable) == 1:
+            self._separate = sorted(combinable + self._separate)
+        elif combinable:
+            self._combinable = combinable
+            group_index = 1
+            for pattern_index, compiled in combinable:
+                self._group_to_pattern[group_index] = (pattern_index, compiled.groups)
+                group_index += compiled.groups + 1
+            try:
+                self._combined = re.compile(
+                    "|".join(f"({compiled.pattern})" for _, compiled in combinable)
+                )
+            except re.error:
+                # e.g. the same group name used in two patterns
+                self._group_to_pattern = {}
+                self._combinable = []
+                self._separate = sorted(combinable + self._separate)
+
+    def search(self, string: str) -> int | None:
+        """Checks if any of the regexes match anywhere in a string.
+
+        Args:
+            string (str): String to search
+
+        Returns:
+            int | None: Position in the pattern list of a regex that matched, or None
+        """
+        found = None
+        if self._combined and (match := self._combined.search(string)):
+            found = self._group_to_pattern[match.lastindex][0]
+            # A pattern earlier in the list may still match later in the string
+            for pattern_index, compiled in self._combinable:
+                if pattern_index >= found:
+                    break
+                if compiled.search(string):
+                    found = pattern_index
+                    break
+        for pattern_index, compiled in self._separate:
+            if found is not None and pattern_index > found:
+                break
+            if compiled.search(string):
+                return pattern_index
+        return found
 
-def get_record_type(data: dict) -> str | None:
-    """Takes data from a firehose record and works out what type of event it is
 
-    Args:
-        data (dict): Firehose record data
+class Redactor(RegexSet):
+    """Redacts the capture groups of every match of a list of regexes.
 
-    Returns:
-        str | None: Type of record
+    Strings that none of the regexes match are ruled out in a single scan (apart
+    from any regexes that can't be combined, see RegexSet). Otherwise each regex
+    finds its own matches, as matches of a combined regex can't overlap and one
+    regex's match would hide another's. The redacted string is then built once
+    from the collected spans. Where spans overlap the earliest one wins.
     """
-    keys = data.keys()
-    if set(("messageType", "logGroup", "owner", "logEvents")) <= keys:
-        return "cloudwatch"
-    elif set(("source", "detail-type")) <= keys:
-        return "eventbridge"
-    elif set(("index", "sourcetype", "event")) <= keys:
-        return "splunk"
-    return None
 
+    def __init__(self, patterns: list[str]):
+        # Regexes without a capture group have nothing to redact
+        super().__init__(patterns, capturing_only=True)
+
+    def _find_spans(self, string: str) -> list[tuple[int, int, int]]:
+        """Finds the spans of all the capture groups to redact.
+
+        Args:
+            string (str): String to search
+
+        Returns:
+            list[tuple[int, int, int]]: Start, end and pattern index of each group
+        """
+        spans = []
+        for pattern_index, compiled in self._combinable + self._separate:
+            for match in compiled.finditer(string):
+                for group in range(1, compiled.groups + 1):
+                    start, end = match.span(group)
+                    if start != -1:
+                        spans.append((start, end, pattern_index))
+        return spans
+
+    def redact(self, string: str, sourcetype_name: str) -> str:
+        """Replaces every captured group with a marker saying which regex redacted it.
+
+        Args:
+            string (str): String to redact
+            sourcetype_name (str): Sourcetype name to include in the markers
+
+        Returns:
+            str: Redacted string
+        """
+        if not (self._combined or self._separate):
+            return string
+        if self._combined and not self._separate and not self._combined.search(string):
+            return string
+        spans = self._find_spans(string)
+        if not spans:
+            return string
+
+        spans.sort(key=lambda x: (x[0], x[2]))
+        pieces = []
+        position = 0
+        for start, end, pattern_index in spans:
+            if start < position:
+                continue
+            pieces.append(string[position:start])
+            pieces.append(
+                f"***REDACTED BY {sourcetype_name}.redact_regexes.{pattern_index}***"
+            )
+            position = end
+        pieces.append(string[position:])
+        return "".join(pieces)
 
-def load_firehose_record_data(base64_data: str) -> dict:
-    """Converts a b64, optionally gzip compressed, string into a dictionary
 
-    Args:
-        base64_data (str): Base64 encoded data
+class CompiledSourcetype(NamedTuple):
+    """A sourcetype's regexes, compiled ready for filtering events.
 
-    Returns:
-        dict: Decoded, maybe decompressed, loaded dictionary
+    allowlist is None when no allowlist_regexes are configured, so all events are allowed.
     """
-    data = base64.b64decode(base64_data)
-    try:
-        return json.loads(gzip.decompress(data))
-    except gzip.BadGzipFile:
-        return json.loads(data)
 
+    denylist: RegexSet
+    allowlist: RegexSet | None
+    redactor: Redactor
 
-def transform_event_to_splunk(
-    timestamp: str,
-    event: str | dict,
-    index: str,
-    sourcetype: dict,
-    sourcetype_name: str,
-    firehose_arn: str,
-    account_id: str,
-    source: str,
-    log_stream: str | None = None,
-) -> None | str:
-    """Transforms an event into a Splunk one
+
+def compile_sourcetype(sourcetype: dict) -> CompiledSourcetype:
+    """Compiles the regexes of a sourcetype from the config.
 
     Args:
-        timestamp (str): Event timestamp
-        event (str | dict): Initial event
-        index (str): Splunk Index
         sourcetype (dict): Sourcetype object containing regexes
-        sourcetype_name (str): Splunk Sourcetype name
-        firehose_arn (str): Firehose ARN
-        account_id (str): AWS Account ID of the initial log
-        source (str): Source of the event
-        log_stream (str | None, optional): Log group stream. Defaults to None.
+
+    Raises:
+        InvalidConfigException: Raised if any of the regexes are invalid.
 
     Returns:
-        None | str: The processed message or None if we dropped it
+        CompiledSourcetype: Compiled sourcetype
     """
+    try:
+        allowlist = sourcetype.get("allowlist_regexes")
+        return CompiledSourcetype(
+            RegexSet(sourcetype.get("denylist_regexes", [])),
+            None if allowlist is None else RegexSet(allowlist),
+            Redactor(sourcetype.get("redact_regexes", [])),
+        )
+    except re.error as e:
+        raise InvalidConfigException(f"Invalid sourcetype regex - {e}") from e
 
-    log = json.dumps(event) if isinstance(event, dict) else event
-
-    for deny_regex in sourcetype.get("denylist_regexes", []):
-        if re.search(deny_regex, log):
-            logger.info(f"Dropping log due to matching {deny_regex}. Log = {log}")
-            return None
 
-    allowed = False
-    for allow_regex in sourcetype.get("allowlist_regexes", [DEFAULT_ALLOW_REGEX]):
-        if re.search(allow_regex, log):
-            allowed = True
-            break
-    if not allowed:
-        logger.info(
-            f"Dropping log because it did not match any allowlist regexes. Log = {log}"
-        )
-        return None
+class Route(NamedTuple):
+    """A single log_groups/events config entry, prepared for fast lookups."""
 
-    for regex_index, redact_regex in enumerate(sourcetype.get("redact_regexes", [])):
-        if match := re.search(redact_regex, log):
-            for group_index, _ in enumerate(match.groups()):
-                group_span = match.span(group_index + 1)
-                log = (
-                    log[: group_span[0]]
-                    + f"***REDACTED BY {sourcetype_name}.redact_regexes.{regex_index}***"
-                    + log[group_span[1] :]
-                )
+    accounts: frozenset[str]
+    index: str
+    sourcetypes: tuple[tuple[re.Pattern, str], ...]
 
-    if is_json(log):
-        log = json.loads(log)
-
-    new_log = {
-        "index": index,
-        "sourcetype": sourcetype_name,
-        "time": timestamp,
-        "host": firehose_arn,
-        "source": source,
-        "fields": {
-            "aws_account_id": account_id,
-        },
-        "event": log,
-    }
 
-    if log_stream:
-        new_log["fields"]["cw_log_stream"] = log_stream
+class RouteCacheInfo(NamedTuple):
+    """Hits, misses and size of a RouteCache, as for functools.lru_cache."""
 
-    return json.dumps(new_log)
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
 
 
-def process_eventbridge_event(
-    data: dict, rec_id: str, firehose_arn: str, config: dict
-) -> dict:
-    account_id = str(data["account"])
-    source = data["source"]
-    detail_type = data["detail-type"]
+class RouteCache:
+    """A least recently used cache of routing results, like functools.lru_cache.
 
-    events_filtered = [
-        x for _, x in config.get("events", {}).items() if x["event_source"] == source
-    ]
+    Unlike lru_cache, the results added since they were last taken can be sent
+    back from a worker process and merged into the cache they were forked from,
+    so the cache still warms up when records are routed in worker processes.
+    """
 
-    if not events_filtered:
-        logger.info(
-            f"EVENTBRIDGE: Dropping as we cannot locate an event source ({source}) match for it."
-        )
-        return {"result": "Dropped", "recordId": rec_id}
+    def __init__(self, resolve, maxsize: int = ROUTE_CACHE_SIZE):
+        self._resolve = resolve
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[str, str] | None] = OrderedDict()
+        self._new: dict[tuple, tuple[str, str] | None] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *key) -> tuple[str, str] | None:
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        result = self._resolve(*key)
+        with self._lock:
+            self.misses += 1
+            self._add(key, result)
+            # Bounded too, in case they're never taken, keeping the latest
+            self._new[key] = result
+            if len(self._new) > self.maxsize:
+                del self._new[next(iter(self._new))]
+        return result
+
+    def _add(self, key: tuple, result: tuple[str, str] | None):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def take_new(self) -> dict:
+        """Takes the results added since they were last taken.
+
+        Returns:
+            dict: Results keyed by the arguments they were resolved from
+        """
+        with self._lock:
+            new, self._new = self._new, {}
+        return new
+
+    def merge(self, results: dict):
+        """Adds results taken from another RouteCache, without counting them as
+        hits or misses.
+
+        Args:
+            results (dict): Results keyed by the arguments they were resolved from
+        """
+        with self._lock:
+            for key, result in results.items():
+                self._add(key, result)
+
+    def cache_info(self) -> RouteCacheInfo:
+        """Gets the hits, misses and size of the cache.
+
+        Returns:
+            RouteCacheInfo: Cache statistics
+        """
+        with self._lock:
+            return RouteCacheInfo(
+                self.hits, self.misses, self.maxsize, len(self._entries)
+            )
 
-    account_id_filtered = [x for x in events_filtered if account_id in x["accounts"]]
 
-    if not account_id_filtered:
-        logger.info(
-            f"EVENTBRIDGE: Dropping as we cannot locate an event source ({source}) and account_id ({account_id}) match for it."
-        )
-        return {"result": "Dropped", "recordId": rec_id}
+class CompiledConfig:
+    """Structures derived from the validated config, built once when it loads.
 
-    index = None
-    sourcetype_name = None
-    for log_config in account_id_filtered:
-        for sourcetype in log_config["detail_types"]:
-            if re.match(sourcetype["regex"], detail_type):
-                sourcetype_name = sourcetype["sourcetype"]
-                index = log_config["index"]
-                break
-        if sourcetype_name:
-            break
+    Attributes:
+        log_groups (dict[str, tuple[Route, ...]]): Routes keyed by log group name.
+        events (dict[str, tuple[Route, ...]]): Routes keyed by event source.
+        sourcetypes (dict[str, CompiledSourcetype]): Compiled sourcetypes keyed by name.
+        match_log_stream (RouteCache): Cached match_route for a log group, account
+            and log stream.
+        match_detail_type (RouteCache): Cached match_route for an event source,
+            account and detail type.
+    """
 
-    if not sourcetype_name:
-        logger.info(
-            f"EVENTBRIDGE: Dropping as we cannot locate a sourcetype match for detail_type ({detail_type}) / source ({source})."
+    def __init__(self, config: dict):
+        self.log_groups = self._build_routes(
+            config.get("log_groups", {}), "log_group", "log_streams"
+        )
+        self.events = self._build_routes(
+            config.get("events", {}), "event_source", "detail_types"
+        )
+        self.sourcetypes = {
+            name: compile_sourcetype(sourcetype)
+            for name, sourcetype in config.get("sourcetypes", {}).items()
+        }
+        self._default_sourcetype = compile_sourcetype({})
+        # The caches belong to this compiled config, so a new config starts with
+        # empty ones
+        self.match_log_stream = RouteCache(self._match_log_stream)
+        self.match_detail_type = RouteCache(self._match_detail_type)
+
+    def get_sourcetype(self, name: str) -> CompiledSourcetype:
+        """Gets a compiled sourcetype, defaulting to one with no regexes.
+
+        Args:
+            name (str): Sourcetype name
+
+        Returns:
+            CompiledSourcetype: Compiled sourcetype
+        """
+        return self.sourcetypes.get(name, self._default_sourcetype)
+
+    def _match_log_stream(
+        self, log_group: str, account_id: str, log_stream: str
+    ) -> tuple[str, str] | None:
+        return match_route(self.log_groups.get(log_group, ()), account_id, log_stream)
+
+    def _match_detail_type(
+        self, source: str, account_id: str, detail_type: str
+    ) -> tuple[str, str] | None:
+        return match_route(self.events.get(source, ()), account_id, detail_type)
+
+    def route_cache_info(self) -> tuple[int, int]:
+        """Gets the hits and misses of the routing caches so far.
+
+        Returns:
+            tuple[int, int]: Hits and misses across both caches
+        """
+        log_streams = self.match_log_stream.cache_info()
+        detail_types = self.match_detail_type.cache_info()
+        return (
+            log_streams.hits + detail_types.hits,
+            log_streams.misses + detail_types.misses,
         )
-        return {"result": "Dropped", "recordId": rec_id}
 
-    sourcetype = config.get("sourcetypes", {}).get(sourcetype_name, {})
+    def take_new_routes(self) -> tuple[dict, dict]:
+        """Takes the routing results added to the caches since they were last taken.
+
+        Returns:
+            tuple[dict, dict]: New log stream and detail type results
+        """
+        return self.match_log_stream.take_new(), self.match_detail_type.take_new()
+
+    def merge_routes(self, routes: tuple[dict, dict]):
+        """Adds routing results taken from the caches of a worker process.
+
+        Args:
+            routes (tuple[dict, dict]): Log stream and detail type results
+        """
+        log_streams, detail_types = routes
+        self.match_log_stream.merge(log_streams)
+        self.match_detail_type.merge(detail_types)
+
+    @staticmethod
+    def _build_routes(
+        section: dict, key_field: str, sourcetypes_field: str
+    ) -> dict[str, tuple[Route, ...]]:
+        """Groups config entries by their lookup key, keeping their original order
+        so the first matching entry still wins."""
+        routes: dict[str, list[Route]] = {}
+        for name, details in section.items():
+            try:
+                sourcetypes = tuple(
+                    (re.compile(x["regex"]), x["sourcetype"])
+                    for x in details[sourcetypes_field]
+                )
+            except re.error as e:
+                raise InvalidConfigException(
+                    f"Invalid {sourcetypes_field} regex in {name} - {e}"
+                ) from e
+            routes.setdefault(details[key_field], []).append(
+                Route(
+                    frozenset(str(x) for x in details["accounts"]),
+                    details["index"],
+                    sourcetypes,
+                )
+            )
+        return {k: tuple(v) for k, v in routes.items()}
 
-    record = transform_event_to_splunk(
-        str(datetime.fromisoformat(data["time"]).timestamp()),
-        data,
-        index,
-        sourcetype,
-        sourcetype_name,
-        firehose_arn,
-        account_id,
-        source,
-    )
-    logger.debug("Processed Data", extra={"data": record})
-    if record:
-        return {
-            "data": base64.b64encode(record.encode()).decode(),
-            "result": "Ok",
-            "recordId": rec_id,
-        }
-    return {"result": "Dropped", "recordId": rec_id}
 
+_compiled_config: tuple[dict | None, CompiledConfig | None] = (None, None)
 
-def process_cloudwatch_log_record(
-    data: dict, rec_id: str, firehose_arn: str, config: dict
-) -> dict:
-    """Matches a CW event to a Splunk index and source type
+
+def get_compiled_config(config: dict) -> CompiledConfig:
+    """Returns the compiled form of a config, only rebuilding it when a different
+    config object is passed in.
 
     Args:
-        data (dict): CW Event
-        rec_id (str): Firehose Record ID
-        firehose_arn (str): Firehose ARN
-        config (dict): Configuration to match against
+        config (dict): Validated configuration
 
     Returns:
-        dict: Processed records
+        CompiledConfig: Compiled configuration
     """
-    # CONTROL_MESSAGE are sent by CWL to check if the subscription is reachable.
-    # They do not contain actual data.
-    if data["messageType"] == "CONTROL_MESSAGE":
-        return {"result": "Dropped", "recordId": rec_id}
-    if data["messageType"] == "DATA_MESSAGE":
-        account_id = str(data["owner"])
-        log_group = data["logGroup"]
-        log_stream = data["logStream"]
+    global _compiled_config  # pylint: disable=global-statement
+    cached_config, compiled = _compiled_config
+    if cached_config is not config:
+        compiled = CompiledConfig(config)
+        _compiled_config = (config, compiled)
+    return compiled
 
-        log_group_filtered = [
-            x
-            for _, x in config.get("log_groups", {}).items()
-            if x["log_group"] == log_group
-        ]
 
-        if not log_group_filtered:
-            logger.info(
-                f"CLOUDWATCH: Dropping as we cannot locate a log_group ({log_group}) match for it."
-            )
-            return {"result": "Dropped", "recordId": rec_id}
+def match_route(
+    routes: tuple[Route, ...], account_id: str, name: str
+) -> tuple[str, str] | None:
+    """Finds the index and sourcetype of the first route matching an account and name.
 
-        account_id_filtered = [
-            x for x in log_group_filtered if account_id in x["accounts"]
-        ]
+    Args:
+        routes (tuple[Route, ...]): Routes already filtered by log group/event source
+        account_id (str): AWS Account ID of the record
+        name (str): Log stream or detail type to match the sourcetype regexes against
 
-        if not account_id_filtered:
-            logger.info(
-                f"CLOUDWATCH: Dropping as we cannot locate a log_group ({log_group}) and account_id ({account_id}) match for it."
-            )
-            return {"result": "Dropped", "recordId": rec_id}
+    Returns:
+        tuple[str, str] | None: Index and sourcetype name, or None if nothing matched
+    """
+    for route in routes:
+        if account_id not in route.accounts:
+            continue
+        for regex, sourcetype_name in route.sourcetypes:
+            if regex.match(name):
+                return route.index, sourcetype_name
+    return None
 
-        index = None
-        sourcetype_name = None
-        for log_config in account_id_filtered:
-            for sourcetype in log_config["log_streams"]:
-                if re.match(sourcetype["regex"], log_stream):
-                    sourcetype_name = sourcetype["sourcetype"]
-                    index = log_config["index"]
-                    break
-            if sourcetype_name:
-                break
 
-        if not sourcetype_name:
-            logger.info(
-                f"CLOUDWATCH: Dropping as we cannot locate a sourcetype match for log_stream ({log_stream}) / log_group ({log_group})."
-            )
-            return {"result": "Dropped", "recordId": rec_id}
+CONFIG = {}
+CONFIG_ETAG = None
+# Tools importing the handler (e.g. compile_config) set SKIP_CONFIG_LOAD
+if not (
+    environ.get("PYTEST_VERSION") or environ.get("SKIP_CONFIG_LOAD")
+):  # pragma: no cover
+    _config_text, CONFIG_ETAG = download_config()
+    CONFIG = parse_config(_config_text)
+    get_compiled_config(CONFIG)
+    del _config_text
+_config_checked_at = time.monotonic()
+
+
+def get_config() -> dict:
+    """Returns the current config, checking S3 for a new one once
+    CONFIG_RELOAD_SECONDS have passed since the last check.
+
+    The check is a conditional GET, so the file is only downloaded when its ETag
+    has changed. A new config is parsed, validated and compiled before it
+    replaces the current one, and if any of that fails the current config is
+    kept (and the broken file isn't downloaded again until it changes).
 
-        sourcetype = config.get("sourcetypes", {}).get(sourcetype_name, {})
+    Returns:
+        dict: Validated configuration
+    """
+    global CONFIG, CONFIG_ETAG, _config_checked_at  # pylint: disable=global-statement
+    if (
+        CONFIG_RELOAD_SECONDS <= 0
+        or time.monotonic() - _config_checked_at < CONFIG_RELOAD_SECONDS
+    ):
+        return CONFIG
+    _config_checked_at = time.monotonic()
 
-        log_events = [
-            event
-            for log_event in data["logEvents"]
-            if (
-                event := transform_event_to_splunk(
-                    str(log_event["timestamp"]),
-                    log_event["message"],
-                    index,
-                    sourcetype,
-                    sourcetype_name,
-                    firehose_arn,
-                    account_id,
-                    log_group,
-                    log_stream,
-                )
-            )
-        ]
+    try:
+        config_text, etag = download_config(CONFIG_ETAG)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.warning(
+            f"Couldn't check for config changes, keeping current config. {e}"
+        )
+        return CONFIG
+    if config_text is None:
+        return CONFIG
 
-        logger.debug("Processed Data", extra={"data": log_events})
-        return {
-            "data": base64.b64encode("\n".join(log_events).encode()).decode(),
-            "result": "Ok",
-            "recordId": rec_id,
-        }
-    return {"result": "ProcessingFailed", "recordId": rec_id}
+    try:
+        config = parse_config(config_text)
+        get_compiled_config(config)
+    except InvalidConfigException as e:
+        logger.error(f"New config {etag} is invalid, keeping current config. {e}")
+        CONFIG_ETAG = etag
+        return CONFIG
 
+    logger.info(f"Loaded new config {etag}")
+    CONFIG, CONFIG_ETAG = config, etag
+    return CONFIG
 
-def get_record_size(record: dict) -> int:
-    """Dumps to a dict to a string and calculates the length of it in bytes.
+
+def is_json(j: str) -> bool:
+    """Checks if a string is json parsable
 
     Args:
-        record (dict): Dictionary to get the size of
+        j (str): JSON to test
 
     Returns:
-        int: Size of the dictionary
+        bool: True if string is json parsable
     """
-    return len(json.dumps(record).encode())
+    try:
+        json.loads(j)
+    except ValueError:
+        return False
+    return True
 
 
-def process_records(records: list[dict], firehose_arn: str, config: dict) -> list:
-    """Loops through records, works out their type and processes them accordingly.
+# Characters a JSON document can start with (json.loads also allows leading whitespace)
+JSON_START_CHARS = frozenset('{["-0123456789tfnNI \t\n\r')
+
+
+def serialise_event(log: str, raw_json_splice: bool = False) -> bytes:
+    """Serialises an event for the event field of a HEC event. If the event is JSON,
+    it's included as JSON rather than as a string.
+
+    Strings that can't be JSON are worked out from their first character, so
+    they're never parsed, and everything else is parsed at most once.
 
     Args:
-        records (list[dict]): Records to process
-        firehose_arn (str): Firehose ARN that received them
-        config (dict): Configuration used to process the CW events
+        log (str): Event to serialise
+        raw_json_splice (bool, optional): Use JSON objects/arrays as they are instead
+            of re-serialising them. Defaults to False.
 
     Returns:
-        list: Processed records
+        bytes: JSON serialised event
     """
-    returned_records = []
-    for r in records:
-        data = load_firehose_record_data(r["data"])
-        logger.debug("Record", extra={"data": r})
-        logger.debug("Parsed data", extra={"data": data})
+    if log[:1] in JSON_START_CHARS:
+        try:
+            parsed = json.loads(log)
+        except ValueError:
+            pass
+        else:
+            # Anything spliced in mustn't contain line breaks as events are newline delimited
+            if (
+                raw_json_splice
+                and log[:1] in "{["
+                and "\n" not in log
+                and "\r" not in log
+            ):
+                try:
+                    return log.encode()
+                except UnicodeEncodeError:
+                    pass
+            return json.dumps(parsed).encode()
+    return json.dumps(log).encode()
 
-        rec_id = r["recordId"]
 
-        record_type = get_record_type(data)
-        if record_type == "cloudwatch":
-            # If it's a Cloudwatch log record
-            processed_record = process_cloudwatch_log_record(
-                data, rec_id, firehose_arn, config
-            )
-            logger.debug("Processed record", extra={"data": processed_record})
-            returned_records.append(processed_record)
-        elif record_type == "eventbridge":
-            # If it's an Eventbridge event record
-            processed_record = process_eventbridge_event(
-                data, rec_id, firehose_arn, config
-            )
-            logger.debug("Processed record", extra={"data": processed_record})
-            returned_records.append(processed_record)
-        elif record_type == "splunk":
-            # Else if it's a reingested log which can skip processing
-            logger.info(f"Reingested log detected, forwarding it on. {r}")
-            returned_records.append(
-                {
-                    "data": base64.b64encode(json.dumps(data).encode()).decode(),
-                    "result": "Ok",
-                    "recordId": rec_id,
-                }
-            )
-        else:
-            # Else it's an unknown log, so reject it
-            returned_records.append({"result": "ProcessingFailed", "recordId": rec_id})
+def get_record_type(data: dict) -> str | None:
+    """Takes data from a firehose record and works out what type of event it is
+
+    Args:
+        data (dict): Firehose record data
+
+    Returns:
+        str | None: Type of record
+    """
+    keys = data.keys()
+    if set(("messageType", "logGroup", "owner", "logEvents")) <= keys:
+        return "cloudwatch"
+    elif set(("source", "detail-type")) <= keys:
+        return "eventbridge"
+    elif set(("index", "sourcetype", "event")) <= keys:
+        return "splunk"
+    return None
+
+
+class RecordDataTooLargeException(Exception):
+    """Raised when a record's data decompresses to more than MAX_DECOMPRESSED_RECORD_BYTES"""
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+# wbits for zlib to expect a gzip or zlib header and trailer
+GZIP_WBITS = 31
+ZLIB_WBITS = 15
+
+
+def get_compression_wbits(data: bytes) -> int | None:
+    """Works out from its first bytes whether data is gzip or zlib compressed.
+
+    Args:
+        data (bytes): Data that may be compressed
+
+    Returns:
+        int | None: wbits to decompress it with, or None if it isn't compressed
+    """
+    if data[:2] == GZIP_MAGIC:
+        return GZIP_WBITS
+    # A zlib header has the deflate method, a window of at most 32KiB and a check
+    # making the first two bytes a multiple of 31. Of the bytes JSON can start
+    # with, only "8" has the deflate method and a valid window, as in b"80", so
+    # that's ruled out, along with the 2KiB window it'd mean. zlib defaults to
+    # 32KiB.
+    if len(data) >= 2 and data[0] & 0x0F == 8 and data[0] >> 4 <= 7:
+        if data[:1] != b"8" and (data[0] << 8 | data[1]) % 31 == 0:
+            return ZLIB_WBITS
+    return None
+
+
+def decompress_record_data(
+    data: bytes, max_size: int = MAX_DECOMPRESSED_RECORD_BYTES
+) -> bytes:
+    """Decompresses gzip or zlib compressed data, a chunk at a time, stopping if it
+    gets bigger than max_size. Uncompressed data is returned as it is.
+
+    Args:
+        data (bytes): Data that may be compressed
+        max_size (int, optional): Most bytes it can decompress to. Defaults to
+            MAX_DECOMPRESSED_RECORD_BYTES.
+
+    Raises:
+        RecordDataTooLargeException: If it decompresses to more than max_size
+        EOFError: If the compressed data is truncated
+
+    Returns:
+        bytes: Decompressed data
+    """
+    if (wbits := get_compression_wbits(data)) is None:
+        return data
+
+    chunks = []
+    size = 0
+    while data:
+        decompressor = zlib.decompressobj(wbits)
+        # Never decompresses more than one byte past the limit
+        chunk = decompressor.decompress(data, max_size - size + 1)
+        size += len(chunk)
+        if size > max_size:
+            raise RecordDataTooLargeException(
+                f"Decompresses to more than {max_size} bytes"
+            )
+        if not decompressor.eof:
+            raise EOFError("Compressed data ended before the end-of-stream marker")
+        chunks.append(chunk)
+        # Gzip data can have several members one after another
+        data = decompressor.unused_data if wbits == GZIP_WBITS else b""
+    return b"".join(chunks)
+
+
+def decode_firehose_record_data(base64_data: str) -> bytes:
+    """Converts a b64, optionally gzip or zlib compressed, string into bytes
+
+    Args:
+        base64_data (str): Base64 encoded data
+
+    Raises:
+        RecordDataTooLargeException: If it decompresses to more than
+            MAX_DECOMPRESSED_RECORD_BYTES
+
+    Returns:
+        bytes: Decoded, maybe decompressed, data
+    """
+    return decompress_record_data(
+        base64.b64decode(base64_data), MAX_DECOMPRESSED_RECORD_BYTES
+    )
+
+
+def load_firehose_record_data(base64_data: str) -> dict:
+    """Converts a b64, optionally gzip compressed, string into a dictionary
+
+    Args:
+        base64_data (str): Base64 encoded data
+
+    Returns:
+        dict: Decoded, maybe decompressed, loaded dictionary
+    """
+    return json.loads(decode_firehose_record_data(base64_data))
+
+
+# Base64 of the gzip magic bytes and deflate method, which every gzipped record starts with
+GZIP_BASE64_PREFIX = "H4sI"
+# Decompressed bytes read from a streamed record at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+# Most decompressed bytes to look through for the keys before the log events
+MAX_STREAMED_HEADER_SIZE = 64 * 1024
+# The key holding the log events, which Cloudwatch Logs puts after the other keys
+LOG_EVENTS_KEY = re.compile(r'"logEvents"\s*:\s*\[')
+WHITESPACE_AND_COMMAS = re.compile(r"[\s,]*")
+
+
+class CloudwatchRecordStream:
+    """Decompresses and parses a gzipped Cloudwatch Logs record a chunk at a time.
+
+    The keys before logEvents are parsed first, so the record can be routed (or
+    dropped) before the rest is decompressed. The log events are then parsed one
+    at a time, only keeping the decompressed data that hasn't been parsed yet.
+    """
+
+    def __init__(
+        self,
+        compressed: bytes,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+        max_size: int = MAX_DECOMPRESSED_RECORD_BYTES,
+    ):
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self._size = 0
+        # wbits=31 expects a gzip header and trailer
+        self._decompressor = zlib.decompressobj(wbits=31)
+        self._compressed = compressed
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+
+    def _read(self) -> bool:
+        """Decompresses the next chunk onto the end of the buffer.
+
+        Raises:
+            RecordDataTooLargeException: If more than max_size bytes have been
+                decompressed
+
+        Returns:
+            bool: False if there was nothing left to decompress
+        """
+        if self._decompressor.eof and self._decompressor.unused_data:
+            # Another gzip member follows the last one
+            self._compressed = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(wbits=31)
+        if not self._compressed or self._decompressor.eof:
+            return False
+        chunk = self._decompressor.decompress(self._compressed, self.chunk_size)
+        self._compressed = self._decompressor.unconsumed_tail
+        self._size += len(chunk)
+        if self._size > self.max_size:
+            raise RecordDataTooLargeException(
+                f"Decompresses to more than {self.max_size} bytes"
+            )
+        if self._pos > self.chunk_size:
+            self._buffer = self._buffer[self._pos :]
+            self._pos = 0
+        self._buffer += self._text_decoder.decode(chunk)
+        return True
+
+    def read_header(self) -> dict | None:
+        """Parses the keys before logEvents, leaving the stream at the first log event.
+
+        Returns:
+            dict | None: The keys before logEvents, or None if they weren't found
+                in the first MAX_STREAMED_HEADER_SIZE bytes
+        """
+        while not (match := LOG_EVENTS_KEY.search(self._buffer)):
+            if len(self._buffer) > MAX_STREAMED_HEADER_SIZE or not self._read():
+                return None
+        try:
+            header = json.loads(
+                self._buffer[: match.start()].rstrip().rstrip(",") + "}"
+            )
+        except json.JSONDecodeError:
+            return None
+        self._pos = match.end()
+        return header if isinstance(header, dict) else None
+
+    def events(self):
+        """Parses the log events one at a time.
+
+        Raises:
+            ValueError: If the log events aren't valid UTF-8 encoded JSON
+            zlib.error: If the compressed data is corrupt
+            RecordDataTooLargeException: If more than max_size bytes get decompressed
+
+        Yields:
+            dict: Log event
+        """
+        while True:
+            self._pos = WHITESPACE_AND_COMMAS.match(self._buffer, self._pos).end()
+            if self._pos == len(self._buffer):
+                if not self._read():
+                    raise json.JSONDecodeError(
+                        "Unterminated logEvents", self._buffer, self._pos
+                    )
+                continue
+            if self._buffer[self._pos] == "]":
+                return
+            try:
+                event, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # The event may carry on into the next chunk
+                if not self._read():
+                    raise
+                continue
+            self._pos = end
+            yield event
+
+
+def is_gzip_base64(base64_data: str | bytes) -> bool:
+    """Checks whether base64 encoded data is gzipped, without decoding it
+
+    Args:
+        base64_data (str | bytes): Base64 encoded data
+
+    Returns:
+        bool: Whether it starts with the gzip magic bytes
+    """
+    prefix = base64_data[: len(GZIP_BASE64_PREFIX)]
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode()
+    return prefix == GZIP_BASE64_PREFIX
+
+
+def stream_cloudwatch_record_data(base64_data: str | bytes) -> dict | None:
+    """Starts streaming a gzipped Cloudwatch record, parsing just the keys before
+    its log events.
+
+    Args:
+        base64_data (str | bytes): Base64 encoded data
+
+    Returns:
+        dict | None: The record's data, with a generator of its log events under
+            logEvents, or None if it isn't a gzipped Cloudwatch record (or can't be
+            read as one)
+    """
+    if not is_gzip_base64(base64_data):
+        return None
+    stream = CloudwatchRecordStream(
+        base64.b64decode(base64_data), max_size=MAX_DECOMPRESSED_RECORD_BYTES
+    )
+    try:
+        header = stream.read_header()
+    except (ValueError, zlib.error):
+        # Left to be decoded as usual, which fails it
+        return None
+    if header is None:
+        return None
+    data = {**header, "logEvents": stream.events()}
+    return data if get_record_type(data) == "cloudwatch" else None
+
+
+class EnvelopeTemplate(NamedTuple):
+    """The constant parts of a serialised Splunk HEC event, either side of its
+    time and event values."""
+
+    prefix: bytes
+    middle: bytes
+    suffix: bytes = b"}"
+
+    def render(self, timestamp: str, event_json: bytes) -> bytes:
+        """Fills in the template, matching json.dumps of the whole HEC event.
+
+        Args:
+            timestamp (str): Event timestamp
+            event_json (bytes): JSON serialised event
+
+        Returns:
+            bytes: Serialised HEC event
+        """
+        return b"".join(
+            (
+                self.prefix,
+                json.dumps(timestamp).encode(),
+                self.middle,
+                event_json,
+                self.suffix,
+            )
+        )
+
+
+@functools.lru_cache(maxsize=1024)
+def get_envelope_template(
+    index: str,
+    sourcetype_name: str,
+    source: str,
+    account_id: str,
+    log_stream: str | None,
+    firehose_arn: str,
+) -> EnvelopeTemplate:
+    """Builds (or gets from the cache) the envelope template for a route.
+
+    Args:
+        index (str): Splunk Index
+        sourcetype_name (str): Splunk Sourcetype name
+        source (str): Source of the event
+        account_id (str): AWS Account ID of the initial log
+        log_stream (str | None): Log group stream
+        firehose_arn (str): Firehose ARN
+
+    Returns:
+        EnvelopeTemplate: Envelope template
+    """
+    fields = {"aws_account_id": account_id}
+    if log_stream:
+        fields["cw_log_stream"] = log_stream
+    prefix = (
+        f'{{"index": {json.dumps(index)}, "sourcetype": {json.dumps(sourcetype_name)}'
+        ', "time": '
+    )
+    middle = (
+        f', "host": {json.dumps(firehose_arn)}, "source": {json.dumps(source)}'
+        f', "fields": {json.dumps(fields)}, "event": '
+    )
+    return EnvelopeTemplate(prefix.encode(), middle.encode())
+
+
+class DropLog:
+    """Counts the events dropped by each sourcetype's regexes, so one summary can be
+    logged per invocation instead of a line per event.
+
+    The first few events dropped by each sourcetype and regex are kept as samples
+    to log with the summary. Nothing is formatted until the summary is logged.
+    """
+
+    def __init__(self, max_samples: int = DROP_LOG_SAMPLES):
+        self.max_samples = max_samples
+        # Keyed by sourcetype name and the denylist regex, or None for the allowlist
+        self.counts: dict[tuple[str, str | None], int] = {}
+        self.samples: dict[tuple[str, str | None], list[str]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, sourcetype_name: str, pattern: str | None, log: str):
+        """Records a dropped event.
+
+        Args:
+            sourcetype_name (str): Sourcetype of the event
+            pattern (str | None): Denylist regex it matched, or None if it didn't
+                match the allowlist
+            log (str): The event
+        """
+        key = (sourcetype_name, pattern)
+        with self._lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+            if count < self.max_samples:
+                self.samples.setdefault(key, []).append(log)
+
+    def take(self) -> tuple[dict, dict]:
+        """Takes the counts and samples recorded so far, and starts again.
+
+        Returns:
+            tuple[dict, dict]: Counts and samples
+        """
+        with self._lock:
+            counts, samples = self.counts, self.samples
+            self.counts, self.samples = {}, {}
+        return counts, samples
+
+    def merge(self, counts: dict, samples: dict):
+        """Adds counts and samples taken from another DropLog, e.g. in a worker process.
+
+        Args:
+            counts (dict): Counts to add
+            samples (dict): Samples to add, up to max_samples
+        """
+        with self._lock:
+            for key, count in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + count
+            for key, logs in samples.items():
+                kept = self.samples.setdefault(key, [])
+                kept.extend(logs[: max(self.max_samples - len(kept), 0)])
+
+    def flush(self):
+        """Logs a summary of the events dropped since the last flush, and the samples."""
+        counts, samples = self.take()
+        if not counts or not logger.isEnabledFor(logging.INFO):
+            return
+
+        summary: dict[str, dict[str, int]] = {}
+        for (sourcetype_name, pattern), count in counts.items():
+            reason = "allowlist" if pattern is None else pattern
+            summary.setdefault(sourcetype_name, {})[reason] = count
+        logger.info("drops", extra={"drops": summary})
+
+        for (sourcetype_name, pattern), logs in samples.items():
+            for log in logs:
+                if pattern is None:
+                    logger.info(
+                        "Dropped %s log because it did not match any allowlist regexes. Log = %s",
+                        sourcetype_name,
+                        log,
+                    )
+                else:
+                    logger.info(
+                        "Dropped %s log due to matching %s. Log = %s",
+                        sourcetype_name,
+                        pattern,
+                        log,
+                    )
+
+
+drop_log = DropLog()
+
+# CloudWatch namespace the stage metrics are published under
+METRICS_NAMESPACE = "MBTPSplunkCloudwatchTransformation"
+# Units of the stage metrics that aren't times in seconds
+METRIC_UNITS = {
+    "Events": "Count",
+    "Records": "Count",
+    "RouteCacheHits": "Count",
+    "RouteCacheMisses": "Count",
+}
+
+
+class StageMetrics:
+    """Totals the time spent in each stage of an invocation, overall and per
+    sourcetype, so they can be emitted once per invocation as CloudWatch Embedded
+    Metric Format (EMF) metrics.
+
+    Callers check enabled before taking any timings, so when it's disabled nothing
+    is timed, kept or emitted.
+    """
+
+    def __init__(
+        self, enabled: bool = STAGE_METRICS, namespace: str = METRICS_NAMESPACE
+    ):
+        self.enabled = enabled
+        self.namespace = namespace
+        # Keyed by sourcetype name, or None for stages not specific to one
+        self.values: dict[str | None, dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, sourcetype_name: str | None, values: dict[str, float]):
+        """Adds to the totals.
+
+        Args:
+            sourcetype_name (str | None): Sourcetype the values are for, or None
+            values (dict[str, float]): Seconds spent in each stage, or counts
+        """
+        with self._lock:
+            totals = self.values.setdefault(sourcetype_name, {})
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0) + value
+
+    def take(self) -> dict:
+        """Takes the totals so far, and starts again.
+
+        Returns:
+            dict: Totals keyed by sourcetype name
+        """
+        with self._lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values: dict):
+        """Adds totals taken from another StageMetrics, e.g. in a worker process.
+
+        Args:
+            values (dict): Totals keyed by sourcetype name
+        """
+        for sourcetype_name, totals in values.items():
+            self.add(sourcetype_name, totals)
+
+    def flush(self, stream_name: str):
+        """Prints an EMF document for the totals since the last flush, with one for
+        each sourcetype.
+
+        Args:
+            stream_name (str): Name of the firehose stream, used as a dimension
+        """
+        values = self.take()
+        if not self.enabled or not values:
+            return
+
+        timestamp = int(time.time() * 1000)
+        for sourcetype_name, totals in values.items():
+            document = {"DeliveryStream": stream_name}
+            dimensions = ["DeliveryStream"]
+            if sourcetype_name is not None:
+                document["Sourcetype"] = sourcetype_name
+                dimensions.append("Sourcetype")
+            metrics = []
+            for name, value in totals.items():
+                unit = METRIC_UNITS.get(name)
+                metrics.append({"Name": name, "Unit": unit or "Milliseconds"})
+                document[name] = value if unit else round(value * 1000, 3)
+            document["_aws"] = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [dimensions],
+                        "Metrics": metrics,
+                    }
+                ],
+            }
+            # EMF has to be written straight to stdout, as the JSON log format
+            # would wrap it if it was logged
+            print(json.dumps(document), flush=True)
+
+
+stage_metrics = StageMetrics()
+
+
+def transform_event(
+    timestamp: str,
+    event: str | dict,
+    sourcetype: CompiledSourcetype,
+    sourcetype_name: str,
+    envelope: EnvelopeTemplate,
+    timings: list[float] | None = None,
+) -> None | bytes:
+    """Filters and redacts an event, then serialises it into a Splunk HEC event
+
+    Args:
+        timestamp (str): Event timestamp
+        event (str | dict): Initial event
+        sourcetype (CompiledSourcetype): Compiled sourcetype containing regexes
+        sourcetype_name (str): Splunk Sourcetype name
+        envelope (EnvelopeTemplate): Envelope template of the event's route
+        timings (list[float] | None, optional): If given, the seconds spent
+            filtering, redacting and serialising the event are added to its three
+            items. Defaults to None.
+
+    Returns:
+        None | bytes: The processed message or None if we dropped it
+    """
+    log = json.dumps(event) if isinstance(event, dict) else event
+
+    if timings is None:
+        if not keep_event(log, sourcetype, sourcetype_name):
+            return None
+        log = sourcetype.redactor.redact(log, sourcetype_name)
+        return envelope.render(timestamp, serialise_event(log, RAW_JSON_SPLICE))
+
+    start = time.perf_counter()
+    keep = keep_event(log, sourcetype, sourcetype_name)
+    filtered = time.perf_counter()
+    timings[0] += filtered - start
+    if not keep:
+        return None
+    log = sourcetype.redactor.redact(log, sourcetype_name)
+    redacted = time.perf_counter()
+    timings[1] += redacted - filtered
+    record = envelope.render(timestamp, serialise_event(log, RAW_JSON_SPLICE))
+    timings[2] += time.perf_counter() - redacted
+    return record
+
+
+def keep_event(log: str, sourcetype: CompiledSourcetype, sourcetype_name: str) -> bool:
+    """Checks an event against its sourcetype's denylist and allowlist regexes,
+    recording it in the drop log if it's to be dropped
+
+    Args:
+        log (str): The event
+        sourcetype (CompiledSourcetype): Compiled sourcetype containing regexes
+        sourcetype_name (str): Splunk Sourcetype name
+
+    Returns:
+        bool: Whether to keep the event
+    """
+    if (deny_index := sourcetype.denylist.search(log)) is not None:
+        drop_log.add(sourcetype_name, sourcetype.denylist.patterns[deny_index], log)
+        return False
+
+    if sourcetype.allowlist is not None and sourcetype.allowlist.search(log) is None:
+        drop_log.add(sourcetype_name, None, log)
+        return False
+
+    return True
+
+
+def transform_event_to_splunk(
+    timestamp: str,
+    event: str | dict,
+    index: str,
+    sourcetype: dict | CompiledSourcetype,
+    sourcetype_name: str,
+    firehose_arn: str,
+    account_id: str,
+    source: str,
+    log_stream: str | None = None,
+) -> None | str:
+    """Transforms an event into a Splunk one
+
+    Args:
+        timestamp (str): Event timestamp
+        event (str | dict): Initial event
+        index (str): Splunk Index
+        sourcetype (dict | CompiledSourcetype): Sourcetype object containing regexes
+        sourcetype_name (str): Splunk Sourcetype name
+        firehose_arn (str): Firehose ARN
+        account_id (str): AWS Account ID of the initial log
+        source (str): Source of the event
+        log_stream (str | None, optional): Log group stream. Defaults to None.
+
+    Returns:
+        None | str: The processed message or None if we dropped it
+    """
+
+    if not isinstance(sourcetype, CompiledSourcetype):
+        sourcetype = compile_sourcetype(sourcetype)
+
+    envelope = get_envelope_template(
+        index, sourcetype_name, source, account_id, log_stream, firehose_arn
+    )
+    record = transform_event(timestamp, event, sourcetype, sourcetype_name, envelope)
+    return None if record is None else record.decode()
+
+
+def process_eventbridge_event(
+    data: dict, rec_id: str, firehose_arn: str, config: dict
+) -> dict:
+    start = time.perf_counter() if stage_metrics.enabled else 0.0
+    account_id = str(data["account"])
+    source = data["source"]
+    detail_type = data["detail-type"]
+
+    compiled_config = get_compiled_config(config)
+    match = compiled_config.match_detail_type(source, account_id, detail_type)
+
+    if not match:
+        routes = compiled_config.events.get(source)
+        if not routes:
+            logger.info(
+                f"EVENTBRIDGE: Dropping as we cannot locate an event source ({source}) "
+                "match for it."
+            )
+        elif not any(account_id in x.accounts for x in routes):
+            logger.info(
+                f"EVENTBRIDGE: Dropping as we cannot locate an event source ({source}) "
+                f"and account_id ({account_id}) match for it."
+            )
+        else:
+            logger.info(
+                "EVENTBRIDGE: Dropping as we cannot locate a sourcetype match for "
+                f"detail_type ({detail_type}) / source ({source})."
+            )
+        return {"result": "Dropped", "recordId": rec_id}
+    index, sourcetype_name = match
+
+    sourcetype = compiled_config.get_sourcetype(sourcetype_name)
+
+    envelope = get_envelope_template(
+        index, sourcetype_name, source, account_id, None, firehose_arn
+    )
+    timings = None
+    route_time = 0.0
+    if stage_metrics.enabled:
+        route_time = time.perf_counter() - start
+        timings = [0.0, 0.0, 0.0]
+    record = transform_event(
+        str(datetime.fromisoformat(data["time"]).timestamp()),
+        data,
+        sourcetype,
+        sourcetype_name,
+        envelope,
+        timings,
+    )
+    if timings is not None:
+        add_transform_metrics(sourcetype_name, route_time, timings, 1)
+    logger.debug("Processed Data", extra={"data": record})
+    if record:
+        return {
+            "data": encode_record_data(record),
+            "result": "Ok",
+            "recordId": rec_id,
+        }
+    return {"result": "Dropped", "recordId": rec_id}
+
+
+def encode_record_data(data: bytes | bytearray) -> str:
+    """Base64 encodes the data of a record being returned to Firehose.
+
+    The response has to be JSON, so the data ends up as a str. A bytearray is
+    emptied once it's been encoded, freeing it before the str is made.
+
+    Args:
+        data (bytes | bytearray): Data to encode
+
+    Returns:
+        str: Base64 encoded data
+    """
+    encoded = binascii.b2a_base64(data, newline=False)
+    if isinstance(data, bytearray):
+        data.clear()
+    return encoded.decode("ascii")
+
+
+# Start of a Splunk HEC event serialised by EnvelopeTemplate, with its index and
+# sourcetype
+SPLUNK_EVENT_START = re.compile(
+    rb'\{"index": "(?:[^"\\]|\\.)*", "sourcetype": "(?:[^"\\]|\\.)*", '
+)
+# Between each of the HEC events in a transformed record
+SPLUNK_EVENT_SEPARATOR = b'}\n{"index": "'
+SPLUNK_EVENT_KEY = b', "event": '
+
+
+def is_splunk_payload(payload: bytes) -> bool:
+    """Checks whether a payload is one or more Splunk HEC events, one per line, as
+    serialised by EnvelopeTemplate.
+
+    Every line has to start with the index key and end with a closing brace, and
+    there has to be an event key for each of them, so other JSON is ruled out
+    with a few passes over the whole payload. Payloads that pass are then parsed
+    in one go as an array of the lines, to make sure each line is a valid JSON
+    object.
+
+    Args:
+        payload (bytes): Decoded record data
+
+    Returns:
+        bool: Whether it is valid Splunk HEC events
+    """
+    lines = payload.count(b"\n") + 1
+    if not (
+        SPLUNK_EVENT_START.match(payload)
+        and payload.endswith(b"}")
+        and payload.count(SPLUNK_EVENT_SEPARATOR) == lines - 1
+        and payload.count(SPLUNK_EVENT_KEY) >= lines
+    ):
+        return False
+    try:
+        events = json.loads(b"[" + payload.replace(b"\n", b",") + b"]")
+    except ValueError:
+        # Not valid JSON, or not valid UTF-8
+        return False
+    # A line holding more than one object would add to the count
+    return len(events) == lines and all(isinstance(event, dict) for event in events)
+
+
+def forward_record_data(base64_data: str | bytes, payload: bytes) -> str:
+    """Gets the data to return for a record being forwarded on as it is.
+
+    Args:
+        base64_data (str | bytes): The record's base64 encoded data
+        payload (bytes): The record's decoded data
+
+    Returns:
+        str: Base64 encoded, uncompressed data
+    """
+    # The first four base64 characters decode to the first three bytes, enough to
+    # tell whether it was gzip or zlib compressed
+    if get_compression_wbits(base64.b64decode(base64_data[:4])) is not None:
+        return encode_record_data(payload)
+    # It wasn't compressed, so the data it came with can be returned
+    return base64_data.decode() if isinstance(base64_data, bytes) else base64_data
+
+
+def add_transform_metrics(
+    sourcetype_name: str, route_time: float, timings: list[float], events: int
+):
+    """Adds the time taken to route and transform a record's events to the stage metrics
+
+    Args:
+        sourcetype_name (str): Sourcetype the events were routed to
+        route_time (float): Seconds spent routing the record
+        timings (list[float]): Seconds spent filtering, redacting and serialising
+        events (int): Number of events
+    """
+    stage_metrics.add(
+        sourcetype_name,
+        {
+            "Route": route_time,
+            "Filter": timings[0],
+            "Redact": timings[1],
+            "Serialise": timings[2],
+            "Events": events,
+        },
+    )
+
+
+def add_route_cache_metrics(config: dict, before: tuple[int, int]):
+    """Adds the routing cache hits and misses since before to the stage metrics.
+
+    Args:
+        config (dict): Configuration the records were routed with
+        before (tuple[int, int]): Hits and misses beforehand, from route_cache_info
+    """
+    hits, misses = get_compiled_config(config).route_cache_info()
+    stage_metrics.add(
+        None,
+        {"RouteCacheHits": hits - before[0], "RouteCacheMisses": misses - before[1]},
+    )
+
+
+def process_cloudwatch_log_record(
+    data: dict,
+    rec_id: str,
+    firehose_arn: str,
+    config: dict,
+    event_sizes: list[int] | None = None,
+) -> dict:
+    """Matches a CW event to a Splunk index and source type
+
+    Args:
+        data (dict): CW Event
+        rec_id (str): Firehose Record ID
+        firehose_arn (str): Firehose ARN
+        config (dict): Configuration to match against
+        event_sizes (list[int] | None, optional): If given, the transformed size of each
+            log event (0 if it was dropped) is appended to it. Defaults to None.
+
+    Returns:
+        dict: Processed records
+    """
+    # CONTROL_MESSAGE are sent by CWL to check if the subscription is reachable.
+    # They do not contain actual data.
+    if data["messageType"] == "CONTROL_MESSAGE":
+        return {"result": "Dropped", "recordId": rec_id}
+    if data["messageType"] == "DATA_MESSAGE":
+        account_id = str(data["owner"])
+        log_group = data["logGroup"]
+        log_stream = data["logStream"]
+
+        start = time.perf_counter() if stage_metrics.enabled else 0.0
+        compiled_config = get_compiled_config(config)
+        match = compiled_config.match_log_stream(log_group, account_id, log_stream)
+
+        if not match:
+            routes = compiled_config.log_groups.get(log_group)
+            if not routes:
+                logger.info(
+                    f"CLOUDWATCH: Dropping as we cannot locate a log_group ({log_group}) "
+                    "match for it."
+                )
+            elif not any(account_id in x.accounts for x in routes):
+                logger.info(
+                    f"CLOUDWATCH: Dropping as we cannot locate a log_group ({log_group}) "
+                    f"and account_id ({account_id}) match for it."
+                )
+            else:
+                logger.info(
+                    "CLOUDWATCH: Dropping as we cannot locate a sourcetype match for "
+                    f"log_stream ({log_stream}) / log_group ({log_group})."
+                )
+            return {"result": "Dropped", "recordId": rec_id}
+        index, sourcetype_name = match
+
+        sourcetype = compiled_config.get_sourcetype(sourcetype_name)
+
+        envelope = get_envelope_template(
+            index, sourcetype_name, log_group, account_id, log_stream, firehose_arn
+        )
+        timings = None
+        route_time = 0.0
+        if stage_metrics.enabled:
+            route_time = time.perf_counter() - start
+            timings = [0.0, 0.0, 0.0]
+
+        # Each event is added to the output as it's transformed, rather than
+        # keeping them all to join together afterwards
+        output = bytearray()
+        events = 0
+        for log_event in data["logEvents"]:
+            event = transform_event(
+                str(log_event["timestamp"]),
+                log_event["message"],
+                sourcetype,
+                sourcetype_name,
+                envelope,
+                timings,
+            )
+            events += 1
+            if event_sizes is not None:
+                event_sizes.append(len(event) if event else 0)
+            if event:
+                if output:
+                    output += b"\n"
+                output += event
+        if timings is not None:
+            add_transform_metrics(sourcetype_name, route_time, timings, events)
+
+        logger.debug("Processed Data", extra={"data": output})
+        return {
+            "data": encode_record_data(output),
+            "result": "Ok",
+            "recordId": rec_id,
+        }
+    return {"result": "ProcessingFailed", "recordId": rec_id}
+
+
+# Lambda's synchronous response payload limit
+MAX_RESPONSE_SIZE = 6_291_456
+# Size of the {"records": []} object wrapping the returned records
+RESPONSE_OVERHEAD = len(json.dumps({"records": []}))
+# Largest record that can be put into a Firehose stream
+MAX_REINGESTION_RECORD_SIZE = 1_024_000
+# Most data that can be sent to Firehose in one put_record_batch call
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+# Size of the ", " separating each returned record
+RECORD_SEPARATOR_SIZE = len(", ")
+# Size of a returned record without its data, allowing up to 256 bytes for the
+# ID Firehose gives a reingested record
+SPLIT_RECORD_OVERHEAD = (
+    len(json.dumps({"data": "", "result": "Ok", "recordId": ""})) + 256
+)
+# Share of the response a split record can take, so that when it's reingested it
+# can still be returned alongside other records rather than being reingested again
+SPLIT_RECORD_RESPONSE_SHARE = 0.5
+
+
+def get_record_size(record: dict) -> int:
+    """Calculates the length in bytes of a record once it's serialised into the response.
+
+    The base64 data is counted by its length, rather than dumping it, as it never
+    needs escaping.
+
+    Args:
+        record (dict): Dictionary to get the size of
+
+    Returns:
+        int: Size of the dictionary
+    """
+    if not (data := record.get("data")):
+        return len(json.dumps(record).encode())
+    return len(json.dumps({**record, "data": ""}).encode()) + len(data)
+
+
+def get_dropped_record_size(rec_id: str) -> int:
+    """Gets the size a record takes up in the response once it's been dropped
+
+    Args:
+        rec_id (str): Firehose Record ID
+
+    Returns:
+        int: Size of the dropped record
+    """
+    return get_record_size({"result": "Dropped", "recordId": rec_id})
+
+
+class ProcessingOptions(NamedTuple):
+    """How process_records fits the records it transforms into the response, and
+    how many of which type of worker process_records_parallel spreads them over."""
+
+    max_return_size: int = MAX_RESPONSE_SIZE
+    streaming_budget: bool = False
+    deadline: float | None = None
+    workers: int = TRANSFORM_WORKERS
+    worker_type: str = TRANSFORM_WORKER_TYPE
+
+
+class ParsedRecord(NamedTuple):
+    """A Firehose record's type, data and decompressed payload."""
+
+    record_type: str | None
+    data: dict | None
+    payload: bytes | None
+
+
+class ResponseBudget:
+    """Keeps track of the space left in the response and the time left to fill it
+    while process_records works through the records, working out which records to
+    skip and the details to keep about each of the others.
+    """
+
+    def __init__(self, records: list[dict], options: ProcessingOptions):
+        """
+        Args:
+            records (list[dict]): Records being processed
+            options (ProcessingOptions): Response size, streaming budget and deadline
+        """
+        self.max_return_size = options.max_return_size
+        self.record_count = len(records)
+        self.seen = 0
+        self.stop_at = None
+        if options.deadline is not None:
+            self.stop_at = options.deadline - PROCESSING_DEADLINE_MARGIN
+        self.out_of_time = False
+        self.remaining_size = None
+        if options.streaming_budget:
+            # Every record has to be returned, at least as Dropped
+            self.remaining_size = (
+                options.max_return_size
+                - RESPONSE_OVERHEAD
+                - RECORD_SEPARATOR_SIZE * max(len(records) - 1, 0)
+                - sum(get_dropped_record_size(r["recordId"]) for r in records)
+            )
+        self.decoded_cache_size = 0
+
+    def skip_next(self) -> bool:
+        """Works out whether the next record should be skipped, as the response is
+        full or the deadline is close.
+
+        Returns:
+            bool: True if it should be skipped
+        """
+        index = self.seen
+        self.seen += 1
+        # At least one record is always transformed, so a timeout too short for the
+        # margins can't leave every invocation reingesting all of its records
+        if (
+            self.stop_at is not None
+            and index > 0
+            and not self.out_of_time
+            and time.monotonic() > self.stop_at
+        ):
+            self.out_of_time = True
+            logger.warning(
+                "Running out of time, reingesting the last %d records as they are",
+                self.record_count - index,
+            )
+        return self.out_of_time or (
+            self.remaining_size is not None and self.remaining_size < 0
+        )
+
+    def add(
+        self, processed_record: dict, parsed: ParsedRecord, event_sizes: list[int]
+    ) -> dict:
+        """Takes a processed record out of the budget.
+
+        Args:
+            processed_record (dict): Processed record
+            parsed (ParsedRecord): What it was processed from
+            event_sizes (list[int]): Transformed size of each of its log events
+
+        Returns:
+            dict: Details of the record, as described for process_records
+        """
+        details = {"size": get_record_size(processed_record)}
+        if (
+            parsed.record_type == "cloudwatch"
+            and processed_record["result"] == "Ok"
+            and RESPONSE_OVERHEAD + details["size"] > self.max_return_size
+        ):
+            details["event_sizes"] = event_sizes
+            # Streamed records' log events have been used up, so can't be kept
+            payload = parsed.payload
+            if (
+                payload is not None
+                and self.decoded_cache_size + len(payload) <= DECODED_RECORD_CACHE_BYTES
+            ):
+                details["decoded"] = payload
+                self.decoded_cache_size += len(payload)
+        elif self.remaining_size is not None and processed_record["result"] == "Ok":
+            self.remaining_size -= details["size"] - get_dropped_record_size(
+                processed_record["recordId"]
+            )
+        return details
+
+
+def decode_record(record: dict) -> tuple[dict | None, bytes | None]:
+    """Starts streaming a Firehose record, or else decompresses its data.
+
+    Args:
+        record (dict): Firehose record
+
+    Returns:
+        tuple[dict | None, bytes | None]: The streamed record's data, or None if it
+            isn't streamed, and the decompressed payload, or None if it's streamed
+            or couldn't be decompressed
+    """
+    try:
+        # Streamed records' log events are decompressed as they're transformed
+        if STREAMING_PARSE:
+            data = stream_cloudwatch_record_data(record["data"])
+            if data is not None:
+                return data, None
+        return None, decode_firehose_record_data(record["data"])
+    except (RecordDataTooLargeException, EOFError, zlib.error) as e:
+        # Too big, truncated or corrupt
+        logger.warning("Failing record %s: %s", record["recordId"], e)
+        return None, None
+
+
+def parse_record(data: dict | None, payload: bytes | None) -> ParsedRecord:
+    """Works out a decoded record's type, parsing its payload if it has to.
+
+    Args:
+        data (dict | None): Streamed record's data
+        payload (bytes | None): Decompressed payload
+
+    Returns:
+        ParsedRecord: The record's type, or None if it's unknown, and data
+    """
+    if data is not None:
+        return ParsedRecord(get_record_type(data), data, payload)
+    if payload is None:
+        # It couldn't be decompressed
+        return ParsedRecord(None, None, None)
+    if is_splunk_payload(payload):
+        # Reingested records are forwarded on without being parsed
+        return ParsedRecord("splunk", None, payload)
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        # Not valid JSON, or not valid UTF-8
+        return ParsedRecord(None, None, payload)
+    return ParsedRecord(get_record_type(data), data, payload)
+
+
+def transform_record(
+    record: dict,
+    parsed: ParsedRecord,
+    firehose_arn: str,
+    config: dict,
+    event_sizes: list[int] | None,
+) -> dict:
+    """Transforms a parsed record according to its type.
+
+    Args:
+        record (dict): Firehose record
+        parsed (ParsedRecord): Its type, data and payload
+        firehose_arn (str): Firehose ARN that received it
+        config (dict): Configuration used to process the CW events
+        event_sizes (list[int] | None): As for process_cloudwatch_log_record
+
+    Returns:
+        dict: Processed record
+    """
+    rec_id = record["recordId"]
+    if parsed.record_type == "cloudwatch":
+        # If it's a Cloudwatch log record
+        try:
+            return process_cloudwatch_log_record(
+                parsed.data, rec_id, firehose_arn, config, event_sizes
+            )
+        except (RecordDataTooLargeException, ValueError, zlib.error) as e:
+            # Streamed records are only decompressed and parsed as they're
+            # transformed, so these can come from their log events
+            logger.warning("Failing record %s: %s", rec_id, e)
+    elif parsed.record_type == "eventbridge":
+        # If it's an Eventbridge event record
+        return process_eventbridge_event(parsed.data, rec_id, firehose_arn, config)
+    elif parsed.record_type == "splunk":
+        # Else if it's a reingested log which can skip processing
+        logger.info("Reingested record %s detected, forwarding it on.", rec_id)
+        return {
+            "data": forward_record_data(record["data"], parsed.payload),
+            "result": "Ok",
+            "recordId": rec_id,
+        }
+    # Else it's an unknown log, or it failed, so reject it
+    return {"result": "ProcessingFailed", "recordId": rec_id}
+
+
+def process_record(
+    record: dict, firehose_arn: str, config: dict, event_sizes: list[int] | None
+) -> tuple[dict, ParsedRecord]:
+    """Decodes, parses and transforms a single record, timing each stage if stage
+    metrics are enabled.
+
+    Args:
+        record (dict): Firehose record
+        firehose_arn (str): Firehose ARN that received it
+        config (dict): Configuration used to process the CW events
+        event_sizes (list[int] | None): As for process_cloudwatch_log_record
+
+    Returns:
+        tuple[dict, ParsedRecord]: Processed record, and what it was processed from
+    """
+    metrics = stage_metrics.enabled
+    if metrics:
+        start = time.perf_counter()
+    data, payload = decode_record(record)
+    if metrics:
+        decoded = time.perf_counter()
+    parsed = parse_record(data, payload)
+    if metrics:
+        parsed_at = time.perf_counter()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Record", extra={"data": record})
+        logger.debug("Parsed data", extra={"data": parsed.data})
+
+    processed_record = transform_record(
+        record, parsed, firehose_arn, config, event_sizes
+    )
+    if debug:
+        logger.debug("Processed record", extra={"data": processed_record})
+    if metrics:
+        stage_metrics.add(
+            None,
+            {
+                "Decompress": decoded - start,
+                "Parse": parsed_at - decoded,
+                "Transform": time.perf_counter() - parsed_at,
+                "Records": 1,
+            },
+        )
+    return processed_record, parsed
+
+
+def process_records(
+    records: list[dict],
+    firehose_arn: str,
+    config: dict,
+    record_details: list[dict] | None = None,
+    options: ProcessingOptions = ProcessingOptions(),
+) -> list:
+    """Loops through records, works out their type and processes them accordingly.
+
+    With a streaming budget, the size of the response is tracked as records are
+    processed. Once the records processed so far have used up all the space for
+    returning data, the rest are marked as Dropped without being decoded, and
+    flagged with "skipped" in record_details so they get reingested as they are.
+
+    Likewise, if it gets within PROCESSING_DEADLINE_MARGIN seconds of the deadline,
+    the records not processed yet are skipped, so there's time to reingest them
+    before the lambda times out. The first record is always processed, so each
+    invocation makes progress even if it starts past that point.
+
+    With STREAMING_PARSE, gzipped Cloudwatch records are routed on the keys before
+    their log events, and their log events are only decompressed and parsed as
+    they're transformed. Records that aren't routed are dropped without
+    decompressing the rest of them, and at most a chunk of each record's
+    decompressed data is held at a time. Their decoded data isn't kept for
+    splitting.
+
+    Records whose data decompresses to more than MAX_DECOMPRESSED_RECORD_BYTES
+    are marked as ProcessingFailed.
+
+    Args:
+        records (list[dict]): Records to process
+        firehose_arn (str): Firehose ARN that received them
+        config (dict): Configuration used to process the CW events
+        record_details (list[dict] | None, optional): If given, a dict is appended to
+            it for each processed record, containing the record's response size
+            under "size". Cloudwatch records too big to ever be returned also keep
+            the transformed size of each log event under "event_sizes" and their
+            decompressed data under "decoded" (up to DECODED_RECORD_CACHE_BYTES in
+            total), so they can be split without decompressing them again. The bytes
+            are kept rather than the parsed data, which takes a few times the
+            memory. Defaults to None.
+        options (ProcessingOptions, optional): Maximum lambda return size, whether
+            to stop processing records once the response is full and the
+            time.monotonic() value the invocation has to finish by. The streaming
+            budget and deadline are only used if record_details is given. Defaults
+            to ProcessingOptions().
+
+    Returns:
+        list: Processed records
+    """
+    returned_records = []
+    budget = None
+    if record_details is not None:
+        budget = ResponseBudget(records, options)
+    for r in records:
+        if budget is None:
+            returned_records.append(process_record(r, firehose_arn, config, None)[0])
+            continue
+        if budget.skip_next():
+            skipped_record = {"result": "Dropped", "recordId": r["recordId"]}
+            returned_records.append(skipped_record)
+            record_details.append(
+                {"size": get_record_size(skipped_record), "skipped": True}
+            )
+            continue
+
+        event_sizes = []
+        processed_record, parsed = process_record(r, firehose_arn, config, event_sizes)
+        returned_records.append(processed_record)
+        record_details.append(budget.add(processed_record, parsed, event_sizes))
     return returned_records
 
 
-def split_cwl_record(cwl_record: dict) -> list:
+def _process_records_worker(
+    conn,
+    records: list[dict],
+    firehose_arn: str,
+    config: dict,
+    options: ProcessingOptions,
+):
+    """Runs process_records in a worker process, sending the processed records,
+    their details, the events it dropped, its stage metrics and the routes it
+    added to the routing caches (or the exception raised) back through a pipe.
+
+    Args:
+        conn (multiprocessing.connection.Connection): Pipe to send results back
+            through
+        records (list[dict]): Records to process
+        firehose_arn (str): Firehose ARN that received them
+        config (dict): Configuration used to process the CW events
+        options (ProcessingOptions): As for process_records
+    """
+    try:
+        # Only send back the drops, metrics and routes from these records
+        drop_log.take()
+        stage_metrics.take()
+        get_compiled_config(config).take_new_routes()
+        if stage_metrics.enabled:
+            route_cache = get_compiled_config(config).route_cache_info()
+        record_details = []
+        processed = process_records(
+            records, firehose_arn, config, record_details, options
+        )
+        if stage_metrics.enabled:
+            add_route_cache_metrics(config, route_cache)
+        conn.send(
+            (
+                processed,
+                record_details,
+                drop_log.take(),
+                stage_metrics.take(),
+                get_compiled_config(config).take_new_routes(),
+                None,
+            )
+        )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        conn.send((None, None, None, None, None, e))
+    finally:
+        conn.close()
+
+
+def _process_slices_in_threads(
+    slices: list[list[dict]],
+    firehose_arn: str,
+    config: dict,
+    options: ProcessingOptions,
+) -> list[tuple[list, list[dict]]]:
+    """Runs process_records on each slice of records in its own thread.
+
+    Args:
+        slices (list[list[dict]]): Slices of records to process
+        firehose_arn (str): Firehose ARN that received them
+        config (dict): Configuration used to process the CW events
+        options (ProcessingOptions): As for process_records
+
+    Returns:
+        list[tuple[list, list[dict]]]: Processed records and their details, for
+            each slice
+    """
+
+    def process_slice(records_slice: list[dict]) -> tuple[list, list[dict]]:
+        details = []
+        processed = process_records(
+            records_slice, firehose_arn, config, details, options
+        )
+        return processed, details
+
+    with ThreadPoolExecutor(max_workers=len(slices)) as executor:
+        return list(executor.map(process_slice, slices))
+
+
+def _receive_worker_results(
+    process, receiver, config: dict
+) -> tuple[list | None, list[dict] | None, Exception | None]:
+    """Receives a worker process's results, merging the events it dropped, its
+    stage metrics and its new routes into this process's, then waits for it to
+    exit.
+
+    Args:
+        process (multiprocessing.Process): Worker process
+        receiver (multiprocessing.connection.Connection): Pipe it sends its
+            results through
+        config (dict): Configuration used to process the CW events
+
+    Returns:
+        tuple[list | None, list[dict] | None, Exception | None]: Processed records
+            and their details, or the exception the worker raised
+    """
+    # Receive before joining, so workers aren't blocked writing large results
+    try:
+        processed, details, drops, metrics, routes, error = receiver.recv()
+    except EOFError:
+        processed, details, drops, metrics, routes = (None,) * 5
+        error = RuntimeError("Worker process exited without returning results")
+    receiver.close()
+    process.join()
+    if drops:
+        drop_log.merge(*drops)
+    if metrics:
+        stage_metrics.merge(metrics)
+    if routes:
+        # So the workers forked next time start with them
+        get_compiled_config(config).merge_routes(routes)
+    return processed, details, error
+
+
+def _process_slices_in_processes(
+    slices: list[list[dict]],
+    firehose_arn: str,
+    config: dict,
+    options: ProcessingOptions,
+) -> list[tuple[list, list[dict]]]:
+    """Runs process_records on each slice of records in its own forked process.
+
+    Args:
+        slices (list[list[dict]]): Slices of records to process
+        firehose_arn (str): Firehose ARN that received them
+        config (dict): Configuration used to process the CW events
+        options (ProcessingOptions): As for process_records
+
+    Returns:
+        list[tuple[list, list[dict]]]: Processed records and their details, for
+            each slice
+    """
+    context = multiprocessing.get_context("fork")
+    pipes = []
+    for records_slice in slices:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_process_records_worker,
+            args=(sender, records_slice, firehose_arn, config, options),
+        )
+        process.start()
+        sender.close()
+        pipes.append((process, receiver))
+
+    results = []
+    errors = []
+    for process, receiver in pipes:
+        processed, details, error = _receive_worker_results(process, receiver, config)
+        results.append((processed, details))
+        if error:
+            errors.append(error)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def process_records_parallel(
+    records: list[dict],
+    firehose_arn: str,
+    config: dict,
+    record_details: list[dict] | None = None,
+    options: ProcessingOptions = ProcessingOptions(),
+) -> list:
+    """Splits records into one contiguous slice per worker and runs process_records
+    on each of them at the same time, returning the results in the original order.
+
+    Process workers are forked and send their results back through pipes, as
+    multiprocessing pools and queues need shared memory which Lambda doesn't
+    provide. Thread workers avoid copying the records and results between
+    processes, but only the decompression runs outside the GIL.
+
+    Args:
+        records (list[dict]): Records to process
+        firehose_arn (str): Firehose ARN that received them
+        config (dict): Configuration used to process the CW events
+        record_details (list[dict] | None, optional): As for process_records.
+            Defaults to None.
+        options (ProcessingOptions, optional): As for process_records, along with
+            the number and type of workers. The streaming budget isn't used, as
+            each worker only sees its own slice. Defaults to ProcessingOptions().
+
+    Raises:
+        ValueError: If the worker type isn't recognised
+
+    Returns:
+        list: Processed records
+    """
+    workers = min(options.workers, len(records))
+    options = options._replace(streaming_budget=False)
+    if workers <= 1:
+        return process_records(records, firehose_arn, config, record_details, options)
+
+    slice_size = -(-len(records) // workers)
+    slices = [records[i : i + slice_size] for i in range(0, len(records), slice_size)]
+    if options.worker_type == "thread":
+        results = _process_slices_in_threads(slices, firehose_arn, config, options)
+    elif options.worker_type == "process":
+        results = _process_slices_in_processes(slices, firehose_arn, config, options)
+    else:
+        raise ValueError(f"Unknown transform worker type {options.worker_type}")
+
+    logger.debug(
+        f"Processed {len(records)} records with {len(slices)} "
+        f"{options.worker_type} workers"
+    )
+    returned_records = []
+    for processed, details in results:
+        returned_records.extend(processed)
+        if record_details is not None:
+            record_details.extend(details)
+    return returned_records
+
+
+def split_cwl_record(
+    cwl_record: dict,
+    event_sizes: list[int] | None = None,
+    max_return_size: int = MAX_RESPONSE_SIZE,
+) -> list:
     """
-    Splits one CWL record into two, each containing half the log events.
+    Splits one CWL record up into smaller records. Without event_sizes it is split
+    into two, each containing half the log events. With them, consecutive log
+    events are grouped into as many records as are needed for each one to take
+    up no more than SPLIT_RECORD_RESPONSE_SHARE of max_return_size once it's
+    transformed.
     Serializes and compresses the data before returning. That data can then be
     re-ingested into the stream, and it'll appear as though they came from CWL
     directly.
 
     Args:
         cwl_record (dict): Cloudwatch Record
+        event_sizes (list[int] | None, optional): Transformed size of each log event.
+            Defaults to None.
+        max_return_size (int, optional): Maximum lambda return size. Defaults to MAX_RESPONSE_SIZE.
 
     Returns:
         list: Split up cloudwatch events, compressed ready for reingestion
     """
 
     log_events = cwl_record["logEvents"]
-    mid = len(log_events) // 2
-    rec1 = dict(cwl_record.items())
-    rec1["logEvents"] = log_events[:mid]
-    rec2 = dict(cwl_record.items())
-    rec2["logEvents"] = log_events[mid:]
-    return [gzip.compress(json.dumps(r).encode()) for r in [rec1, rec2]]
+    chunks = []
+    if event_sizes is not None and len(event_sizes) == len(log_events):
+        # Largest transformed data that still fits in its share of the response
+        # once base64 encoded and wrapped with a record ID we don't know yet.
+        max_record_size = int(
+            (max_return_size - RESPONSE_OVERHEAD) * SPLIT_RECORD_RESPONSE_SHARE
+        )
+        max_data_size = (max_record_size - SPLIT_RECORD_OVERHEAD) // 4 * 3
+        start = 0
+        chunk_size = 0
+        for idx, event_size in enumerate(event_sizes):
+            if not event_size:
+                continue
+            # Events are joined by newlines
+            event_size += 1 if chunk_size else 0
+            if chunk_size and chunk_size + event_size > max_data_size:
+                chunks.append(log_events[start:idx])
+                start = idx
+                event_size -= 1
+                chunk_size = 0
+            chunk_size += event_size
+        chunks.append(log_events[start:])
+
+    if len(chunks) < 2:
+        mid = len(log_events) // 2
+        chunks = [log_events[:mid], log_events[mid:]]
+
+    split_records = []
+    for chunk in chunks:
+        rec = dict(cwl_record.items())
+        rec["logEvents"] = chunk
+        split_records.append(gzip.compress(json.dumps(rec).encode()))
+    return split_records
+
+
+# Base delay, in seconds, before retrying records Firehose failed to put
+RETRY_BASE_DELAY = 0.1
+# Base delay, in seconds, before retrying records Firehose throttled
+THROTTLED_RETRY_BASE_DELAY = 1.0
+# Longest delay, in seconds, between attempts to put records
+RETRY_MAX_DELAY = 5.0
+# Error codes that retrying won't fix
+NON_RETRYABLE_ERROR_CODES = frozenset(
+    [
+        "AccessDeniedException",
+        "InvalidArgumentException",
+        "InvalidKMSResourceException",
+        "ResourceNotFoundException",
+    ]
+)
+
+
+class RetrySettings(NamedTuple):
+    """How many attempts FirehoseRetrier makes and how it backs off between them"""
+
+    max_attempts: int = 20
+    base_delay: float = RETRY_BASE_DELAY
+    throttled_base_delay: float = THROTTLED_RETRY_BASE_DELAY
+    max_delay: float = RETRY_MAX_DELAY
+
+
+class FirehoseRetrier:
+    """Puts records into a Firehose stream, retrying any that fail.
+
+    Attempts are made in a loop, backing off exponentially (with full jitter)
+    between them. Throttling, i.e. ServiceUnavailableException for either the
+    whole call or individual records, backs off from a longer base delay than
+    other failures. Errors retrying can't fix aren't retried, and no retry is
+    made that would start after the deadline.
+    """
+
+    def __init__(
+        self,
+        client,
+        deadline: float | None = None,
+        settings: RetrySettings = RetrySettings(),
+        sleep=None,
+        clock=None,
+    ):
+        """
+        Args:
+            client (botocore.client.BaseClient): Firehose client
+            deadline (float | None, optional): time.monotonic() value to stop
+                retrying by. Defaults to None.
+            settings (RetrySettings, optional): Attempts and delays. Defaults to
+                RetrySettings().
+            sleep (Callable[[float], None] | None, optional): Used to wait between
+                attempts. Defaults to time.sleep.
+            clock (Callable[[], float] | None, optional): Used to check the
+                deadline. Defaults to time.monotonic.
+        """
+        self.client = client
+        self.deadline = deadline
+        self.settings = settings
+        self.sleep = sleep or time.sleep
+        self.clock = clock or time.monotonic
+
+    def get_delay(self, attempt: int, throttled: bool) -> float:
+        """Works out how long to wait before the next attempt
+
+        Args:
+            attempt (int): Number of attempts made so far
+            throttled (bool): Whether the last attempt was throttled
+
+        Returns:
+            float: Seconds to wait
+        """
+        settings = self.settings
+        base_delay = settings.throttled_base_delay if throttled else settings.base_delay
+        return random.uniform(
+            0, min(settings.max_delay, base_delay * 2 ** (attempt - 1))
+        )
+
+    def attempt(
+        self, stream_name: str, records: list[dict]
+    ) -> tuple[list[dict], str, bool, bool]:
+        """Makes a single attempt to put records into the stream.
+
+        Args:
+            stream_name (str): Stream to send the records to.
+            records (list[dict]): Records to send.
+
+        Returns:
+            tuple[list[dict], str, bool, bool]: Records that failed, why, whether
+                they were throttled and whether retrying them could help.
+        """
+        try:
+            response = self.client.put_record_batch(
+                DeliveryStreamName=stream_name, Records=records
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # botocore is always imported by the time a client raises
+            from botocore.exceptions import (  # pylint: disable=import-outside-toplevel
+                ClientError,
+            )
+
+            code = None
+            if isinstance(e, ClientError):
+                code = e.response.get("Error", {}).get("Code")
+            return (
+                records,
+                str(e),
+                code == "ServiceUnavailableException",
+                code not in NON_RETRYABLE_ERROR_CODES,
+            )
+
+        if response["FailedPutCount"] == 0:
+            return [], "", False, True
+        failed_records = []
+        codes = []
+        for idx, res in enumerate(response["RequestResponses"]):
+            if res.get("ErrorCode"):
+                codes.append(res["ErrorCode"])
+                failed_records.append(records[idx])
+        return (
+            failed_records,
+            "Individual error codes: " + ",".join(codes),
+            "ServiceUnavailableException" in codes,
+            True,
+        )
+
+    def put_record_batch(
+        self, stream_name: str, records: list[dict]
+    ) -> tuple[list[dict], str]:
+        """Puts records into the stream, retrying any that fail.
+
+        Args:
+            stream_name (str): Stream to send the records to.
+            records (list[dict]): Records to send.
+
+        Returns:
+            tuple[list[dict], str]: Records that still couldn't be put, and why.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            records, err_msg, throttled, retryable = self.attempt(stream_name, records)
+            if not records:
+                return [], ""
+            if not retryable:
+                return records, f"Not retrying after attempt {attempt}. {err_msg}"
+            if attempt >= self.settings.max_attempts:
+                return records, f"Gave up after {attempt} attempts. {err_msg}"
+            delay = self.get_delay(attempt, throttled)
+            if self.deadline is not None and self.clock() + delay > self.deadline:
+                return (
+                    records,
+                    f"Out of time to retry after {attempt} attempts. {err_msg}",
+                )
+
+            logger.info(
+                f"{len(records)} records failed while calling PutRecordBatch "
+                f"to Firehose stream, retrying in {delay:.2f}s. {err_msg}"
+            )
+            self.sleep(delay)
 
 
 def put_records_to_firehose_stream(
     stream_name: str,
     records: list[dict],
-    attempts_made: int = 0,
     max_attempts: int = 20,
+    deadline: float | None = None,
 ):
     """Tries to send records back to firehose.
 
     Args:
         stream_name (str): Stream to send the logs to.
         records (list[dict]): Records to send.
-        attempts_made (int, optional): How many attempts we've already made. Defaults to 0.
         max_attempts (int, optional): How many attempts to make. Defaults to 20.
+        deadline (float | None, optional): time.monotonic() value to stop retrying
+            by. Defaults to None.
 
     Raises:
         RuntimeError: If we fail to send them, raise this error
     """
-    failed_records = []
-    codes = []
-    err_msg = ""
-    response = None
-    try:
-        response = firehose_client.put_record_batch(
-            DeliveryStreamName=stream_name, Records=records
-        )
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        failed_records = records
-        err_msg = str(e)
-
-    # if there are no failed_records (put_record_batch succeeded), iterate over the response to gather results
-    if not failed_records and response and response["FailedPutCount"] > 0:
-        for idx, res in enumerate(response["RequestResponses"]):
-            # (if the result does not have a key 'ErrorCode' OR if it does and is empty) => we do not need to re-ingest
-            if not res.get("ErrorCode"):
-                continue
-
-            codes.append(res["ErrorCode"])
-            failed_records.append(records[idx])
-
-        err_msg = "Individual error codes: " + ",".join(codes)
-
+    failed_records, err_msg = FirehoseRetrier(
+        get_firehose_client(), deadline, RetrySettings(max_attempts)
+    ).put_record_batch(stream_name, records)
     if failed_records:
-        if attempts_made + 1 < max_attempts:
-            logger.info(
-                f"Some records failed while calling Putrecord_batch to Firehose stream, retrying. {err_msg}"
-            )
-            put_records_to_firehose_stream(
-                stream_name, failed_records, attempts_made + 1, max_attempts
-            )
-        else:
-            raise RuntimeError(
-                f"Could not put records after {str(max_attempts)} attempts. {err_msg}"
-            )
+        raise RuntimeError(f"Could not put {len(failed_records)} records. {err_msg}")
 
 
 def create_reingestion_record(original_record: dict, data: bytes | None = None) -> dict:
@@ -648,99 +2701,344 @@ def create_reingestion_record(original_record: dict, data: bytes | None = None)
     return r
 
 
+def compress_transformed_record(rec: dict) -> bytes | None:
+    """Compresses a processed record's HEC events so they can be reingested as
+    splunk records, which are forwarded on without being processed again.
+
+    Args:
+        rec (dict): Processed record
+
+    Returns:
+        bytes | None: Data to reingest, or None if there's nothing to reingest or
+            it's too big for a Firehose record.
+    """
+    data = base64.b64decode(rec["data"])
+    if not data:
+        return None
+    data = gzip.compress(data)
+    if len(data) > MAX_REINGESTION_RECORD_SIZE:
+        return None
+    return data
+
+
+def batch_reingestion_records(
+    records: list[dict],
+    max_batch_size: int = 500,
+    max_batch_bytes: int = MAX_BATCH_BYTES,
+) -> list[list[dict]]:
+    """Groups records, in order, into batches that can each be sent to firehose in
+    one put_record_batch call.
+
+    Args:
+        records (list[dict]): Records to reingest.
+        max_batch_size (int, optional): Maximum number of records in a batch.
+            Defaults to 500.
+        max_batch_bytes (int, optional): Maximum total size of the records' data in
+            a batch. Defaults to MAX_BATCH_BYTES.
+
+    Returns:
+        list[list[dict]]: Batches of records
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for record in records:
+        record_bytes = len(record["Data"])
+        if batch and (
+            len(batch) >= max_batch_size or batch_bytes + record_bytes > max_batch_bytes
+        ):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += record_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def reingest_records(
     record_lists_to_reingest: list[list[dict]],
     stream_name: str,
     max_batch_size: int = 500,
+    max_batch_bytes: int = MAX_BATCH_BYTES,
+    max_workers: int = REINGEST_CONCURRENCY,
+    deadline: float | None = None,
 ):
-    """Reingests records back into firehose
+    """Reingests records back into firehose, sending several batches at once
 
     Args:
         record_lists_to_reingest (list[list[dict]]): Records to reingest.
         stream_name (str): Name of the firehose stream.
-        max_batch_size (int, optional): Maximum number of records to send to firehose at once. Defaults to 500.
+        max_batch_size (int, optional): Maximum number of records to send to
+            firehose at once. Defaults to 500.
+        max_batch_bytes (int, optional): Maximum amount of data to send to firehose
+            at once. Defaults to MAX_BATCH_BYTES.
+        max_workers (int, optional): Maximum number of batches to send at once.
+            Defaults to REINGEST_CONCURRENCY.
+        deadline (float | None, optional): time.monotonic() value to stop retrying
+            by. Defaults to None.
     """
-    # call putrecord_batch/putRecords for each group of up to 500 records to be re-ingested
+    # call putrecord_batch/putRecords for each batch of records to be re-ingested
     if record_lists_to_reingest:
         records_reingested_so_far = 0
         flattened_list = [r for sublist in record_lists_to_reingest for r in sublist]
-        for i in range(0, len(flattened_list), max_batch_size):
-            record_batch = flattened_list[i : i + max_batch_size]
-            # last argument is maxAttempts
-            put_records_to_firehose_stream(stream_name, record_batch)
-            records_reingested_so_far += len(record_batch)
-            logger.info(f"Reingested {records_reingested_so_far}/{len(flattened_list)}")
+        batches = batch_reingestion_records(
+            flattened_list, max_batch_size, max_batch_bytes
+        )
+        # Creating clients isn't thread safe, so make sure it exists first
+        get_firehose_client()
+        workers = min(max(1, max_workers), len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    put_records_to_firehose_stream,
+                    stream_name,
+                    batch,
+                    deadline=deadline,
+                )
+                for batch in batches
+            ]
+            # Every batch is attempted before any failure is raised
+            for batch, future in zip(batches, futures):
+                future.result()
+                records_reingested_so_far += len(batch)
+                logger.info(
+                    f"Reingested {records_reingested_so_far}/{len(flattened_list)}"
+                )
+
+
+class PackingOptions(NamedTuple):
+    """How work_out_records_to_reingest chooses which records to return, and what
+    it reingests in place of the rest."""
+
+    strategy: str = "in_order"
+    reingest_transformed: bool = False
+
+
+def split_oversized_record(
+    original_record: dict,
+    rec: dict,
+    record_size: int,
+    details: dict | None,
+    max_return_size: int,
+) -> list[dict]:
+    """Splits the original data of a record too large to return after processing
+    into records small enough to be returned (or in two if we don't know the size
+    of each log event), to be reingested. If it's not possible to split because
+    there is only one log event, the record is marked as ProcessingFailed, which
+    sends it to error output.
+
+    Args:
+        original_record (dict): Record as it was received
+        rec (dict): Processed record, which is updated with its new result
+        record_size (int): Size of the processed record
+        details (dict | None): Details of the record from process_records
+        max_return_size (int): Maximum lambda return size
+
+    Returns:
+        list[dict]: Records to reingest in its place, if any
+    """
+    reingestion_records = []
+    # Use the data decompressed by process_records, releasing it as we go, else reload it
+    if details and (payload := details.pop("decoded", None)):
+        record_data = json.loads(payload)
+        del payload
+        record_type = "cloudwatch"
+    else:
+        record_data = load_firehose_record_data(original_record["data"])
+        record_type = get_record_type(record_data)
+    if record_type == "cloudwatch":
+        # If there is more than one log event, split log events up and re-process
+        if len(record_data.get("logEvents", [])) > 1:
+            rec["result"] = "Dropped"
+            event_sizes = details.get("event_sizes") if details else None
+            reingestion_records = [
+                create_reingestion_record(original_record, data)
+                for data in split_cwl_record(record_data, event_sizes, max_return_size)
+            ]
+        else:
+            # Else if it's just one large message, drop it
+            rec["result"] = "ProcessingFailed"
+            logger.info(
+                f"Record {rec["recordId"]} contains only one log event but is still "
+                f"too large after processing ({record_size} bytes), marking it as "
+                f"{rec["result"]}"
+            )
+    else:
+        rec["result"] = "ProcessingFailed"
+        logging.info(
+            f"A large record of type {record_type} tried to be split but couldn't."
+        )
+    del rec["data"]
+    return reingestion_records
+
+
+def get_unreturnable_records(
+    records: list[dict], record_sizes: list[int], max_return_size: int, strategy: str
+) -> list[int]:
+    """Fits the Ok records into what's left for returning data once every record is
+    accounted for, in the order the packing strategy gives, each one being
+    returned if it still fits.
+
+    Args:
+        records (list[dict]): Processed records
+        record_sizes (list[int]): Size of each record in the response
+        max_return_size (int): Maximum lambda return size
+        strategy (str): "in_order", "max_bytes" or "min_records"
+
+    Returns:
+        list[int]: Indexes of the Ok records that don't fit
+    """
+    # Assume any Ok records will be dropped and reingested
+    dropped_sizes = [
+        (
+            get_dropped_record_size(rec["recordId"])
+            if rec["result"] == "Ok"
+            else record_sizes[idx]
+        )
+        for idx, rec in enumerate(records)
+    ]
+    remaining_size = (
+        max_return_size
+        - RESPONSE_OVERHEAD
+        - RECORD_SEPARATOR_SIZE * max(len(records) - 1, 0)
+        - sum(dropped_sizes)
+    )
+
+    data_sizes = {
+        idx: record_sizes[idx] - dropped_sizes[idx]
+        for idx, rec in enumerate(records)
+        if rec["result"] == "Ok"
+    }
+    order = list(data_sizes)
+    if strategy != "in_order":
+        # Sorting is stable, so records the same size stay in order
+        order.sort(key=data_sizes.get, reverse=strategy == "max_bytes")
+    unreturnable = []
+    for idx in order:
+        if data_sizes[idx] <= remaining_size:
+            remaining_size -= data_sizes[idx]
+        else:
+            unreturnable.append(idx)
+    return unreturnable
 
 
 def work_out_records_to_reingest(
-    event: dict, records: list[dict], max_return_size: int = 6_000_000
+    event: dict,
+    records: list[dict],
+    max_return_size: int = MAX_RESPONSE_SIZE,
+    record_details: list[dict] | None = None,
+    options: PackingOptions = PackingOptions(),
 ) -> list[list[dict]]:
-    """Goes through all the processed records and works out what cannot be returned through the lambda return.
+    """Goes through all the processed records and works out what cannot be
+    returned through the lambda return.
+
+    Every record has to be returned, so the budget for returning data is what's
+    left of max_return_size once the response wrapper and every record (without
+    its data) has been accounted for.
+
+    The packing strategy decides the order the Ok records are fitted into that
+    budget, each one being returned if it still fits:
+    - in_order: in the order they were received
+    - max_bytes: largest first, to return as much data as possible
+    - min_records: smallest first, to reingest as few records as possible
+
+    Records that don't fit in the response are reingested as they were received,
+    unless reingest_transformed is set, in which case their transformed HEC events
+    are reingested (where they fit in a Firehose record) so they aren't processed
+    again.
 
     Args:
         event (dict): Initial event object
         records (list[dict]): Transformed records
-        max_return_size (int, optional): Maximum lambda return size. Defaults to 6_000_000.
+        max_return_size (int, optional): Maximum lambda return size. Defaults to
+            MAX_RESPONSE_SIZE.
+        record_details (list[dict] | None, optional): Details of each record from
+            process_records, used to avoid recalculating their sizes. Defaults to None.
+        options (PackingOptions, optional): Packing strategy, "in_order",
+            "max_bytes" or "min_records", and whether to reingest the transformed
+            data of records that don't fit in the response. Defaults to
+            PackingOptions().
+
+    Raises:
+        ValueError: If the packing strategy isn't recognised
 
     Returns:
         list[dict]: Records which cannot be returned and need resubmitting to Firehose.
     """
-    record_lists_to_reingest = []
-    projected_return_size = 0
+    if options.strategy not in ("in_order", "max_bytes", "min_records"):
+        raise ValueError(f"Unknown packing strategy {options.strategy}")
+
+    reingested_by_index: dict[int, list[dict]] = {}
+    if record_details is None:
+        record_sizes = [get_record_size(rec) for rec in records]
+    else:
+        record_sizes = [details["size"] for details in record_details]
+        # Records process_records skipped once the response was full are reingested as they are
+        for idx, details in enumerate(record_details):
+            if details.get("skipped"):
+                reingested_by_index[idx] = [
+                    create_reingestion_record(event["records"][idx])
+                ]
 
     for idx, rec in enumerate(records):
-        original_record = event["records"][idx]
+        # We shouldn't get any processed reingested logs hitting this as they will be
+        # less than 6MB (reingestion already checked that)
+        if (
+            rec["result"] != "Ok"
+            or RESPONSE_OVERHEAD + record_sizes[idx] <= max_return_size
+        ):
+            continue
+        if split_records := split_oversized_record(
+            event["records"][idx],
+            rec,
+            record_sizes[idx],
+            record_details[idx] if record_details else None,
+            max_return_size,
+        ):
+            reingested_by_index[idx] = split_records
+        record_sizes[idx] = get_record_size(rec)
+
+    for idx in get_unreturnable_records(
+        records, record_sizes, max_return_size, options.strategy
+    ):
+        rec = records[idx]
+        reingested_by_index[idx] = [
+            create_reingestion_record(
+                event["records"][idx],
+                (
+                    compress_transformed_record(rec)
+                    if options.reingest_transformed
+                    else None
+                ),
+            )
+        ]
+        del rec["data"]
+        rec["result"] = "Dropped"
+    return [reingested_by_index[idx] for idx in sorted(reingested_by_index)]
 
-        record_size = get_record_size(rec)
 
-        if rec["result"] != "Ok":
-            projected_return_size += record_size
-            continue
+# Seconds to leave spare before the lambda times out
+DEADLINE_MARGIN = 2.0
 
-        # If a single record is too large after processing, split the original CWL data into two, each containing half
-        # the log events, and re-ingest both of them (note that it is the original data that is re-ingested, not the
-        # processed data). If it's not possible to split because there is only one log event, then mark the record as
-        # ProcessingFailed, which sends it to error output.
-
-        # If the record is greater than 6MB
-        # We shouldn't get any processed reingested logs hitting this as they will be less than 6MB (reingestion already checked that)
-        if record_size > max_return_size:
-            # Reload original data
-            record_data = load_firehose_record_data(original_record["data"])
-            record_type = get_record_type(record_data)
-            if record_type == "cloudwatch":
-                # If there is more than one log event, split log events in half and re-process
-                if len(record_data.get("logEvents", [])) > 1:
-                    rec["result"] = "Dropped"
-                    record_lists_to_reingest.append(
-                        [
-                            create_reingestion_record(original_record, data)
-                            for data in split_cwl_record(record_data)
-                        ]
-                    )
-                else:
-                    # Else if it's just one large message, drop it
-                    rec["result"] = "ProcessingFailed"
-                    logger.info(
-                        f"Record {rec["recordId"]} contains only one log event but is still too large after processing ({record_size} bytes), marking it as {rec["result"]}"
-                    )
-            else:
-                rec["result"] = "ProcessingFailed"
-                logging.info(
-                    f"A large record of type {record_type} tried to be split but couldn't."
-                )
-            del rec["data"]
-        else:
-            # If the record is less than 6MB,
-            projected_return_size += record_size
-            # 6000000 instead of 6291456 to leave ample headroom for the stuff we didn't account for
-            if projected_return_size > max_return_size:
-                record_lists_to_reingest.append(
-                    [create_reingestion_record(original_record)]
-                )
-                del rec["data"]
-                rec["result"] = "Dropped"
-    return record_lists_to_reingest
+
+def get_deadline(context) -> float | None:
+    """Works out the time.monotonic() value the invocation should finish by.
+
+    Args:
+        context (LambdaContext): Lambda context
+
+    Returns:
+        float | None: Deadline, or None if the context doesn't say
+    """
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return (
+        time.monotonic()
+        + context.get_remaining_time_in_millis() / 1000
+        - DEADLINE_MARGIN
+    )
 
 
 def get_stats(records: list, record_lists_to_reingest: list) -> dict:
@@ -767,27 +3065,98 @@ def get_stats(records: list, record_lists_to_reingest: list) -> dict:
     return stats
 
 
-def lambda_handler(event: dict, _context: dict) -> dict:
+def transform_records(
+    event: dict, firehose_arn: str, config: dict, deadline: float | None
+) -> tuple[list, list[dict]]:
+    """Transforms the event's records, with TRANSFORM_WORKERS workers if there's
+    more than one.
+
+    Args:
+        event (dict): Firehose transformation event
+        firehose_arn (str): Firehose ARN that received it
+        config (dict): Configuration used to process the CW events
+        deadline (float | None): time.monotonic() value the invocation has to
+            finish by
+
+    Returns:
+        tuple[list, list[dict]]: Processed records, and their details
+    """
+    if stage_metrics.enabled:
+        route_cache = get_compiled_config(config).route_cache_info()
+    record_details = []
+    if TRANSFORM_WORKERS > 1:
+        records = process_records_parallel(
+            event["records"],
+            firehose_arn,
+            config,
+            record_details,
+            ProcessingOptions(deadline=deadline),
+        )
+    else:
+        records = process_records(
+            event["records"],
+            firehose_arn,
+            config,
+            record_details,
+            ProcessingOptions(streaming_budget=STREAMING_BUDGET, deadline=deadline),
+        )
+    if stage_metrics.enabled:
+        # Workers in other processes add their own
+        add_route_cache_metrics(config, route_cache)
+    return records, record_details
+
+
+def lambda_handler(event: dict, context: dict) -> dict:
     """Lambda function to transform Cloudwatch logs and Eventbridge events to Splunk HEC events.
 
     Args:
         event (dict): Firehose transformation event
-        _context (dict): Lambda context
+        context (dict): Lambda context
 
     Returns:
         dict: Transformed logs
     """
     logger.debug("Incoming event", extra={"data": event})
+    deadline = get_deadline(context)
+    metrics = stage_metrics.enabled
+    if metrics:
+        start = time.perf_counter()
 
     firehose_arn = event["deliveryStreamArn"]
     stream_name = firehose_arn.split("/")[1]
 
-    records = process_records(event["records"], firehose_arn, CONFIG)
-    record_lists_to_reingest = work_out_records_to_reingest(event, records)
-    reingest_records(record_lists_to_reingest, stream_name)
+    config = get_config()
+    if metrics:
+        configured = time.perf_counter()
+    records, record_details = transform_records(event, firehose_arn, config, deadline)
+    if metrics:
+        processed = time.perf_counter()
+    record_lists_to_reingest = work_out_records_to_reingest(
+        event,
+        records,
+        record_details=record_details,
+        options=PackingOptions(PACKING_STRATEGY, REINGEST_TRANSFORMED),
+    )
+    del record_details
+    if metrics:
+        split = time.perf_counter()
+    reingest_records(record_lists_to_reingest, stream_name, deadline=deadline)
+    if metrics:
+        finished = time.perf_counter()
+        stage_metrics.add(
+            None,
+            {
+                "Config": configured - start,
+                "Process": processed - configured,
+                "Split": split - processed,
+                "Reingest": finished - split,
+                "Total": finished - start,
+            },
+        )
 
-    stats = get_stats(records, record_lists_to_reingest)
-    logger.info("stats", extra={"stats": stats})
+    logger.info("stats", extra={"stats": get_stats(records, record_lists_to_reingest)})
+    drop_log.flush()
+    stage_metrics.flush(stream_name)
 
     logger.debug("Outgoing event", extra={"data": {"records": records}})
 
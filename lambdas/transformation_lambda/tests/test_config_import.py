@@ -9,9 +9,14 @@ import pytest
 import yaml
 from src.mbtp_splunk_cloudwatch_transformation.handler import (
     InvalidConfigException,
+    compile_config,
+    get_config,
     get_validated_config,
+    parse_config,
+)
+from src.mbtp_splunk_cloudwatch_transformation.compile_config import (
+    main as compile_config_main,
 )
-
 
 test_configs = [
     (
@@ -169,3 +174,80 @@ def test_get_validated_config(test_config, error, mocker):
     else:
         with pytest.raises(InvalidConfigException):
             get_validated_config()
+
+
+def test_get_config_reload(mocker):
+    handler = "src.mbtp_splunk_cloudwatch_transformation.handler"
+    mocked_s3_client = boto3.client("s3", region_name=environ["AWS_REGION"])
+    s3_stubber = Stubber(mocked_s3_client)
+    expected_params = {
+        "Bucket": "CONFIG_S3_BUCKET",
+        "Key": "CONFIG_S3_KEY",
+        "IfNoneMatch": '"etag1"',
+    }
+    new_config = b"log_groups: {}\n"
+    s3_stubber.add_client_error(
+        "get_object", "304", http_status_code=304, expected_params=expected_params
+    )
+    s3_stubber.add_response(
+        "get_object",
+        {
+            "Body": StreamingBody(io.BytesIO(new_config), len(new_config)),
+            "ETag": '"etag2"',
+        },
+        expected_params,
+    )
+    s3_stubber.add_response(
+        "get_object",
+        {"Body": StreamingBody(io.BytesIO(b"foo: ["), 6), "ETag": '"etag3"'},
+        {**expected_params, "IfNoneMatch": '"etag2"'},
+    )
+    s3_stubber.activate()
+    mocker.patch(f"{handler}.s3_client", new=mocked_s3_client)
+    old_config = {"events": {}}
+    mocker.patch(f"{handler}.CONFIG", new=old_config)
+    mocker.patch(f"{handler}.CONFIG_ETAG", new='"etag1"')
+    mocker.patch(f"{handler}.CONFIG_RELOAD_SECONDS", new=60)
+    mocker.patch(f"{handler}._config_checked_at", new=0)
+    now = mocker.patch(f"{handler}.time.monotonic", return_value=30)
+
+    # Not due a check yet
+    assert get_config() is old_config
+    # Unchanged
+    now.return_value = 100
+    assert get_config() is old_config
+    # Changed
+    now.return_value = 200
+    assert get_config() == {"log_groups": {}}
+    # Changed, but invalid
+    now.return_value = 300
+    assert get_config() == {"log_groups": {}}
+    s3_stubber.assert_no_pending_responses()
+
+
+def test_compile_config(tmp_path):
+    config_yaml = test_configs[-1][0]
+    compiled = compile_config(config_yaml)
+    assert parse_config(compiled) == parse_config(config_yaml)
+
+    with pytest.raises(InvalidConfigException):
+        compile_config(config_yaml.replace("regex: .*", "regex: (", 1))
+    with pytest.raises(InvalidConfigException):
+        parse_config(
+            compiled.replace(
+                '"mbtp_splunk_compiled_config":1', '"mbtp_splunk_compiled_config":2'
+            )
+        )
+    # JSON that isn't a compiled config is parsed as YAML
+    assert parse_config('{"log_groups": {}}') == {"log_groups": {}}
+
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(config_yaml)
+    output_file = tmp_path / "config.json"
+    assert compile_config_main([str(config_file), str(output_file)]) == 0
+    assert output_file.read_text() == compiled
+    # An invalid config leaves the existing output alone
+    config_file.write_text("")
+    assert compile_config_main([str(config_file), str(output_file)]) == 1
+    assert output_file.read_text() == compiled
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["config.json", "config.yaml"]
@@ -6,9 +6,13 @@ import json
 
 from tests.test_pre_reingest import b64compress
 from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    DEADLINE_MARGIN,
+    PROCESSING_DEADLINE_MARGIN,
+    StageMetrics,
     check_required_env_vars,
     get_stats,
     lambda_handler,
+    process_cloudwatch_log_record,
 )
 import pytest
 
@@ -97,6 +101,145 @@ def test_handler(mocker):
     }
 
 
+def test_handler_stage_metrics(mocker, capsys):
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.CONFIG",
+        new=config,
+    )
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.stage_metrics",
+        new=StageMetrics(enabled=True),
+    )
+    event = {
+        "deliveryStreamArn": "ARN/STREAM_NAME",
+        "records": [
+            {"recordId": "1", "data": b64compress(data)},
+        ],
+    }
+    lambda_handler(event, {})
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    overall, by_sourcetype = sorted(documents, key=lambda d: "Sourcetype" in d)
+    assert overall["DeliveryStream"] == "STREAM_NAME"
+    assert overall["Records"] == 1
+    assert overall["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["DeliveryStream"]]
+    assert {
+        metric["Name"]: metric["Unit"]
+        for metric in overall["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    } == {
+        "Decompress": "Milliseconds",
+        "Parse": "Milliseconds",
+        "Transform": "Milliseconds",
+        "Records": "Count",
+        "Config": "Milliseconds",
+        "Process": "Milliseconds",
+        "Split": "Milliseconds",
+        "Reingest": "Milliseconds",
+        "Total": "Milliseconds",
+        "RouteCacheHits": "Count",
+        "RouteCacheMisses": "Count",
+    }
+    assert overall["RouteCacheHits"] + overall["RouteCacheMisses"] == 1
+    assert by_sourcetype["Sourcetype"] == "TEST_SOURCETYPE"
+    assert by_sourcetype["Events"] == 2
+    assert by_sourcetype["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["DeliveryStream", "Sourcetype"]
+    ]
+
+
+def test_handler_stage_metrics_disabled(mocker, capsys):
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.CONFIG",
+        new=config,
+    )
+    stage_metrics = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.stage_metrics",
+        new=StageMetrics(enabled=False),
+    )
+    perf_counter = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.time.perf_counter"
+    )
+    event = {
+        "deliveryStreamArn": "ARN/STREAM_NAME",
+        "records": [
+            {"recordId": "1", "data": b64compress(data)},
+        ],
+    }
+    lambda_handler(event, {})
+    assert capsys.readouterr().out == ""
+    perf_counter.assert_not_called()
+    assert stage_metrics.values == {}
+
+
+class FakeContext:
+    """Lambda context for an invocation with a fixed amount of time left"""
+
+    def __init__(self, remaining_seconds):
+        self.remaining_seconds = remaining_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int(self.remaining_seconds * 1000)
+
+
+def test_handler_short_deadline(mocker):
+    handler = "src.mbtp_splunk_cloudwatch_transformation.handler"
+    mocker.patch(f"{handler}.CONFIG", new=config)
+    clock = {"now": 0.0}
+    mocker.patch(f"{handler}.time.monotonic", side_effect=lambda: clock["now"])
+
+    def slow_process_cloudwatch_log_record(*args):
+        # As if every record had a slow regex
+        clock["now"] += 1
+        return process_cloudwatch_log_record(*args)
+
+    mocker.patch(
+        f"{handler}.process_cloudwatch_log_record",
+        new=slow_process_cloudwatch_log_record,
+    )
+    firehose_client = mocker.patch(f"{handler}.firehose_client")
+    firehose_client.put_record_batch.return_value = {
+        "FailedPutCount": 0,
+        "RequestResponses": [{}, {}],
+    }
+    event = {
+        "deliveryStreamArn": "ARN/STREAM_NAME",
+        "records": [{"recordId": str(i), "data": b64compress(data)} for i in range(4)],
+    }
+    # Time to transform a record and a half before it has to stop
+    context = FakeContext(DEADLINE_MARGIN + PROCESSING_DEADLINE_MARGIN + 1.5)
+
+    records = lambda_handler(event, context)["records"]
+    assert [rec["result"] for rec in records] == ["Ok", "Ok", "Dropped", "Dropped"]
+    firehose_client.put_record_batch.assert_called_once_with(
+        DeliveryStreamName="STREAM_NAME",
+        Records=[
+            {"Data": base64.b64decode(event["records"][2]["data"])},
+            {"Data": base64.b64decode(event["records"][3]["data"])},
+        ],
+    )
+
+
+def test_handler_deadline_already_passed(mocker):
+    handler = "src.mbtp_splunk_cloudwatch_transformation.handler"
+    mocker.patch(f"{handler}.CONFIG", new=config)
+    mocker.patch(f"{handler}.time.monotonic", return_value=0.0)
+    firehose_client = mocker.patch(f"{handler}.firehose_client")
+    firehose_client.put_record_batch.return_value = {
+        "FailedPutCount": 0,
+        "RequestResponses": [{}, {}],
+    }
+    event = {
+        "deliveryStreamArn": "ARN/STREAM_NAME",
+        "records": [{"recordId": str(i), "data": b64compress(data)} for i in range(3)],
+    }
+    # A timeout shorter than the margins still transforms a record per invocation
+    context = FakeContext(DEADLINE_MARGIN)
+
+    records = lambda_handler(event, context)["records"]
+    assert [rec["result"] for rec in records] == ["Ok", "Dropped", "Dropped"]
+    assert len(firehose_client.put_record_batch.call_args.kwargs["Records"]) == 2
+
+
 def test_missing_env_vars():
     """Test to check that a missing env var throws an error."""
     del environ["AWS_REGION"]
@@ -1,13 +1,35 @@
 import base64
+import binascii
 import gzip
 import json
+import zlib
+
+import pytest
 from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    MAX_RESPONSE_SIZE,
+    RESPONSE_OVERHEAD,
+    SPLIT_RECORD_OVERHEAD,
+    CloudwatchRecordStream,
+    DropLog,
+    ProcessingOptions,
+    RecordDataTooLargeException,
+    RouteCache,
+    StageMetrics,
+    compress_transformed_record,
+    decompress_record_data,
+    encode_record_data,
+    InvalidConfigException,
+    get_compiled_config,
     get_record_size,
     get_record_type,
+    is_splunk_payload,
+    match_route,
     process_cloudwatch_log_record,
     process_eventbridge_event,
     process_records,
+    process_records_parallel,
     split_cwl_record,
+    stream_cloudwatch_record_data,
 )
 
 config = {
@@ -151,6 +173,8 @@ def test_process_cloudwatch_log_record_unknown_message():
 
 def test_get_record_size():
     assert get_record_size({"foo": "bar"}) == 14
+    record = {"data": "SGVsbG8=", "result": "Ok", "recordId": "1"}
+    assert get_record_size(record) == len(json.dumps(record))
 
 
 def test_process_records_cloudwatch():
@@ -195,6 +219,198 @@ def test_process_records_cloudwatch():
     ]
 
 
+def test_process_records_reingested_transformed_records():
+    compressed_data = base64.b64encode(gzip.compress(json.dumps(data).encode()))
+    (processed,) = process_records(
+        [{"data": compressed_data, "recordId": "1"}], "ARN", config
+    )
+    reingested = compress_transformed_record(processed)
+    assert gzip.decompress(reingested).count(b"\n") == len(transformed_logs) - 1
+
+    test_records = [
+        {"data": base64.b64encode(reingested), "recordId": "2"},
+        {"data": base64.b64encode(b'{"foo": "bar"}\n{"foo": "bar"}'), "recordId": "3"},
+    ]
+    assert process_records(test_records, "ARN", config) == [
+        {"result": "Ok", "recordId": "2", "data": processed["data"]},
+        {"result": "ProcessingFailed", "recordId": "3"},
+    ]
+
+
+def test_compress_transformed_record(mocker):
+    assert compress_transformed_record({"data": ""}) is None
+    data = base64.b64encode(b"x" * 1_000).decode()
+    assert gzip.decompress(compress_transformed_record({"data": data})) == b"x" * 1_000
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.MAX_REINGESTION_RECORD_SIZE",
+        new=10,
+    )
+    assert compress_transformed_record({"data": data}) is None
+
+
+@pytest.mark.parametrize("worker_type", ["thread", "process"])
+def test_process_records_parallel(worker_type):
+    test_records = [
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": str(i),
+        }
+        for i in range(5)
+    ]
+    test_records.insert(
+        2,
+        {
+            "data": base64.b64encode(
+                gzip.compress(json.dumps({"foo": "bar"}).encode())
+            ),
+            "recordId": "unknown",
+        },
+    )
+    expected_details = []
+    expected = process_records(test_records, "ARN", config, expected_details)
+
+    record_details = []
+    assert (
+        process_records_parallel(
+            test_records,
+            "ARN",
+            config,
+            record_details,
+            options=ProcessingOptions(workers=4, worker_type=worker_type),
+        )
+        == expected
+    )
+    assert record_details == expected_details
+
+
+def test_process_records_parallel_counts_drops(mocker):
+    drop_log = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.drop_log", new=DropLog()
+    )
+    denying_config = {
+        **config,
+        "sourcetypes": {"TEST_SOURCETYPE": {"denylist_regexes": ["log message 1"]}},
+    }
+    test_records = [
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": str(i),
+        }
+        for i in range(4)
+    ]
+    process_records_parallel(
+        test_records, "ARN", denying_config, options=ProcessingOptions(workers=2)
+    )
+    assert drop_log.counts == {("TEST_SOURCETYPE", "log message 1"): 4}
+
+
+def test_process_records_parallel_stage_metrics(mocker):
+    stage_metrics = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.stage_metrics",
+        new=StageMetrics(enabled=True),
+    )
+    test_records = [
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": str(i),
+        }
+        for i in range(4)
+    ]
+    process_records_parallel(
+        test_records, "ARN", config, options=ProcessingOptions(workers=2)
+    )
+    assert stage_metrics.values[None]["Records"] == 4
+    assert stage_metrics.values["TEST_SOURCETYPE"]["Events"] == 8
+    assert set(stage_metrics.values["TEST_SOURCETYPE"]) == {
+        "Route",
+        "Filter",
+        "Redact",
+        "Serialise",
+        "Events",
+    }
+
+
+def test_process_records_parallel_warms_route_cache(mocker):
+    stage_metrics = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.stage_metrics",
+        new=StageMetrics(enabled=True),
+    )
+    test_config = dict(config)
+    compiled_config = get_compiled_config(test_config)
+    test_records = [
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": str(i),
+        }
+        for i in range(4)
+    ]
+    process_records_parallel(
+        test_records, "ARN", test_config, options=ProcessingOptions(workers=2)
+    )
+    # The routes the workers resolved are kept, without being counted again
+    assert compiled_config.match_log_stream.cache_info() == (0, 0, 4096, 1)
+    assert stage_metrics.take()[None]["RouteCacheMisses"] == 2
+
+    # So the next workers find them
+    process_records_parallel(
+        test_records, "ARN", test_config, options=ProcessingOptions(workers=2)
+    )
+    assert stage_metrics.take()[None] == {
+        "Decompress": mocker.ANY,
+        "Parse": mocker.ANY,
+        "Transform": mocker.ANY,
+        "Records": 4,
+        "RouteCacheHits": 4,
+        "RouteCacheMisses": 0,
+    }
+
+
+def test_route_cache():
+    resolved = []
+
+    def resolve(*key):
+        resolved.append(key)
+        return key[0] or None
+
+    cache = RouteCache(resolve, maxsize=2)
+    assert [cache("a"), cache("b"), cache("a"), cache("")] == ["a", "b", "a", None]
+    # "b" was the least recently used
+    assert cache("b") == "b"
+    assert resolved == [("a",), ("b",), ("",), ("b",)]
+    assert cache.cache_info() == (1, 4, 2, 2)
+
+    # Only as many new results as the cache holds are kept to be taken
+    new = cache.take_new()
+    assert new == {("b",): "b", ("",): None}
+    assert cache.take_new() == {}
+    other = RouteCache(resolve)
+    other.merge(new)
+    assert other.cache_info() == (0, 0, 4096, 2)
+    assert other("b") == "b"
+    assert other.cache_info().hits == 1
+
+    # A size of 0 doesn't cache anything
+    cache = RouteCache(resolve, maxsize=0)
+    cache("a")
+    cache("a")
+    assert cache.cache_info() == (0, 2, 0, 0)
+
+
+def test_process_records_parallel_errors():
+    test_records = [{"data": "not base64", "recordId": str(i)} for i in range(2)]
+    with pytest.raises(binascii.Error):
+        process_records_parallel(
+            test_records, "ARN", config, options=ProcessingOptions(workers=2)
+        )
+    with pytest.raises(ValueError):
+        process_records_parallel(
+            test_records,
+            "ARN",
+            config,
+            options=ProcessingOptions(workers=2, worker_type="fibre"),
+        )
+
+
 def test_split_cwl_record():
     result = [
         {
@@ -232,6 +448,46 @@ def test_split_cwl_record():
     ]
 
 
+def test_split_cwl_record_by_event_size():
+    data = {
+        "logGroup": "TEST_LOG_GROUP",
+        "logEvents": [{"id": str(i)} for i in range(5)],
+    }
+    # Each split record can take half of what's left after the response wrapper,
+    # leaving room for 300 bytes of transformed data
+    max_return_size = 15 + 2 * (SPLIT_RECORD_OVERHEAD + 400)
+
+    def split_ids(event_sizes):
+        return [
+            [e["id"] for e in json.loads(gzip.decompress(r))["logEvents"]]
+            for r in split_cwl_record(data, event_sizes, max_return_size)
+        ]
+
+    # Dropped events take no space
+    assert split_ids([100, 0, 199, 300, 0]) == [["0", "1", "2"], ["3", "4"]]
+    assert split_ids([300, 300, 300, 300, 300]) == [["0"], ["1"], ["2"], ["3"], ["4"]]
+    # Falls back to halving if it all fits, or the sizes don't match the events
+    assert split_ids([1, 1, 1, 1, 1]) == [["0", "1"], ["2", "3", "4"]]
+    assert split_ids([300]) == [["0", "1"], ["2", "3", "4"]]
+
+
+def test_split_cwl_record_leaves_room_for_other_records():
+    data = {
+        "logGroup": "TEST_LOG_GROUP",
+        "logEvents": [{"id": str(i)} for i in range(10)],
+    }
+    event_sizes = [1_000_000] * 10
+    split_records = split_cwl_record(data, event_sizes)
+    assert len(split_records) == 5
+    for split_record in split_records:
+        chunk_size = sum(
+            event_sizes[int(e["id"])] + 1
+            for e in json.loads(gzip.decompress(split_record))["logEvents"]
+        )
+        returned_size = (chunk_size - 1 + 2) // 3 * 4 + SPLIT_RECORD_OVERHEAD
+        assert returned_size <= (MAX_RESPONSE_SIZE - RESPONSE_OVERHEAD) / 2
+
+
 def test_get_record_type():
     assert (
         get_record_type(
@@ -455,3 +711,398 @@ def test_process_records_eventbridge():
             ).decode(),
         }
     ]
+
+
+def test_compiled_config_first_match_wins():
+    test_config = {
+        "log_groups": {
+            "first": {
+                "log_group": "TEST_LOG_GROUP",
+                "accounts": ["123456789012"],
+                "index": "FIRST_INDEX",
+                "log_streams": [{"regex": "^TEST_", "sourcetype": "FIRST"}],
+            },
+            "second": {
+                "log_group": "TEST_LOG_GROUP",
+                "accounts": ["123456789012", "210987654321"],
+                "index": "SECOND_INDEX",
+                "log_streams": [{"regex": ".*", "sourcetype": "SECOND"}],
+            },
+        },
+        "sourcetypes": {},
+    }
+    routes = get_compiled_config(test_config).log_groups["TEST_LOG_GROUP"]
+    assert match_route(routes, "123456789012", "TEST_STREAM") == (
+        "FIRST_INDEX",
+        "FIRST",
+    )
+    assert match_route(routes, "123456789012", "OTHER_STREAM") == (
+        "SECOND_INDEX",
+        "SECOND",
+    )
+    assert match_route(routes, "210987654321", "TEST_STREAM") == (
+        "SECOND_INDEX",
+        "SECOND",
+    )
+    assert match_route(routes, "000000000000", "TEST_STREAM") is None
+
+
+def test_compiled_config_is_reused():
+    assert get_compiled_config(config) is get_compiled_config(config)
+    assert get_compiled_config(config) is not get_compiled_config(dict(config))
+
+
+def test_compiled_config_route_cache():
+    test_config = dict(config)
+    compiled_config = get_compiled_config(test_config)
+    assert compiled_config.route_cache_info() == (0, 0)
+
+    for _ in range(3):
+        assert process_cloudwatch_log_record(data, "123", "ARN", test_config)
+    assert process_cloudwatch_log_record(
+        {**data, "logStream": "OTHER_LOG_STREAM"}, "123", "ARN", test_config
+    ) == {"result": "Dropped", "recordId": "123"}
+    assert compiled_config.match_log_stream.cache_info().hits == 2
+    assert compiled_config.match_log_stream.cache_info().misses == 2
+
+    event = {
+        "source": "aws.tag",
+        "account": "123456789012",
+        "detail-type": "Tag Change on Resource",
+        "time": "2025-03-05T11:05:23Z",
+    }
+    for _ in range(2):
+        process_eventbridge_event(event, "123", "ARN", test_config)
+    assert compiled_config.route_cache_info() == (3, 3)
+
+    # A new config starts with an empty cache
+    assert get_compiled_config(dict(config)).route_cache_info() == (0, 0)
+
+
+def test_compiled_config_invalid_regex():
+    test_config = {
+        "events": {
+            "test_config": {
+                "event_source": "aws.tag",
+                "accounts": ["123456789012"],
+                "index": "TEST_INDEX",
+                "detail_types": [{"regex": "(", "sourcetype": "TEST_SOURCETYPE"}],
+            }
+        },
+    }
+    with pytest.raises(InvalidConfigException):
+        get_compiled_config(test_config)
+
+
+def test_process_records_record_details():
+    compressed_data = base64.b64encode(gzip.compress(json.dumps(data).encode()))
+    unknown_record_compressed = base64.b64encode(
+        gzip.compress(json.dumps({"foo": "bar"}).encode())
+    )
+    test_records = [
+        {"data": compressed_data, "recordId": "1"},
+        {"data": unknown_record_compressed, "recordId": "2"},
+    ]
+    record_details = []
+    processed = process_records(test_records, "ARN", config, record_details)
+    assert record_details == [{"size": len(json.dumps(x))} for x in processed]
+
+
+def test_cloudwatch_record_stream():
+    streamed_data = {
+        **data,
+        "logEvents": [
+            {"id": str(i), "timestamp": 1510109208016 + i, "message": f"é {i} " * i}
+            for i in range(50)
+        ],
+    }
+    stream = CloudwatchRecordStream(
+        gzip.compress(json.dumps(streamed_data, ensure_ascii=False).encode()),
+        chunk_size=64,
+    )
+    header = stream.read_header()
+    assert header == {
+        key: value for key, value in streamed_data.items() if key != "logEvents"
+    }
+
+    events = []
+    for event in stream.events():
+        events.append(event)
+        # Only the data not yet parsed, plus a chunk or so, is kept
+        assert len(stream._buffer) < 600
+    assert events == streamed_data["logEvents"]
+
+
+def test_stream_cloudwatch_record_data():
+    streamed = stream_cloudwatch_record_data(
+        base64.b64encode(gzip.compress(json.dumps(data).encode()))
+    )
+    assert list(streamed.pop("logEvents")) == data["logEvents"]
+    assert streamed == {k: v for k, v in data.items() if k != "logEvents"}
+
+    # Records that aren't gzipped Cloudwatch records are left to be decoded as usual
+    assert (
+        stream_cloudwatch_record_data(base64.b64encode(json.dumps(data).encode()))
+        is None
+    )
+    assert (
+        stream_cloudwatch_record_data(
+            base64.b64encode(gzip.compress(json.dumps({"foo": "bar"}).encode()))
+        )
+        is None
+    )
+
+
+def test_process_records_streaming_parse(mocker):
+    test_records = [
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": "1",
+        },
+        {
+            "data": base64.b64encode(json.dumps(data).encode()),
+            "recordId": "2",
+        },
+        {
+            # Not routed, so the invalid log events are never parsed
+            "data": base64.b64encode(
+                gzip.compress(
+                    json.dumps({**data, "logGroup": "UNKNOWN"})
+                    .replace('"logEvents": [', '"logEvents": [not json')
+                    .encode()
+                )
+            ),
+            "recordId": "3",
+        },
+    ]
+    expected = process_records(test_records[:2], "ARN", config)
+
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.STREAMING_PARSE", new=True
+    )
+    assert process_records(test_records, "ARN", config) == [
+        *expected,
+        {"result": "Dropped", "recordId": "3"},
+    ]
+
+
+def streamed_record(payload: bytes) -> dict:
+    return {"data": base64.b64encode(gzip.compress(payload)), "recordId": "1"}
+
+
+def corrupt_crc(compressed: bytes) -> bytes:
+    compressed = bytearray(compressed)
+    # The CRC is the first half of the 8 byte gzip trailer
+    compressed[-8] ^= 0xFF
+    return bytes(compressed)
+
+
+# Enough log events for the end of the record to be streamed well after the header
+many_events = json.dumps(
+    {
+        **data,
+        "logEvents": [
+            {"id": str(i), "timestamp": i, "message": "x" * 100} for i in range(1000)
+        ]
+        + [{"id": "last", "timestamp": 0, "message": "LAST"}],
+    }
+).encode()
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        streamed_record(
+            json.dumps(data)
+            .replace('"logEvents": [', '"logEvents": [not json')
+            .encode()
+        ),
+        # Invalid UTF-8 in a log event
+        streamed_record(many_events.replace(b"LAST", b"\xff")),
+        {
+            "data": base64.b64encode(corrupt_crc(gzip.compress(many_events))),
+            "recordId": "1",
+        },
+    ],
+)
+def test_process_records_streaming_parse_malformed(mocker, record):
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.STREAMING_PARSE", new=True
+    )
+    assert process_records([record], "ARN", config) == [
+        {"result": "ProcessingFailed", "recordId": "1"}
+    ]
+
+
+def test_encode_record_data():
+    output = bytearray(b"event 1\nevent 2")
+    assert encode_record_data(output) == base64.b64encode(b"event 1\nevent 2").decode()
+    # The bytearray is freed once it's been encoded
+    assert output == bytearray()
+    assert encode_record_data(b"") == ""
+
+
+def test_is_splunk_payload():
+    events = [json.dumps(log).encode() for log in transformed_logs]
+    assert is_splunk_payload(events[0])
+    assert is_splunk_payload(b"\n".join(events))
+    assert is_splunk_payload(b'{"index": "a", "sourcetype": "b\\"c", "event": {}}')
+
+    assert not is_splunk_payload(events[0][:-1])
+    assert not is_splunk_payload(b"\n".join([events[0], events[1][:-10]]))
+    assert not is_splunk_payload(b'{"index": "a", "sourcetype": "b", "time": "1"}')
+    assert not is_splunk_payload(b'{"sourcetype": "b", "index": "a", "event": {}}')
+    assert not is_splunk_payload(b"\n".join([events[0], b"{}", events[1]]))
+    assert not is_splunk_payload(json.dumps(data).encode())
+    assert not is_splunk_payload(b"")
+
+
+def test_process_records_splunk_passthrough(mocker):
+    payload = "\n".join(json.dumps(log) for log in transformed_logs).encode()
+    test_records = [
+        {"data": base64.b64encode(payload).decode(), "recordId": "1"},
+        {"data": base64.b64encode(gzip.compress(payload)), "recordId": "2"},
+        {"data": base64.b64encode(zlib.compress(payload)), "recordId": "3"},
+    ]
+    dumps = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.json.dumps",
+        wraps=json.dumps,
+    )
+    assert process_records(test_records, "ARN", config) == [
+        # Uncompressed data is returned as it came
+        {"result": "Ok", "recordId": "1", "data": test_records[0]["data"]},
+        {"result": "Ok", "recordId": "2", "data": test_records[0]["data"]},
+        {"result": "Ok", "recordId": "3", "data": test_records[0]["data"]},
+    ]
+    # They're forwarded without being serialised again
+    dumps.assert_not_called()
+
+
+malformed_splunk_lines = [
+    # Truncated
+    json.dumps(transformed_logs[0])[:-1].encode(),
+    # Bad JSON that still ends in a closing brace
+    json.dumps(transformed_logs[0])
+    .replace('"log message 1"}', '"log message 1"}}')
+    .encode(),
+    json.dumps(transformed_logs[0]).replace('"log message 1"', "]]]").encode(),
+    # Invalid UTF-8 in the event
+    json.dumps(transformed_logs[0]).encode().replace(b"log message", b"\xff\xfe"),
+]
+
+
+@pytest.mark.parametrize("compress", [lambda x: x, gzip.compress, zlib.compress])
+@pytest.mark.parametrize(
+    "payload",
+    [
+        *malformed_splunk_lines,
+        # One bad line among good ones
+        *(
+            b"\n".join([json.dumps(transformed_logs[1]).encode(), line])
+            for line in malformed_splunk_lines
+        ),
+        b"\n".join(
+            [
+                json.dumps(transformed_logs[0]).encode(),
+                b'{"index": "TEST_INDEX", "sourcetype": "TEST_SOURCETYPE", "event": 1}'
+                b', {"index": "TEST_INDEX"}',
+            ]
+        ),
+    ],
+)
+def test_process_records_malformed_splunk_payload(compress, payload):
+    assert not is_splunk_payload(payload)
+    test_records = [{"data": base64.b64encode(compress(payload)), "recordId": "1"}]
+    assert process_records(test_records, "ARN", config) == [
+        {"result": "ProcessingFailed", "recordId": "1"}
+    ]
+
+
+@pytest.mark.parametrize("payload", [b'{"a": "b"', b'{"a": "\xff"}'])
+def test_process_records_invalid_payload(payload):
+    test_records = [{"data": base64.b64encode(payload), "recordId": "1"}]
+    assert process_records(test_records, "ARN", config) == [
+        {"result": "ProcessingFailed", "recordId": "1"}
+    ]
+
+
+def test_decompress_record_data():
+    payload = json.dumps(data).encode()
+    assert decompress_record_data(gzip.compress(payload)) == payload
+    assert decompress_record_data(zlib.compress(payload)) == payload
+    assert decompress_record_data(payload) == payload
+    assert decompress_record_data(b"") == b""
+    # JSON numbers that look like a zlib header
+    assert decompress_record_data(b"80") == b"80"
+    assert decompress_record_data(b"8015") == b"8015"
+    # Every zlib window except 2KiB, which starts with "8"
+    for wbits in [9, 10, 12, 13, 14, 15]:
+        compressor = zlib.compressobj(wbits=wbits)
+        compressed = compressor.compress(payload) + compressor.flush()
+        assert decompress_record_data(compressed) == payload
+    # Gzip members one after another
+    assert decompress_record_data(gzip.compress(b"a") + gzip.compress(b"b")) == b"ab"
+
+    with pytest.raises(RecordDataTooLargeException):
+        decompress_record_data(gzip.compress(b"x" * 1_000_000), 999_999)
+    assert decompress_record_data(gzip.compress(b"x" * 1_000), 1_000) == b"x" * 1_000
+    with pytest.raises(EOFError):
+        decompress_record_data(gzip.compress(payload)[:-20])
+
+
+@pytest.mark.parametrize("streaming_parse", [False, True])
+@pytest.mark.parametrize(
+    "compressed",
+    [
+        # Truncated
+        gzip.compress(json.dumps(data).encode())[:-20],
+        zlib.compress(json.dumps(data).encode())[:-20],
+        # Corrupt
+        gzip.compress(json.dumps(data).encode())[:10] + b"garbage",
+        zlib.compress(json.dumps(data).encode())[:2] + b"garbage",
+    ],
+)
+def test_process_records_malformed_compressed_data(mocker, streaming_parse, compressed):
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.STREAMING_PARSE",
+        new=streaming_parse,
+    )
+    test_records = [
+        {"data": base64.b64encode(compressed), "recordId": "1"},
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": "2",
+        },
+    ]
+    assert [rec["result"] for rec in process_records(test_records, "ARN", config)] == [
+        "ProcessingFailed",
+        "Ok",
+    ]
+
+
+@pytest.mark.parametrize("streaming_parse", [False, True])
+def test_process_records_too_large_to_decompress(mocker, streaming_parse):
+    handler = "src.mbtp_splunk_cloudwatch_transformation.handler"
+    mocker.patch(f"{handler}.STREAMING_PARSE", new=streaming_parse)
+    mocker.patch(f"{handler}.MAX_DECOMPRESSED_RECORD_BYTES", new=10_000)
+    big_data = {
+        **data,
+        "logEvents": [
+            {"id": str(i), "timestamp": 1510109208016, "message": "x" * 100}
+            for i in range(200)
+        ],
+    }
+    test_records = [
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(big_data).encode())),
+            "recordId": "1",
+        },
+        {
+            "data": base64.b64encode(gzip.compress(json.dumps(data).encode())),
+            "recordId": "2",
+        },
+    ]
+    assert [rec["result"] for rec in process_records(test_records, "ARN", config)] == [
+        "ProcessingFailed",
+        "Ok",
+    ]
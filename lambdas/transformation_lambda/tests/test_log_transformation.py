@@ -1,5 +1,13 @@
+import json
+import logging
+
 import pytest
 from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    DropLog,
+    Redactor,
+    RegexSet,
+    get_envelope_template,
+    serialise_event,
     is_json,
     load_firehose_record_data,
     transform_event_to_splunk,
@@ -206,3 +214,211 @@ def test_transform_event_to_splunk(data, sourcetype, expected_event):
         )
 
     assert transform_event_to_splunk(**default_params) == expected_result
+
+
+test_regex_sets = [
+    (["foo", "bar", "baz"], "xx bar baz", 1),
+    (["foo", "bar"], "nothing here", None),
+    ([], "anything", None),
+    # Groups inside patterns don't affect which pattern is reported
+    (["(a)(b)c", "(?P<x>d)e", "f"], "def", 1),
+    # Backreferences and global flags are checked on their own
+    ([r"(\w)\1", "(?i)hello"], "HeLlO", 1),
+    ([r"(\w)\1", "(?i)hello"], "aa", 0),
+    # Duplicate group names can't be combined into one regex
+    (["(?P<x>a)", "(?P<x>b)"], "b", 1),
+    # The first pattern in the list that matches is reported, wherever it matches
+    (["ERROR", "DEBUG"], "DEBUG then ERROR", 0),
+    (["foo", "bar", "baz"], "baz bar foo", 0),
+    ([r"(\w)\1", "foo", "bar"], "bar foo xx", 0),
+    (["zzz", r"(\w)\1", "bar"], "bar xx", 1),
+    (["zzz", r"(\w)\1", "bar"], "bar", 2),
+]
+
+
+@pytest.mark.parametrize("patterns,string,expected", test_regex_sets)
+def test_regex_set(patterns, string, expected):
+    assert RegexSet(patterns).search(string) == expected
+
+
+def test_transform_empty_allowlist_drops_everything():
+    assert (
+        transform_event_to_splunk(
+            "1234",
+            "HI",
+            "INDEX",
+            {"allowlist_regexes": []},
+            "SOURCETYPE",
+            "ARN",
+            "ACCOUNT_ID",
+            "LOG_GROUP",
+        )
+        is None
+    )
+
+
+def test_transform_drops_are_counted(mocker):
+    drop_log = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.drop_log", new=DropLog()
+    )
+    sourcetype = {"denylist_regexes": ["foo", "bar"], "allowlist_regexes": ["baz"]}
+    for event in ["foo", "bar", "bar", "baz", "qux"]:
+        transform_event_to_splunk(
+            "1234",
+            event,
+            "INDEX",
+            sourcetype,
+            "SOURCETYPE",
+            "ARN",
+            "ACCOUNT_ID",
+            "LOG_GROUP",
+        )
+    assert drop_log.counts == {
+        ("SOURCETYPE", "foo"): 1,
+        ("SOURCETYPE", "bar"): 2,
+        ("SOURCETYPE", None): 1,
+    }
+
+
+def test_drop_log(caplog):
+    drop_log = DropLog(max_samples=2)
+    for i in range(3):
+        drop_log.add("SOURCETYPE", "foo", f"foo {i}")
+    other = DropLog()
+    other.add("SOURCETYPE", "foo", "foo 3")
+    other.add("SOURCETYPE", None, "qux")
+    drop_log.merge(*other.take())
+    assert other.counts == {}
+    assert drop_log.counts == {("SOURCETYPE", "foo"): 4, ("SOURCETYPE", None): 1}
+    assert drop_log.samples == {
+        ("SOURCETYPE", "foo"): ["foo 0", "foo 1"],
+        ("SOURCETYPE", None): ["qux"],
+    }
+
+    with caplog.at_level(logging.INFO):
+        drop_log.flush()
+    assert caplog.records[0].drops == {"SOURCETYPE": {"foo": 4, "allowlist": 1}}
+    assert [r.getMessage() for r in caplog.records[1:]] == [
+        "Dropped SOURCETYPE log due to matching foo. Log = foo 0",
+        "Dropped SOURCETYPE log due to matching foo. Log = foo 1",
+        "Dropped SOURCETYPE log because it did not match any allowlist regexes. Log = qux",
+    ]
+    assert drop_log.counts == {}
+
+    # Nothing is logged if INFO isn't enabled
+    caplog.clear()
+    drop_log.add("SOURCETYPE", "foo", "foo")
+    with caplog.at_level(logging.WARNING):
+        drop_log.flush()
+    assert caplog.records == []
+
+
+test_redactions = [
+    # Every match is redacted, not just the first
+    (["(PII)"], "PII and PII", "<0> and <0>"),
+    # Matches from different regexes are redacted in one go
+    (["(foo)", r"id=(\d+)"], "foo id=123 foo id=4", "<0> id=<1> <0> id=<1>"),
+    # Regexes without groups, or that don't match, leave the string alone
+    (["PII", "(nothing)"], "PII", "PII"),
+    # Each group of a regex is redacted
+    ([r"(\w+)@(\w+)"], "a@b c", "<0>@<0> c"),
+    # Overlapping spans are only redacted once
+    (["((a)b)", "(b)"], "ab b", "<0> <1>"),
+    # Regexes which can't be combined are still applied
+    ([r"(\w)\1", "(x)"], "aa x", "<0>a <1>"),
+    # A match of one regex doesn't hide a match of another starting inside it
+    (
+        [r"key=(\w+) secret=\w+", r"secret=(\w+)"],
+        "key=abc secret=xyz",
+        "key=<0> secret=<1>",
+    ),
+]
+
+
+@pytest.mark.parametrize("patterns,string,expected", test_redactions)
+def test_redactor(patterns, string, expected):
+    for i in range(len(patterns)):
+        expected = expected.replace(
+            f"<{i}>", f"***REDACTED BY ST.redact_regexes.{i}***"
+        )
+    assert Redactor(patterns).redact(string, "ST") == expected
+
+
+golden_routes = [
+    ("INDEX", "SOURCETYPE", "LOG_GROUP", "123456789012", "LOG_STREAM", "ARN"),
+    ("INDEX", "SOURCETYPE", "aws.tag", "123456789012", None, "ARN"),
+    ("INDEX", "SOURCETYPE", "LOG_GROUP", "123456789012", "", "ARN"),
+    (
+        'IN"DEX',
+        "SOURCE\\TYPE",
+        "/aws/lambda/ünïcode",
+        "123456789012",
+        "2025/03/05/[$LATEST]\t\n",
+        "arn:aws:firehose:eu-west-2:123456789012:deliverystream/STREAM_NAME",
+    ),
+]
+golden_events = [
+    "log message",
+    '{"foo": "bar", "nested": {"list": [1, 2.5, null, true]}}',
+    'ünïcode "quoted" \\ back\\slash \x00 control',
+    "12345",
+    {"time": "1234", "source": "aws.tag", "detail": {"tags": {"ü": "\n"}}},
+]
+
+
+@pytest.mark.parametrize("route", golden_routes)
+@pytest.mark.parametrize("event", golden_events)
+def test_envelope_template_golden(route, event):
+    index, sourcetype_name, source, account_id, log_stream, firehose_arn = route
+    log = json.dumps(event) if isinstance(event, dict) else event
+    try:
+        log = json.loads(log)
+    except ValueError:
+        pass
+    new_log = {
+        "index": index,
+        "sourcetype": sourcetype_name,
+        "time": "1510109208016",
+        "host": firehose_arn,
+        "source": source,
+        "fields": {"aws_account_id": account_id},
+        "event": log,
+    }
+    if log_stream:
+        new_log["fields"]["cw_log_stream"] = log_stream
+
+    assert transform_event_to_splunk(
+        "1510109208016",
+        event,
+        index,
+        {},
+        sourcetype_name,
+        firehose_arn,
+        account_id,
+        source,
+        log_stream,
+    ) == json.dumps(new_log)
+    assert get_envelope_template(*route) is get_envelope_template(*route)
+
+
+test_serialised_events = [
+    ("log message", False, b'"log message"'),
+    ("", False, b'""'),
+    ("123", False, b"123"),
+    ("true story", False, b'"true story"'),
+    ('{"foo":"bar"}', False, b'{"foo": "bar"}'),
+    ('{"foo":"bar"}', True, b'{"foo":"bar"}'),
+    ("[1,2, 3]", True, b"[1,2, 3]"),
+    ('{"foo": "bär"}', True, '{"foo": "bär"}'.encode()),
+    # Invalid JSON is still sent as a string
+    ('{"foo":', True, b'"{\\"foo\\":"'),
+    # Line breaks would split the event up, so it's re-serialised
+    ('{\n  "foo": "bar"\n}', True, b'{"foo": "bar"}'),
+    # Only objects and arrays are spliced
+    ("12.50", True, b"12.5"),
+]
+
+
+@pytest.mark.parametrize("log,raw_json_splice,expected", test_serialised_events)
+def test_serialise_event(log, raw_json_splice, expected):
+    assert serialise_event(log, raw_json_splice) == expected
@@ -2,7 +2,13 @@ import base64
 import gzip
 import json
 from unittest import mock
+import pytest
 from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    PackingOptions,
+    ProcessingOptions,
+    decode_firehose_record_data,
+    get_record_size,
+    process_records,
     work_out_records_to_reingest,
 )
 
@@ -46,8 +52,9 @@ def test_work_out_records_to_reingest():
         {"result": "Ok", "recordId": "3", "data": ""},
         {"result": "Dropped", "recordId": "4", "data": ""},
     ]
-    # Each record is 45 bytes so 100 bytes max should cause one to be reingested
-    assert work_out_records_to_reingest(event, records, 100) == [[{"Data": mock.ANY}]]
+    # The response wrapper and all the records without their data come to 185 bytes,
+    # and each Ok record's data adds 7 bytes, so 200 bytes max should cause one to be reingested
+    assert work_out_records_to_reingest(event, records, 200) == [[{"Data": mock.ANY}]]
     assert records[2]["result"] == "Dropped"
     assert "data" not in records[2]
 
@@ -131,3 +138,254 @@ def test_work_out_records_to_reingest_large_non_cloudwatch():
     assert work_out_records_to_reingest(event, records, 1) == []
     assert records[0]["result"] == "ProcessingFailed"
     assert "data" not in records[0]
+
+
+def test_work_out_records_to_reingest_fills_response_exactly():
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [],
+    }
+    event = {"records": [{"data": b64compress(data)} for _ in range(3)]}
+    records = [
+        {"data": "A" * 1000, "result": "Ok", "recordId": str(i)} for i in range(3)
+    ]
+    record_details = [{"size": get_record_size(rec)} for rec in records]
+    # Exactly enough room to return two of the records
+    max_return_size = (
+        len(json.dumps({"records": records[:2]}))
+        + len(", ")
+        + len(json.dumps({"result": "Dropped", "recordId": "2"}))
+    )
+
+    assert work_out_records_to_reingest(
+        event, records, max_return_size, record_details
+    ) == [[{"Data": mock.ANY}]]
+    assert [rec["result"] for rec in records] == ["Ok", "Ok", "Dropped"]
+    assert len(json.dumps({"records": records})) == max_return_size
+
+
+@pytest.mark.parametrize(
+    "packing_strategy,returned",
+    [
+        ("in_order", ["Ok", "Ok", "Dropped"]),
+        ("max_bytes", ["Dropped", "Ok", "Ok"]),
+        ("min_records", ["Ok", "Dropped", "Ok"]),
+    ],
+)
+def test_work_out_records_to_reingest_packing_strategy(packing_strategy, returned):
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [],
+    }
+    event = {"records": [{"data": b64compress(data)} for _ in range(3)]}
+    records = [
+        {"data": "A" * size, "result": "Ok", "recordId": str(i)}
+        for i, size in enumerate([2000, 5000, 4000])
+    ]
+    record_details = [{"size": get_record_size(rec)} for rec in records]
+    # Exactly enough room to return the last two records
+    max_return_size = (
+        len(json.dumps({"records": records[1:]}))
+        + len(", ")
+        + len(json.dumps({"result": "Dropped", "recordId": "0"}))
+    )
+
+    reingested = work_out_records_to_reingest(
+        event,
+        records,
+        max_return_size,
+        record_details,
+        options=PackingOptions(packing_strategy),
+    )
+    assert [rec["result"] for rec in records] == returned
+    assert reingested == [[{"Data": mock.ANY}]]
+    assert len(json.dumps({"records": records})) <= max_return_size
+
+
+def test_work_out_records_to_reingest_unknown_packing_strategy():
+    with pytest.raises(ValueError):
+        work_out_records_to_reingest(
+            {"records": []}, [], 1000, [], PackingOptions("random")
+        )
+
+
+def test_work_out_records_to_reingest_reuses_decoded_data(mocker):
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [
+            {"id": "1", "timestamp": 1510109208016, "message": "log message 1"},
+            {"id": "2", "timestamp": 1510109208017, "message": "log message 2"},
+        ],
+    }
+    event = {"records": [{"data": b64compress(data), "recordId": "1"}]}
+    records = [{"result": "Ok", "recordId": "1", "data": ""}]
+    record_details = [{"size": 1_000, "decoded": json.dumps(data).encode()}]
+    load = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.load_firehose_record_data"
+    )
+
+    assert work_out_records_to_reingest(event, records, 100, record_details) == [
+        [{"Data": mock.ANY}, {"Data": mock.ANY}]
+    ]
+    load.assert_not_called()
+    assert record_details == [{"size": 1_000}]
+
+
+def test_process_records_keeps_decoded_oversized_records(mocker):
+    config = {
+        "log_groups": {
+            "test_config": {
+                "log_group": "TEST_LOG_GROUP",
+                "accounts": ["123456789012"],
+                "index": "TEST_INDEX",
+                "log_streams": [{"regex": ".*", "sourcetype": "TEST_SOURCETYPE"}],
+            }
+        },
+    }
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [
+            {"id": "1", "timestamp": 1510109208016, "message": "log message 1"}
+        ],
+    }
+    records = [{"data": b64compress(data), "recordId": str(i)} for i in range(2)]
+
+    record_details = []
+    process_records(records, "ARN", config, record_details, ProcessingOptions(100))
+    payload = json.dumps(data).encode()
+    assert [details["decoded"] for details in record_details] == [payload, payload]
+    assert [len(details["event_sizes"]) for details in record_details] == [1, 1]
+
+    # Nothing is kept if it doesn't fit in the cache
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.DECODED_RECORD_CACHE_BYTES",
+        new=len(json.dumps(data)),
+    )
+    record_details = []
+    process_records(records, "ARN", config, record_details, ProcessingOptions(100))
+    assert ["decoded" in details for details in record_details] == [True, False]
+
+    # Or if the records can be returned
+    record_details = []
+    process_records(records, "ARN", config, record_details)
+    assert ["decoded" in details for details in record_details] == [False, False]
+
+
+def test_work_out_records_to_reingest_splits_by_event_size():
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [
+            {"id": str(i), "timestamp": 1510109208016, "message": f"log message {i}"}
+            for i in range(6)
+        ],
+    }
+    event = {"records": [{"data": b64compress(data), "recordId": "1"}]}
+    records = [{"result": "Ok", "recordId": "1", "data": ""}]
+    # Each record has room for 300 bytes of transformed data, so two events each
+    record_details = [{"size": 10_000, "event_sizes": [150] * 6}]
+
+    reingested = work_out_records_to_reingest(event, records, 1449, record_details)
+    assert len(reingested[0]) == 3
+    assert [
+        [e["id"] for e in json.loads(gzip.decompress(r["Data"]))["logEvents"]]
+        for r in reingested[0]
+    ] == [["0", "1"], ["2", "3"], ["4", "5"]]
+
+
+def test_process_records_streaming_budget(mocker):
+    config = {
+        "log_groups": {
+            "test_config": {
+                "log_group": "TEST_LOG_GROUP",
+                "accounts": ["123456789012"],
+                "index": "TEST_INDEX",
+                "log_streams": [{"regex": ".*", "sourcetype": "TEST_SOURCETYPE"}],
+            }
+        },
+    }
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [
+            {"id": "1", "timestamp": 1510109208016, "message": "log message 1"}
+        ],
+    }
+    event = {
+        "records": [{"data": b64compress(data), "recordId": str(i)} for i in range(3)]
+    }
+    processed = process_records(event["records"], "ARN", config)
+    # Room for the first record's data, and a little more
+    max_return_size = len(json.dumps({"records": processed})) - 2 * len(
+        processed[0]["data"]
+    )
+
+    decode = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.decode_firehose_record_data",
+        wraps=decode_firehose_record_data,
+    )
+    record_details = []
+    records = process_records(
+        event["records"],
+        "ARN",
+        config,
+        record_details,
+        ProcessingOptions(max_return_size, True),
+    )
+    assert decode.call_count == 2
+    assert records[2] == {"result": "Dropped", "recordId": "2"}
+    assert record_details[2]["skipped"]
+
+    reingested = work_out_records_to_reingest(
+        event, records, max_return_size, record_details
+    )
+    assert [rec["result"] for rec in records] == ["Ok", "Dropped", "Dropped"]
+    original_data = base64.b64decode(event["records"][0]["data"])
+    assert reingested == [[{"Data": original_data}], [{"Data": original_data}]]
+    assert len(json.dumps({"records": records})) <= max_return_size
+
+
+def test_work_out_records_to_reingest_transformed():
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "TEST_LOG_GROUP",
+        "logStream": "TEST_LOG_STREAM",
+        "logEvents": [
+            {"id": "1", "timestamp": 1510109208016, "message": "log message 1"}
+        ],
+    }
+    event = {"records": [{"data": b64compress(data)}, {"data": b64compress(data)}]}
+    transformed = base64.b64encode(b'{"event": "log message 1"}').decode()
+    records = [
+        {"result": "Ok", "recordId": "1", "data": transformed},
+        {"result": "Ok", "recordId": "2", "data": transformed},
+    ]
+    max_return_size = len(json.dumps({"records": records})) - 1
+
+    reingested = work_out_records_to_reingest(
+        event,
+        records,
+        max_return_size,
+        options=PackingOptions(reingest_transformed=True),
+    )
+    assert [rec["result"] for rec in records] == ["Ok", "Dropped"]
+    assert [gzip.decompress(r["Data"]) for r in reingested[0]] == [
+        b'{"event": "log message 1"}'
+    ]
@@ -1,13 +1,18 @@
 from unittest import mock
 
 import pytest
-from src.mbtp_splunk_cloudwatch_transformation.handler import reingest_records
+from src.mbtp_splunk_cloudwatch_transformation.handler import (
+    FirehoseRetrier,
+    RetrySettings,
+    batch_reingestion_records,
+    reingest_records,
+)
 from os import environ
 import boto3
 
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 
-
 records = [
     [
         {"Data": "1"},
@@ -18,6 +23,7 @@ records = [
 
 
 def test_reingest_records_failures(mocker):
+    mocker.patch("src.mbtp_splunk_cloudwatch_transformation.handler.time.sleep")
     mocked_firehose_client = boto3.client("firehose", region_name=environ["AWS_REGION"])
     firehose_stubber = Stubber(mocked_firehose_client)
     firehose_stubber.add_response(
@@ -57,10 +63,11 @@ def test_reingest_records_failures(mocker):
         "src.mbtp_splunk_cloudwatch_transformation.handler.firehose_client",
         new=mocked_firehose_client,
     )
-    reingest_records(records, "STREAM_NAME", 2)
+    reingest_records(records, "STREAM_NAME", 2, max_workers=1)
 
 
 def test_reingest_records_errored(mocker):
+    mocker.patch("src.mbtp_splunk_cloudwatch_transformation.handler.time.sleep")
     mocked_firehose_client = boto3.client("firehose", region_name=environ["AWS_REGION"])
     firehose_stubber = Stubber(mocked_firehose_client)
     for _ in range(0, 20):
@@ -73,3 +80,116 @@ def test_reingest_records_errored(mocker):
     )
     with pytest.raises(RuntimeError):
         reingest_records(records, "STREAM_NAME")
+
+
+def test_batch_reingestion_records():
+    to_batch = [{"Data": b"x" * size} for size in [3, 3, 3, 5, 1, 1, 1]]
+    assert [
+        [len(r["Data"]) for r in batch]
+        for batch in batch_reingestion_records(to_batch, 3, 6)
+    ] == [[3, 3], [3], [5, 1], [1, 1]]
+    # Records over the byte limit still get sent, on their own
+    assert batch_reingestion_records([{"Data": b"xx"}], 3, 1) == [[{"Data": b"xx"}]]
+
+
+def test_reingest_records_concurrently(mocker):
+    sent = []
+
+    def put_record_batch(DeliveryStreamName, Records):
+        sent.append(Records)
+        return {"FailedPutCount": 0, "RequestResponses": [{} for _ in Records]}
+
+    mocked_firehose_client = mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.firehose_client"
+    )
+    mocked_firehose_client.put_record_batch.side_effect = put_record_batch
+    to_reingest = [[{"Data": b"x" * 10}] for _ in range(10)]
+    reingest_records(to_reingest, "STREAM_NAME", max_batch_bytes=25, max_workers=3)
+    assert len(sent) == 5
+    assert sorted(len(batch) for batch in sent) == [2, 2, 2, 2, 2]
+    # A concurrency of 0 still sends everything
+    sent.clear()
+    reingest_records(to_reingest, "STREAM_NAME", max_batch_bytes=25, max_workers=0)
+    assert len(sent) == 5
+
+
+class FakeFirehoseClient:
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.calls = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls.append(Records)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {
+            "FailedPutCount": sum(1 for code in outcome if code),
+            "RequestResponses": [
+                {"ErrorCode": code} if code else {} for code in outcome
+            ],
+        }
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code}}, "PutRecordBatch")
+
+
+def test_firehose_retrier_backs_off(mocker):
+    mocker.patch(
+        "src.mbtp_splunk_cloudwatch_transformation.handler.random.uniform",
+        side_effect=lambda low, high: high,
+    )
+    client = FakeFirehoseClient(
+        [
+            ["InternalFailure", None, "InternalFailure"],
+            client_error("ServiceUnavailableException"),
+            ["ServiceUnavailableException", None],
+            [None],
+        ]
+    )
+    delays = []
+    retrier = FirehoseRetrier(
+        client,
+        settings=RetrySettings(base_delay=1, throttled_base_delay=10, max_delay=30),
+        sleep=delays.append,
+    )
+    assert retrier.put_record_batch(
+        "STREAM_NAME", [{"Data": "1"}, {"Data": "2"}, {"Data": "3"}]
+    ) == ([], "")
+    assert client.calls == [
+        [{"Data": "1"}, {"Data": "2"}, {"Data": "3"}],
+        [{"Data": "1"}, {"Data": "3"}],
+        [{"Data": "1"}, {"Data": "3"}],
+        [{"Data": "1"}],
+    ]
+    assert delays == [1, 20, 30]
+
+
+def test_firehose_retrier_gives_up():
+    delays = []
+    client = FakeFirehoseClient([["InternalFailure"]] * 3)
+    failed, err_msg = FirehoseRetrier(
+        client, settings=RetrySettings(max_attempts=3), sleep=delays.append
+    ).put_record_batch("STREAM_NAME", [{"Data": "1"}])
+    assert failed == [{"Data": "1"}]
+    assert (
+        err_msg == "Gave up after 3 attempts. Individual error codes: InternalFailure"
+    )
+    assert len(delays) == 2
+
+    # Errors retrying won't fix
+    client = FakeFirehoseClient([client_error("ResourceNotFoundException")])
+    failed, _ = FirehoseRetrier(client, sleep=delays.append).put_record_batch(
+        "STREAM_NAME", [{"Data": "1"}]
+    )
+    assert failed == [{"Data": "1"}]
+    assert len(client.calls) == 1
+
+    # Retries that would go past the deadline
+    client = FakeFirehoseClient([["InternalFailure"]])
+    failed, err_msg = FirehoseRetrier(
+        client, deadline=100, sleep=delays.append, clock=lambda: 100
+    ).put_record_batch("STREAM_NAME", [{"Data": "1"}])
+    assert failed == [{"Data": "1"}]
+    assert err_msg.startswith("Out of time to retry after 1 attempts.")
@@ -30,10 +30,11 @@ resource "aws_lambda_function" "firehose_lambda_reingestion" {
   }
   environment {
     variables = {
-      MAX_RETRIES    = 3
-      STREAM_NAME    = local.firehose_stream_name
-      RETRIES_PREFIX = var.s3_retries_prefix
-      FAILED_PREFIX  = var.s3_failed_prefix
+      MAX_RETRIES                   = 3
+      STREAM_NAME                   = local.firehose_stream_name
+      RETRIES_PREFIX                = var.s3_retries_prefix
+      FAILED_PREFIX                 = var.s3_failed_prefix
+      MAX_DECOMPRESSED_RECORD_BYTES = var.reingestion_lambda_max_decompressed_record_bytes
     }
   }
 }
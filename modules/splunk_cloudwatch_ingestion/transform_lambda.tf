@@ -42,8 +42,23 @@ resource "aws_lambda_function" "firehose_lambda_transformation" {
   }
   environment {
     variables = {
-      CONFIG_S3_BUCKET = var.s3_bucket_name
-      CONFIG_S3_KEY    = var.s3_config_file_key
+      CONFIG_S3_BUCKET              = var.s3_bucket_name
+      CONFIG_S3_KEY                 = var.s3_config_file_key
+      RAW_JSON_SPLICE               = var.transformation_lambda_raw_json_splice
+      DECODED_RECORD_CACHE_BYTES    = var.transformation_lambda_decoded_record_cache_bytes
+      STREAMING_BUDGET              = var.transformation_lambda_streaming_budget
+      REINGEST_TRANSFORMED          = var.transformation_lambda_reingest_transformed
+      TRANSFORM_WORKERS             = var.transformation_lambda_transform_workers
+      TRANSFORM_WORKER_TYPE         = var.transformation_lambda_transform_worker_type
+      REINGEST_CONCURRENCY          = var.transformation_lambda_reingest_concurrency
+      CONFIG_RELOAD_SECONDS         = var.transformation_lambda_config_reload_seconds
+      DROP_LOG_SAMPLES              = var.transformation_lambda_drop_log_samples
+      STAGE_METRICS                 = var.transformation_lambda_stage_metrics
+      STREAMING_PARSE               = var.transformation_lambda_streaming_parse
+      MAX_DECOMPRESSED_RECORD_BYTES = var.transformation_lambda_max_decompressed_record_bytes
+      PROCESSING_DEADLINE_MARGIN    = var.transformation_lambda_processing_deadline_margin
+      PACKING_STRATEGY              = var.transformation_lambda_packing_strategy
+      ROUTE_CACHE_SIZE              = var.transformation_lambda_route_cache_size
     }
   }
   depends_on = [null_resource.transformation_lambda_exporter]
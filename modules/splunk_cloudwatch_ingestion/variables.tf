@@ -141,6 +141,85 @@ variable "transformation_lambda_log_level" {
   description = "Logging level of the lambda function"
   default     = "INFO"
 }
+variable "transformation_lambda_config_reload_seconds" {
+  description = "Seconds between the transformation lambda checking S3 for changes to its config, or 0 to only load it on a cold start."
+  type        = number
+  default     = 300
+}
+variable "transformation_lambda_route_cache_size" {
+  description = "Number of log stream and detail type routing results the transformation lambda keeps for its config, so the routing regexes aren't run again for the same log stream."
+  type        = number
+  default     = 4096
+}
+variable "transformation_lambda_raw_json_splice" {
+  description = "Splice JSON log messages into Splunk events as they are, instead of re-serialising them. Saves CPU but keeps the original formatting of the JSON."
+  type        = bool
+  default     = false
+}
+variable "transformation_lambda_decoded_record_cache_bytes" {
+  description = "Maximum total decompressed size, in bytes, of oversized records the transformation lambda keeps decompressed so it can split them without decompressing them again."
+  type        = number
+  default     = 67108864
+}
+variable "transformation_lambda_streaming_budget" {
+  description = "Whether the transformation lambda should stop transforming records once its response is full, reingesting the rest as they are."
+  type        = bool
+  default     = false
+}
+variable "transformation_lambda_streaming_parse" {
+  description = "Whether the transformation lambda routes Cloudwatch records on their header before decompressing and parsing their log events one at a time."
+  type        = bool
+  default     = false
+}
+variable "transformation_lambda_reingest_transformed" {
+  description = "Whether records that don't fit in the transformation lambda's response are reingested already transformed, rather than as they were received."
+  type        = bool
+  default     = false
+}
+variable "transformation_lambda_packing_strategy" {
+  description = "How the transformation lambda chooses which records to return when they don't all fit in its response, one of in_order, max_bytes or min_records."
+  type        = string
+  default     = "in_order"
+}
+variable "transformation_lambda_transform_workers" {
+  description = "Number of workers the transformation lambda transforms records with, or 0 for one per vCPU. Only worth raising above 1 once the lambda's memory size gives it more than one vCPU."
+  type        = number
+  default     = 1
+}
+variable "transformation_lambda_transform_worker_type" {
+  description = "Type of worker the transformation lambda uses when transformation_lambda_transform_workers is above 1, either process or thread."
+  type        = string
+  default     = "process"
+}
+variable "transformation_lambda_reingest_concurrency" {
+  description = "Number of batches of records the transformation lambda sends back to Firehose at once when reingesting."
+  type        = number
+  default     = 4
+  validation {
+    condition     = var.transformation_lambda_reingest_concurrency >= 1
+    error_message = "transformation_lambda_reingest_concurrency must be at least 1."
+  }
+}
+variable "transformation_lambda_drop_log_samples" {
+  description = "Number of events dropped by each sourcetype regex that the transformation lambda logs in full per invocation, alongside a summary of how many were dropped."
+  type        = number
+  default     = 3
+}
+variable "transformation_lambda_stage_metrics" {
+  description = "Whether the transformation lambda emits the time spent in each stage of processing as CloudWatch metrics. These are custom metrics, which are charged for."
+  type        = bool
+  default     = false
+}
+variable "transformation_lambda_max_decompressed_record_bytes" {
+  description = "Most bytes the data of a record can decompress to in the transformation lambda. Records that decompress to more are marked as ProcessingFailed."
+  type        = number
+  default     = 67108864
+}
+variable "transformation_lambda_processing_deadline_margin" {
+  description = "Seconds before the transformation lambda times out that it stops transforming records, reingesting the rest as they are."
+  type        = number
+  default     = 10
+}
 
 # Reingestion Lambda
 variable "reingestion_lambda_name" {
@@ -159,6 +238,11 @@ variable "reingestion_lambda_log_level" {
   description = "Logging level of the lambda function"
   default     = "INFO"
 }
+variable "reingestion_lambda_max_decompressed_record_bytes" {
+  description = "Most bytes the data of a record can decompress to in the reingestion lambda. Records that decompress to more are moved to the failed prefix as they are."
+  type        = number
+  default     = 67108864
+}
 
 # Process Failures Lambda
 variable "process_failures_lambda_name" {